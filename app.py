@@ -1,13 +1,26 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_file, abort, g, Response
+from flask import before_render_template, template_rendered
+from markupsafe import Markup
 import poplib
 import smtplib
-import email
-from email.header import decode_header
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-import re
+import asyncio
+import hashlib
+import inspect
+import time
 from datetime import datetime
 from functools import wraps
+from mail_store import MessageStore
+from mail_pool import ConnectionPool
+from mail_stream import SESSION_ERRORS, read_message
+from mail_attachments import AttachmentStore
+from mail_metrics import metrics
+from mail_sessions import SessionStore
+from mail_text import clean_text, decode_mime_words, decode_payload, extract_address, html_to_text
+from mail_sync import SyncWorker
+from mail_async import AsyncPOP3, AsyncSMTP, AsyncConnectionPool, MailLoop
+from mail_outbox import SendQueue, classify_send_error
 
 app = Flask(__name__)
 app.secret_key = 'India@team05'  # Change this to a random string
@@ -19,9 +32,81 @@ EMAIL_CONFIG = {
     'pop_port': 110,
     'smtp_port': 587,
     'use_ssl_pop': False,
-    'use_tls_smtp': True
+    'use_tls_smtp': True,
+    'cache_path': 'mail_cache.db',
+    # Exported CSV files added to the search index
+    'export_files': ['sent_items.csv'],
+    'search_page_size': 20,
+    'preview_lines': 30,
+    'preview_chars': 200,
+    # Text kept per message; attachments are streamed to attachment_dir
+    'max_text_bytes': 1024 * 1024,
+    'attachment_dir': 'attachments',
+    'max_sessions_per_server': 4,
+    'pool_idle_timeout': 60,
+    # A POP3 session only sees the maildrop as it was at login, so pooled
+    # POP3 sessions are recycled quickly to pick up new mail
+    'pop_session_max_age': 30,
+    'smtp_session_max_age': 300,
+    # Background sync of logged-in accounts
+    'sync_interval': 60,
+    'sync_idle_timeout': 1800,
+    'sync_workers': 4,
+    'inbox_poll_interval': 15,
+    'inbox_size': 50,
+    'max_page_size': 200,
+    # Serve mail operations from asyncio sessions on one background loop
+    'async_backend': True,
+    # Outbound queue: messages per SMTP session, per-account rate and retries
+    'send_batch_size': 50,
+    'send_rate_per_minute': 120,
+    'send_max_attempts': 5,
+    'send_retry_delay': 5,
+    # Login sessions are kept server-side; the cookie only holds a session id
+    # and the key to the stored password. Set a path (e.g. 'sessions.db') to
+    # share sessions between several worker processes
+    'session_store_path': None,
+    'session_ttl': 86400
 }
 
+# Local message cache shared by all requests
+message_store = MessageStore(EMAIL_CONFIG['cache_path'])
+
+# Attachment files, stored once per distinct content
+attachment_store = AttachmentStore(EMAIL_CONFIG['attachment_dir'])
+
+# Credentials of logged-in users
+session_store = SessionStore(EMAIL_CONFIG['session_store_path'], ttl=EMAIL_CONFIG['session_ttl'])
+
+# Authenticated POP3/SMTP sessions reused across requests
+pop_pool = ConnectionPool(
+    max_per_server=EMAIL_CONFIG['max_sessions_per_server'],
+    max_per_key=1,
+    idle_timeout=EMAIL_CONFIG['pool_idle_timeout'],
+    max_age=EMAIL_CONFIG['pop_session_max_age']
+)
+smtp_pool = ConnectionPool(
+    max_per_server=EMAIL_CONFIG['max_sessions_per_server'],
+    max_per_key=1,
+    idle_timeout=EMAIL_CONFIG['pool_idle_timeout'],
+    max_age=EMAIL_CONFIG['smtp_session_max_age']
+)
+
+# Event loop and sessions of the asyncio backend
+mail_loop = MailLoop()
+async_pop_pool = AsyncConnectionPool(
+    max_per_server=EMAIL_CONFIG['max_sessions_per_server'],
+    max_per_key=1,
+    idle_timeout=EMAIL_CONFIG['pool_idle_timeout'],
+    max_age=EMAIL_CONFIG['pop_session_max_age']
+)
+async_smtp_pool = AsyncConnectionPool(
+    max_per_server=EMAIL_CONFIG['max_sessions_per_server'],
+    max_per_key=1,
+    idle_timeout=EMAIL_CONFIG['pool_idle_timeout'],
+    max_age=EMAIL_CONFIG['smtp_session_max_age']
+)
+
 class EmailManager:
     def __init__(self, email_address, password):
         self.email_address = email_address
@@ -29,71 +114,117 @@ class EmailManager:
         self.pop_connection = None
         self.smtp_connection = None
     
-    def connect_pop(self):
-        """Connect to POP3 server"""
-        try:
+    def pool_key(self, server):
+        """Key pooled sessions by server, account and a digest of the password
+        
+        Including the password digest means a login with new credentials is
+        never satisfied by a session authenticated with the old ones.
+        """
+        digest = hashlib.sha256(self.password.encode('utf-8')).hexdigest()
+        return (server, self.email_address.lower(), digest)
+    
+    def open_pop(self):
+        """Open and authenticate a new POP3 session"""
+        with metrics.time('pop_connect'):
             if EMAIL_CONFIG['use_ssl_pop']:
-                self.pop_connection = poplib.POP3_SSL(
+                connection = poplib.POP3_SSL(
                     EMAIL_CONFIG['pop_server'], 
                     EMAIL_CONFIG['pop_port'], 
                     timeout=30
                 )
             else:
-                self.pop_connection = poplib.POP3(
+                connection = poplib.POP3(
                     EMAIL_CONFIG['pop_server'], 
                     EMAIL_CONFIG['pop_port'], 
                     timeout=30
                 )
+        
+        try:
+            with metrics.time('pop_login'):
+                connection.user(self.email_address)
+                connection.pass_(self.password)
+        except Exception:
+            connection.close()
+            raise
+        return connection
+    
+    def open_smtp(self):
+        """Open and authenticate a new SMTP session"""
+        with metrics.time('smtp_connect'):
+            connection = smtplib.SMTP(
+                EMAIL_CONFIG['smtp_server'], 
+                EMAIL_CONFIG['smtp_port'], 
+                timeout=30
+            )
+        
+        try:
+            if EMAIL_CONFIG['use_tls_smtp']:
+                with metrics.time('smtp_starttls'):
+                    connection.starttls()
             
-            self.pop_connection.user(self.email_address)
-            self.pop_connection.pass_(self.password)
+            with metrics.time('smtp_login'):
+                connection.login(self.email_address, self.password)
+        except Exception:
+            connection.close()
+            raise
+        return connection
+    
+    def connect_pop(self):
+        """Check out a POP3 session from the pool"""
+        try:
+            self.pop_connection = pop_pool.acquire(
+                self.pool_key(EMAIL_CONFIG['pop_server']), self.open_pop
+            )
             return True
         except Exception as e:
             print(f"POP3 connection error: {str(e)}")
             return False
     
+    def release_pop(self, discard=False):
+        """Return the POP3 session to the pool"""
+        if self.pop_connection is not None:
+            pop_pool.release(self.pop_connection, discard=discard)
+            self.pop_connection = None
+    
     def connect_smtp(self):
-        """Connect to SMTP server"""
+        """Check out an SMTP session from the pool"""
         try:
-            self.smtp_connection = smtplib.SMTP(
-                EMAIL_CONFIG['smtp_server'], 
-                EMAIL_CONFIG['smtp_port'], 
-                timeout=30
+            self.smtp_connection = smtp_pool.acquire(
+                self.pool_key(EMAIL_CONFIG['smtp_server']), self.open_smtp
             )
-            
-            if EMAIL_CONFIG['use_tls_smtp']:
-                self.smtp_connection.starttls()
-            
-            self.smtp_connection.login(self.email_address, self.password)
             return True
         except Exception as e:
             print(f"SMTP connection error: {str(e)}")
             return False
     
+    def release_smtp(self, discard=False):
+        """Return the SMTP session to the pool"""
+        if self.smtp_connection is not None:
+            smtp_pool.release(self.smtp_connection, discard=discard)
+            self.smtp_connection = None
+    
+    def check_login(self):
+        """Check the credentials; the session stays pooled for the next request"""
+        if not self.connect_pop():
+            return False
+        self.release_pop()
+        return True
+    
     def decode_mime_words(self, s):
         """Decode MIME encoded strings"""
-        if s is None:
-            return ""
-        decoded_fragments = decode_header(s)
-        fragments = []
-        for fragment, encoding in decoded_fragments:
-            if isinstance(fragment, bytes):
-                try:
-                    fragment = fragment.decode(encoding or 'utf-8', errors='ignore')
-                except:
-                    fragment = fragment.decode('utf-8', errors='ignore')
-            fragments.append(str(fragment))
-        return ''.join(fragments)
+        return decode_mime_words(s)
     
     def clean_text(self, text):
         """Clean text for display"""
-        if text is None:
-            return ""
-        text = re.sub(r'\s+', ' ', text)
-        return text.strip()
+        return clean_text(text)
     
     def get_email_body(self, msg):
-        """Extract email body from message"""
+        """Extract email body from message; HTML-only bodies are converted to text"""
+        body, html_body = self.get_email_parts(msg)
+        return body if body else html_to_text(html_body)
+    
+    def get_email_parts(self, msg):
+        """Return the ``(text, html)`` bodies of a message, either of them possibly empty"""
         body = ""
         html_body = ""
         
@@ -102,19 +233,19 @@ class EmailManager:
                 content_type = part.get_content_type()
                 content_disposition = str(part.get("Content-Disposition"))
                 
-                if content_type == "text/plain" and "attachment" not in content_disposition:
+                if content_type == "text/plain" and not body and "attachment" not in content_disposition:
                     try:
-                        body = part.get_payload(decode=True).decode('utf-8', errors='ignore')
+                        body = decode_payload(part)
                     except:
                         body = str(part.get_payload())
-                elif content_type == "text/html" and "attachment" not in content_disposition:
+                elif content_type == "text/html" and not html_body and "attachment" not in content_disposition:
                     try:
-                        html_body = part.get_payload(decode=True).decode('utf-8', errors='ignore')
+                        html_body = decode_payload(part)
                     except:
                         html_body = str(part.get_payload())
         else:
             try:
-                content = msg.get_payload(decode=True).decode('utf-8', errors='ignore')
+                content = decode_payload(msg)
                 if msg.get_content_type() == "text/html":
                     html_body = content
                 else:
@@ -122,46 +253,209 @@ class EmailManager:
             except:
                 body = str(msg.get_payload())
         
-        return body if body else html_body
+        return body, html_body
     
-    def get_emails(self, limit=50):
-        """Retrieve emails from POP3 server"""
+    def get_uidls(self):
+        """Return a mapping of message number to UIDL for the maildrop"""
+        with metrics.time('pop_list'):
+            response, lines, octets = self.pop_connection.uidl()
+        return self.parse_uidls(lines)
+    
+    def parse_uidls(self, lines):
+        """Parse the lines of a UIDL listing into a message number to UIDL mapping"""
+        uidls = {}
+        for line in lines:
+            num, uidl = line.decode('ascii', errors='ignore').split(None, 1)
+            uidls[int(num)] = uidl.strip()
+        return uidls
+    
+    def get_uidl(self, msg_num):
+        """Return the UIDL of a single message"""
+        return self.parse_uidl(self.pop_connection.uidl(msg_num))
+    
+    def parse_uidl(self, response):
+        """Parse the UIDL out of a single-message UIDL response"""
+        return response.decode('ascii', errors='ignore').split()[2]
+    
+    def fetch_message(self, command, msg_num, *args, attachments=None):
+        """Stream a RETR or TOP response into a parsed message
+        
+        Returns ``(msg, octets)``. Only text parts are kept, capped at
+        ``max_text_bytes``, so large attachments never sit in memory;
+        with an ``attachments`` collector they are written to disk instead.
+        """
+        return read_message(
+            self.pop_connection, command, msg_num, *args,
+            max_text_bytes=EMAIL_CONFIG['max_text_bytes'],
+            attachments=attachments
+        )
+    
+    def parse_email(self, msg_num, msg):
+        """Convert a parsed message into an email dict
+        
+        ``msg`` may also come from the truncated output of TOP, in which case
+        the body is partial and only suitable for the preview.
+        """
+        with metrics.time('decode'):
+            return self.decode_email(msg_num, msg)
+    
+    def decode_email(self, msg_num, msg):
+        """Decode the headers and body of a parsed message, see parse_email"""
+        body, html_body = self.get_email_parts(msg)
+        preview = body
+        if not body:
+            body = html_to_text(html_body)
+            # The preview leaves out the quoted history of replies, unless that is all there is
+            preview = html_to_text(html_body, strip_history=True) or body
+        
+        return {
+            'id': msg_num,
+            'date': msg.get('Date', ''),
+            'from': self.decode_mime_words(msg.get('From', '')),
+            'to': self.decode_mime_words(msg.get('To', '')),
+            'cc': self.decode_mime_words(msg.get('CC', '')),
+            'subject': self.decode_mime_words(msg.get('Subject', '(No Subject)')),
+            'body': body,
+            'preview': self.clean_text(preview)[:EMAIL_CONFIG['preview_chars']],
+            'message_id': str(msg.get('Message-ID', '')),
+            'in_reply_to': str(msg.get('In-Reply-To', '')),
+            'references': str(msg.get('References', ''))
+        }
+    
+    def sync_mailbox(self, limit=50, before=None):
+        """Download headers of the newest ``limit`` messages that are not cached yet
+        
+        With a ``before`` UIDL cursor the ``limit`` messages below that one
+        are synced instead, for paging back through older mail.
+        
+        New messages are fetched with TOP so only the headers and the first
+        few body lines cross the wire; full bodies load in get_email.
+        Returns the number of messages added, or None on failure.
+        """
         if not self.connect_pop():
             return None
         
+        account = self.email_address.lower()
+        added = 0
+        
         try:
-            num_messages = len(self.pop_connection.list()[1])
-            start_msg = max(1, num_messages - limit + 1)
+            uidls = self.get_uidls()
+            message_store.update_positions(account, uidls)
+            known = message_store.known_uidls(account)
             
-            emails = []
-            
-            for i in range(num_messages, start_msg - 1, -1):
+            for i in self.sync_range(uidls, limit, before):
+                uidl = uidls.get(i)
+                if uidl is None or uidl in known:
+                    continue
                 try:
-                    response, lines, octets = self.pop_connection.retr(i)
-                    msg_content = b'\r\n'.join(lines)
-                    msg = email.message_from_bytes(msg_content)
-                    
-                    email_data = {
-                        'id': i,
-                        'date': msg.get('Date', ''),
-                        'from': self.decode_mime_words(msg.get('From', '')),
-                        'to': self.decode_mime_words(msg.get('To', '')),
-                        'subject': self.decode_mime_words(msg.get('Subject', '(No Subject)')),
-                        'body': self.get_email_body(msg),
-                        'message_id': msg.get('Message-ID', '')
-                    }
-                    
-                    emails.append(email_data)
+                    msg, octets = self.fetch_message('TOP', i, EMAIL_CONFIG['preview_lines'])
+                    email_data = self.parse_email(i, msg)
+                    message_store.save_message(account, uidl, i, email_data, size=octets, has_body=False)
+                    added += 1
+                except SESSION_ERRORS:
+                    # The session lost its place in the response stream
+                    raise
                 except Exception as e:
                     print(f"Error retrieving email {i}: {str(e)}")
                     continue
             
-            self.pop_connection.quit()
-            return emails
+            self.release_pop()
+            return added
             
         except Exception as e:
             print(f"Error getting emails: {str(e)}")
+            self.release_pop(discard=True)
+            return None
+    
+    def sync_range(self, uidls, limit, before=None):
+        """Message numbers to sync, newest first: ``limit`` below ``before`` or the newest"""
+        positions = {uidl: num for num, uidl in uidls.items()}
+        end_msg = positions.get(before, len(uidls) + 1) - 1 if before else len(uidls)
+        start_msg = max(1, end_msg - limit + 1)
+        return range(end_msg, start_msg - 1, -1)
+    
+    def needs_fetch(self, page, before):
+        """Whether a page from the store is missing headers that must be downloaded"""
+        return bool(page['missing'] or (before is not None and not page['emails']))
+    
+    def get_emails(self, limit=50):
+        """Sync the mailbox and return the inbox listing from the local cache"""
+        if self.sync_mailbox(limit) is None:
             return None
+        return message_store.get_messages(self.email_address.lower(), limit)
+    
+    def get_page(self, before=None, page_size=50, fetch=True):
+        """Return one inbox page from the local store, see MessageStore.get_page
+        
+        With ``fetch`` set, headers missing from the page (or a cursor the
+        store does not know yet) are downloaded first.
+        """
+        account = self.email_address.lower()
+        page = message_store.get_page(account, before, page_size)
+        
+        if fetch and self.needs_fetch(page, before):
+            if self.sync_mailbox(limit=page_size, before=before) is None:
+                return None
+            page = message_store.get_page(account, before, page_size)
+        return page
+    
+    def get_email(self, email_id):
+        """Retrieve a single email, from the local cache when possible"""
+        account = self.email_address.lower()
+        
+        email_data = message_store.get_message(account, email_id)
+        if email_data is not None and email_data['has_body']:
+            return email_data
+        
+        if not self.connect_pop():
+            return None
+        
+        try:
+            try:
+                uidl = self.get_uidl(email_id)
+            except poplib.error_proto:
+                uidl = None
+            if email_data is not None and uidl != email_data['uidl']:
+                # Messages were deleted since the cache was numbered: renumber
+                # it and fetch the cached message from its current position
+                uidls = self.get_uidls()
+                message_store.update_positions(account, uidls)
+                uidl = email_data['uidl']
+                email_id = next((num for num, value in uidls.items() if value == uidl), None)
+            if uidl is None or email_id is None:
+                self.release_pop()
+                return None
+            collector = attachment_store.collector()
+            try:
+                msg, octets = self.fetch_message('RETR', email_id, attachments=collector)
+            finally:
+                collector.abort()
+            email_data = self.parse_email(email_id, msg)
+            email_data['attachments'] = collector.saved
+            message_store.save_message(account, uidl, email_id, email_data, size=octets)
+            
+            self.release_pop()
+            email_data['uidl'] = uidl
+            return email_data
+            
+        except Exception as e:
+            print(f"Error retrieving email {email_id}: {str(e)}")
+            self.release_pop(discard=True)
+            return None
+    
+    def build_message(self, to_address, subject, body, in_reply_to=None):
+        """Build an outgoing plain text message"""
+        msg = MIMEMultipart()
+        msg['From'] = self.email_address
+        msg['To'] = to_address
+        msg['Subject'] = subject
+        
+        if in_reply_to:
+            msg['In-Reply-To'] = in_reply_to
+            msg['References'] = in_reply_to
+        
+        msg.attach(MIMEText(body, 'plain'))
+        return msg
     
     def send_email(self, to_address, subject, body, in_reply_to=None):
         """Send an email via SMTP"""
@@ -169,35 +463,370 @@ class EmailManager:
             return False, "Failed to connect to SMTP server"
         
         try:
-            msg = MIMEMultipart()
-            msg['From'] = self.email_address
-            msg['To'] = to_address
-            msg['Subject'] = subject
+            msg = self.build_message(to_address, subject, body, in_reply_to)
+            with metrics.time('smtp_send'):
+                self.smtp_connection.send_message(msg)
+            self.release_smtp()
+            
+            return True, "Email sent successfully"
+            
+        except Exception as e:
+            self.release_smtp(discard=True)
+            return False, f"Error sending email: {str(e)}"
+    
+    def send_batch(self, items):
+        """Send several messages over one SMTP session
+        
+        ``items`` are dicts of send_email arguments. Returns one
+        ``(success, error, permanent)`` tuple per item; once the session
+        breaks, the rest of the batch fails as retryable.
+        """
+        if not self.connect_smtp():
+            return [(False, "Failed to connect to SMTP server", False)] * len(items)
+        
+        results = []
+        for item in items:
+            try:
+                with metrics.time('smtp_send'):
+                    self.smtp_connection.send_message(self.build_message(**item))
+                results.append((True, None, False))
+            except Exception as e:
+                error, permanent, broken = classify_send_error(e)
+                results.append((False, error, permanent))
+                if broken:
+                    self.release_smtp(discard=True)
+                    return results + [(False, error, False)] * (len(items) - len(results))
+        
+        self.release_smtp()
+        return results
+
+class AsyncEmailManager(EmailManager):
+    """EmailManager on the asyncio backend
+    
+    The network operations are coroutines that must run on ``mail_loop``,
+    with sessions from the asyncio pools. Parsing, caching and the message
+    format are shared with the blocking EmailManager.
+    """
+    
+    async def open_pop(self):
+        """Open and authenticate a new POP3 session"""
+        with metrics.time('pop_connect'):
+            connection = await AsyncPOP3.connect(
+                EMAIL_CONFIG['pop_server'], 
+                EMAIL_CONFIG['pop_port'], 
+                use_ssl=EMAIL_CONFIG['use_ssl_pop'],
+                timeout=30
+            )
+        
+        try:
+            with metrics.time('pop_login'):
+                await connection.user(self.email_address)
+                await connection.pass_(self.password)
+        except Exception:
+            connection.close()
+            raise
+        return connection
+    
+    async def open_smtp(self):
+        """Open and authenticate a new SMTP session"""
+        with metrics.time('smtp_connect'):
+            connection = await AsyncSMTP.connect(
+                EMAIL_CONFIG['smtp_server'], 
+                EMAIL_CONFIG['smtp_port'], 
+                timeout=30
+            )
+        
+        try:
+            if EMAIL_CONFIG['use_tls_smtp']:
+                with metrics.time('smtp_starttls'):
+                    await connection.starttls()
+            
+            with metrics.time('smtp_login'):
+                await connection.login(self.email_address, self.password)
+        except Exception:
+            connection.close()
+            raise
+        return connection
+    
+    async def connect_pop(self):
+        """Check out a POP3 session from the pool"""
+        try:
+            self.pop_connection = await async_pop_pool.acquire(
+                self.pool_key(EMAIL_CONFIG['pop_server']), self.open_pop
+            )
+            return True
+        except Exception as e:
+            print(f"POP3 connection error: {str(e)}")
+            return False
+    
+    async def release_pop(self, discard=False):
+        """Return the POP3 session to the pool"""
+        if self.pop_connection is not None:
+            await async_pop_pool.release(self.pop_connection, discard=discard)
+            self.pop_connection = None
+    
+    async def connect_smtp(self):
+        """Check out an SMTP session from the pool"""
+        try:
+            self.smtp_connection = await async_smtp_pool.acquire(
+                self.pool_key(EMAIL_CONFIG['smtp_server']), self.open_smtp
+            )
+            return True
+        except Exception as e:
+            print(f"SMTP connection error: {str(e)}")
+            return False
+    
+    async def release_smtp(self, discard=False):
+        """Return the SMTP session to the pool"""
+        if self.smtp_connection is not None:
+            await async_smtp_pool.release(self.smtp_connection, discard=discard)
+            self.smtp_connection = None
+    
+    async def check_login(self):
+        """Check the credentials; the session stays pooled for the next request"""
+        if not await self.connect_pop():
+            return False
+        await self.release_pop()
+        return True
+    
+    async def get_uidls(self):
+        """Return a mapping of message number to UIDL for the maildrop"""
+        with metrics.time('pop_list'):
+            response, lines = await self.pop_connection.uidl()
+        return self.parse_uidls(lines)
+    
+    async def get_uidl(self, msg_num):
+        """Return the UIDL of a single message"""
+        return self.parse_uidl(await self.pop_connection.uidl(msg_num))
+    
+    async def fetch_message(self, command, msg_num, *args, attachments=None):
+        """Stream a RETR or TOP response into a parsed message"""
+        return await self.pop_connection.read_message(
+            command, msg_num, *args,
+            max_text_bytes=EMAIL_CONFIG['max_text_bytes'],
+            attachments=attachments
+        )
+    
+    async def sync_mailbox(self, limit=50, before=None):
+        """Download headers of messages that are not cached yet, see EmailManager.sync_mailbox"""
+        if not await self.connect_pop():
+            return None
+        
+        account = self.email_address.lower()
+        added = 0
+        
+        try:
+            uidls = await self.get_uidls()
+            message_store.update_positions(account, uidls)
+            known = message_store.known_uidls(account)
+            
+            for i in self.sync_range(uidls, limit, before):
+                uidl = uidls.get(i)
+                if uidl is None or uidl in known:
+                    continue
+                try:
+                    msg, octets = await self.fetch_message('TOP', i, EMAIL_CONFIG['preview_lines'])
+                    email_data = self.parse_email(i, msg)
+                    message_store.save_message(account, uidl, i, email_data, size=octets, has_body=False)
+                    added += 1
+                except Exception as e:
+                    print(f"Error retrieving email {i}: {str(e)}")
+                    if self.pop_connection.closed:
+                        # The session lost its place in the response stream
+                        raise
+                    continue
             
-            if in_reply_to:
-                msg['In-Reply-To'] = in_reply_to
-                msg['References'] = in_reply_to
+            await self.release_pop()
+            return added
             
-            msg.attach(MIMEText(body, 'plain'))
+        except Exception as e:
+            print(f"Error getting emails: {str(e)}")
+            await self.release_pop(discard=True)
+            return None
+    
+    async def get_page(self, before=None, page_size=50, fetch=True):
+        """Return one inbox page from the local store, see EmailManager.get_page"""
+        account = self.email_address.lower()
+        page = message_store.get_page(account, before, page_size)
+        
+        if fetch and self.needs_fetch(page, before):
+            if await self.sync_mailbox(limit=page_size, before=before) is None:
+                return None
+            page = message_store.get_page(account, before, page_size)
+        return page
+    
+    async def get_email(self, email_id):
+        """Retrieve a single email, from the local cache when possible"""
+        account = self.email_address.lower()
+        
+        email_data = message_store.get_message(account, email_id)
+        if email_data is not None and email_data['has_body']:
+            return email_data
+        
+        if not await self.connect_pop():
+            return None
+        
+        try:
+            try:
+                uidl = await self.get_uidl(email_id)
+            except poplib.error_proto:
+                uidl = None
+            if email_data is not None and uidl != email_data['uidl']:
+                # Messages were deleted since the cache was numbered: renumber
+                # it and fetch the cached message from its current position
+                uidls = await self.get_uidls()
+                message_store.update_positions(account, uidls)
+                uidl = email_data['uidl']
+                email_id = next((num for num, value in uidls.items() if value == uidl), None)
+            if uidl is None or email_id is None:
+                await self.release_pop()
+                return None
+            collector = attachment_store.collector()
+            try:
+                msg, octets = await self.fetch_message('RETR', email_id, attachments=collector)
+            finally:
+                collector.abort()
+            email_data = self.parse_email(email_id, msg)
+            email_data['attachments'] = collector.saved
+            message_store.save_message(account, uidl, email_id, email_data, size=octets)
             
-            self.smtp_connection.send_message(msg)
-            self.smtp_connection.quit()
+            await self.release_pop()
+            email_data['uidl'] = uidl
+            return email_data
+            
+        except Exception as e:
+            print(f"Error retrieving email {email_id}: {str(e)}")
+            await self.release_pop(discard=True)
+            return None
+    
+    async def send_email(self, to_address, subject, body, in_reply_to=None):
+        """Send an email via SMTP"""
+        if not await self.connect_smtp():
+            return False, "Failed to connect to SMTP server"
+        
+        try:
+            msg = self.build_message(to_address, subject, body, in_reply_to)
+            with metrics.time('smtp_send'):
+                await self.smtp_connection.send_message(msg)
+            await self.release_smtp()
             
             return True, "Email sent successfully"
             
         except Exception as e:
+            await self.release_smtp(discard=True)
             return False, f"Error sending email: {str(e)}"
+    
+    async def send_batch(self, items):
+        """Send several messages over one SMTP session, see EmailManager.send_batch"""
+        if not await self.connect_smtp():
+            return [(False, "Failed to connect to SMTP server", False)] * len(items)
+        
+        results = []
+        for item in items:
+            try:
+                with metrics.time('smtp_send'):
+                    await self.smtp_connection.send_message(self.build_message(**item))
+                results.append((True, None, False))
+            except Exception as e:
+                error, permanent, broken = classify_send_error(e)
+                results.append((False, error, permanent))
+                if broken:
+                    await self.release_smtp(discard=True)
+                    return results + [(False, error, False)] * (len(items) - len(results))
+        
+        await self.release_smtp()
+        return results
+
+def new_manager(email_address, password):
+    """Create the EmailManager for an account on the configured backend"""
+    if EMAIL_CONFIG['async_backend']:
+        return AsyncEmailManager(email_address, password)
+    return EmailManager(email_address, password)
+
+async def run_mail(manager, method, *args, **kwargs):
+    """Await an EmailManager operation from an async view
+    
+    Asyncio operations run on the shared mail loop; blocking ones run in a
+    thread so the view's own event loop is never blocked.
+    """
+    if isinstance(manager, AsyncEmailManager):
+        return await mail_loop.wait(getattr(manager, method)(*args, **kwargs))
+    return await asyncio.to_thread(getattr(manager, method), *args, **kwargs)
+
+def run_mail_blocking(manager, method, *args, **kwargs):
+    """Run an EmailManager operation from a plain thread and wait for it"""
+    if isinstance(manager, AsyncEmailManager):
+        return mail_loop.run(getattr(manager, method)(*args, **kwargs))
+    return getattr(manager, method)(*args, **kwargs)
+
+# Keeps the local store of every logged-in account up to date
+sync_worker = SyncWorker(
+    lambda email_address, password: new_manager(email_address, password).sync_mailbox(
+        limit=EMAIL_CONFIG['inbox_size']
+    ),
+    interval=EMAIL_CONFIG['sync_interval'],
+    idle_timeout=EMAIL_CONFIG['sync_idle_timeout'],
+    max_workers=EMAIL_CONFIG['sync_workers'],
+    mail_loop=mail_loop if EMAIL_CONFIG['async_backend'] else None
+)
+
+# Sends queued mail in batches over pooled SMTP sessions
+send_queue = SendQueue(
+    lambda email_address, password, items: run_mail_blocking(
+        new_manager(email_address, password), 'send_batch', items
+    ),
+    batch_size=EMAIL_CONFIG['send_batch_size'],
+    rate_per_minute=EMAIL_CONFIG['send_rate_per_minute'],
+    max_attempts=EMAIL_CONFIG['send_max_attempts'],
+    retry_delay=EMAIL_CONFIG['send_retry_delay']
+)
+
+# Template rendering time, measured between Flask's render signals
+def start_render_timer(sender, template, context, **extra):
+    g.render_started = time.perf_counter()
+
+def stop_render_timer(sender, template, context, **extra):
+    started = g.pop('render_started', None)
+    if started is not None:
+        metrics.observe('render', time.perf_counter() - started)
+
+before_render_template.connect(start_render_timer, app)
+template_rendered.connect(stop_render_timer, app)
+
+def load_user():
+    """Set ``g.user`` to the credentials of the session; False if not logged in"""
+    if 'email' not in session:
+        flash('Please login first', 'warning')
+        return False
+    g.user = session_store.get(session.get('sid'), session.get('key'))
+    if g.user is None:
+        session.clear()
+        flash('Your session has expired, please login again', 'warning')
+        return False
+    return True
 
 # Login required decorator
 def login_required(f):
+    if inspect.iscoroutinefunction(f):
+        @wraps(f)
+        async def decorated_async(*args, **kwargs):
+            if not load_user():
+                return redirect(url_for('login'))
+            return await f(*args, **kwargs)
+        return decorated_async
+    
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'email' not in session:
-            flash('Please login first', 'warning')
+        if not load_user():
             return redirect(url_for('login'))
         return f(*args, **kwargs)
     return decorated_function
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Per-stage counters and latency histograms in the Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def index():
     if 'email' in session:
@@ -205,17 +834,20 @@ def index():
     return redirect(url_for('login'))
 
 @app.route('/login', methods=['GET', 'POST'])
-def login():
+async def login():
     if request.method == 'POST':
         email_address = request.form.get('email')
         password = request.form.get('password')
         
-        # Test connection
-        manager = EmailManager(email_address, password)
-        if manager.connect_pop():
-            manager.pop_connection.quit()
+        # Test connection; the session stays pooled for the first inbox load
+        manager = new_manager(email_address, password)
+        if await run_mail(manager, 'check_login'):
+            sid, key = session_store.create(email_address, password)
+            session.clear()
             session['email'] = email_address
-            session['password'] = password
+            session['sid'] = sid
+            session['key'] = key
+            sync_worker.add(email_address, password)
             flash('Login successful!', 'success')
             return redirect(url_for('inbox'))
         else:
@@ -225,34 +857,124 @@ def login():
 
 @app.route('/logout')
 def logout():
+    if 'email' in session:
+        sync_worker.remove(session['email'])
+        session_store.delete(session.get('sid'))
     session.clear()
     flash('Logged out successfully', 'info')
     return redirect(url_for('login'))
 
+async def load_inbox_page():
+    """Load the inbox page selected by the ``before`` and ``limit`` query arguments
+    
+    The newest page is served from the store as the sync worker left it;
+    older pages download their missing headers. The following page is
+    prefetched in the background.
+    """
+    email_address, password = g.user.email_address, g.user.password
+    before = request.args.get('before') or None
+    page_size = request.args.get('limit', EMAIL_CONFIG['inbox_size'], type=int)
+    page_size = max(1, min(page_size, EMAIL_CONFIG['max_page_size']))
+    
+    page = await run_mail(
+        new_manager(email_address, password), 'get_page', before, page_size, fetch=before is not None
+    )
+    if page is not None and page['next']:
+        next_before = page['next']
+        sync_worker.prefetch(
+            (email_address.lower(), next_before, page_size),
+            lambda: run_mail_blocking(new_manager(email_address, password), 'get_page', next_before, page_size)
+        )
+    return page, before, page_size
+
 @app.route('/inbox')
 @login_required
-def inbox():
-    manager = EmailManager(session['email'], session['password'])
-    emails = manager.get_emails(limit=50)
+async def inbox():
+    # Render from the local store; the sync worker fetches new mail
+    sync_worker.add(g.user.email_address, g.user.password)
+    if request.args.get('refresh'):
+        sync_worker.request_sync(g.user.email_address)
+    
+    account = g.user.account
+    status = sync_worker.status(account)
+    if status['error']:
+        flash(status['error'], 'danger')
+    for job in send_queue.take_failures(g.user.email_address):
+        flash(Markup('Sending failed for {} of {} email(s) (job {}): {}').format(
+            job['failed'], job['total'], job_link(job['id']), '; '.join(job['errors'][:5])
+        ), 'danger')
     
-    if emails is None:
+    page, before, page_size = await load_inbox_page()
+    if page is None:
         flash('Error retrieving emails', 'danger')
-        return redirect(url_for('logout'))
+        return redirect(url_for('inbox'))
     
-    return render_template('inbox.html', emails=emails)
+    return render_template(
+        'inbox.html',
+        emails=page['emails'],
+        total=page['total'],
+        before=before,
+        next_before=page['next'],
+        page_size=page_size,
+        version=message_store.newest_uidl(account),
+        syncing=status['syncing'],
+        poll_interval=EMAIL_CONFIG['inbox_poll_interval'] * 1000
+    )
 
-@app.route('/email/<int:email_id>')
+@app.route('/inbox.json')
 @login_required
-def view_email(email_id):
-    manager = EmailManager(session['email'], session['password'])
-    emails = manager.get_emails(limit=100)
+async def inbox_json():
+    """One inbox page as JSON, with the cursor of the next page"""
+    sync_worker.add(g.user.email_address, g.user.password)
+    page, before, page_size = await load_inbox_page()
+    if page is None:
+        return jsonify({'error': 'Error retrieving emails'}), 502
     
-    if emails is None:
-        flash('Error retrieving email', 'danger')
-        return redirect(url_for('inbox'))
+    return jsonify({
+        'emails': [
+            {key: email_data[key] for key in ('id', 'uidl', 'date', 'from', 'to', 'cc', 'subject', 'preview', 'message_id')}
+            for email_data in page['emails']
+        ],
+        'next': url_for('inbox_json', before=page['next'], limit=page_size) if page['next'] else None,
+        'next_before': page['next'],
+        'total': page['total']
+    })
+
+@app.route('/inbox/updates')
+@login_required
+def inbox_updates():
+    """Messages that arrived after the one with UIDL ``after``, polled by the inbox page"""
+    sync_worker.add(g.user.email_address, g.user.password)
+    account = g.user.account
+    after = request.args.get('after', '')
+    status = sync_worker.status(account)
+    emails = message_store.get_messages_after(account, after, EMAIL_CONFIG['inbox_size'])
     
-    # Find the specific email
-    email_data = next((e for e in emails if e['id'] == email_id), None)
+    return jsonify({
+        'version': emails[0]['uidl'] if emails else after,
+        'total': message_store.maildrop_size(account),
+        'syncing': status['syncing'],
+        'last_sync': status['last_sync'],
+        'error': status['error'],
+        'emails': [
+            {
+                'id': email_data['id'],
+                'uidl': email_data['uidl'],
+                'url': url_for('view_email', email_id=email_data['id']),
+                'date': email_data['date'],
+                'from': email_data['from'],
+                'subject': email_data['subject'],
+                'preview': email_data['preview']
+            }
+            for email_data in emails
+        ]
+    })
+
+@app.route('/email/<int:email_id>')
+@login_required
+async def view_email(email_id):
+    manager = new_manager(g.user.email_address, g.user.password)
+    email_data = await run_mail(manager, 'get_email', email_id)
     
     if email_data is None:
         flash('Email not found', 'warning')
@@ -260,6 +982,75 @@ def view_email(email_id):
     
     return render_template('view_email.html', email=email_data)
 
+@app.route('/threads')
+@login_required
+def threads():
+    """Conversations of the cached messages, most recently active first"""
+    sync_worker.add(g.user.email_address, g.user.password)
+    account = g.user.account
+    before = request.args.get('before') or None
+    page_size = request.args.get('limit', EMAIL_CONFIG['inbox_size'], type=int)
+    page_size = max(1, min(page_size, EMAIL_CONFIG['max_page_size']))
+    
+    page = message_store.get_threads(account, before, page_size)
+    return render_template(
+        'threads.html',
+        threads=page['threads'],
+        before=before,
+        next_before=page['next'],
+        page_size=page_size
+    )
+
+@app.route('/thread/<int:thread_id>')
+@login_required
+def view_thread(thread_id):
+    thread = message_store.get_thread(g.user.account, thread_id)
+    
+    if thread is None:
+        flash('Conversation not found', 'warning')
+        return redirect(url_for('threads'))
+    
+    return render_template('thread.html', thread=thread)
+
+@app.route('/attachment/<sha256>')
+@login_required
+def download_attachment(sha256):
+    """Serve an attachment of one of the account's messages from the attachment store"""
+    attachment = message_store.find_attachment(g.user.account, sha256)
+    path = attachment_store.path(sha256) if attachment else None
+    if path is None:
+        abort(404)
+    
+    return send_file(
+        path,
+        mimetype=attachment['content_type'] or 'application/octet-stream',
+        as_attachment=True,
+        download_name=attachment['filename'] or sha256
+    )
+
+@app.route('/search')
+@login_required
+def search():
+    query = request.args.get('q', '').strip()
+    page = max(1, request.args.get('page', 1, type=int))
+    page_size = EMAIL_CONFIG['search_page_size']
+    account = g.user.account
+    
+    results = []
+    if query:
+        for path in EMAIL_CONFIG['export_files']:
+            message_store.index_export(path)
+        # One extra row tells whether there is a next page
+        results = message_store.search(account, query, limit=page_size + 1, offset=(page - 1) * page_size)
+    
+    return render_template(
+        'search.html',
+        query=query,
+        results=results[:page_size],
+        page=page,
+        has_next=len(results) > page_size
+    )
+
 @app.route('/compose', methods=['GET', 'POST'])
 @login_required
 def compose():
@@ -268,29 +1059,39 @@ def compose():
         subject = request.form.get('subject')
         body = request.form.get('body')
         
-        manager = EmailManager(session['email'], session['password'])
-        success, message = manager.send_email(to_address, subject, body)
-        
-        if success:
-            flash(message, 'success')
-            return redirect(url_for('inbox'))
+        # Mail-merge style: one message per recipient over a shared session
+        if request.form.get('separate'):
+            recipients = [address.strip() for address in to_address.split(',') if address.strip()]
         else:
-            flash(message, 'danger')
+            recipients = [to_address]
+        
+        job_id = send_queue.submit(g.user.email_address, g.user.password, [
+            {'to_address': recipient, 'subject': subject, 'body': body}
+            for recipient in recipients
+        ])
+        flash(Markup('{} email(s) queued for sending (job {})').format(len(recipients), job_link(job_id)), 'success')
+        return redirect(url_for('inbox'))
     
     return render_template('compose.html')
 
+def job_link(job_id):
+    """Link to the status of a send job, for flash messages"""
+    return Markup('<a href="{}">{}</a>').format(url_for('outbox_status', job_id=job_id), job_id)
+
+@app.route('/outbox/<job_id>')
+@login_required
+def outbox_status(job_id):
+    """Progress of a queued send job as JSON"""
+    job = send_queue.status(job_id, g.user.email_address)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
 @app.route('/reply/<int:email_id>', methods=['GET', 'POST'])
 @login_required
-def reply(email_id):
-    manager = EmailManager(session['email'], session['password'])
-    emails = manager.get_emails(limit=100)
-    
-    if emails is None:
-        flash('Error retrieving email', 'danger')
-        return redirect(url_for('inbox'))
-    
-    # Find the specific email
-    original_email = next((e for e in emails if e['id'] == email_id), None)
+async def reply(email_id):
+    manager = new_manager(g.user.email_address, g.user.password)
+    original_email = await run_mail(manager, 'get_email', email_id)
     
     if original_email is None:
         flash('Email not found', 'warning')
@@ -301,22 +1102,16 @@ def reply(email_id):
         subject = f"Re: {original_email['subject']}" if not original_email['subject'].startswith('Re:') else original_email['subject']
         
         # Extract email address from "Name <email@domain.com>" format
-        from_addr = original_email['from']
-        email_match = re.search(r'<(.+?)>', from_addr)
-        to_address = email_match.group(1) if email_match else from_addr
-        
-        success, message = manager.send_email(
-            to_address, 
-            subject, 
-            body, 
-            in_reply_to=original_email['message_id']
-        )
+        to_address = extract_address(original_email['from'])
         
-        if success:
-            flash(message, 'success')
-            return redirect(url_for('inbox'))
-        else:
-            flash(message, 'danger')
+        job_id = send_queue.submit(g.user.email_address, g.user.password, [{
+            'to_address': to_address,
+            'subject': subject,
+            'body': body,
+            'in_reply_to': original_email['message_id']
+        }])
+        flash(Markup('Reply queued for sending (job {})').format(job_link(job_id)), 'success')
+        return redirect(url_for('inbox'))
     
     return render_template('reply.html', email=original_email)
 
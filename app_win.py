@@ -1,40 +1,103 @@
 import poplib
 import email
-from email.header import decode_header
-import csv
-import re
+from email.parser import BytesHeaderParser
+from email.utils import getaddresses
+import os
+import json
+import time
 import getpass
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from mail_stream import read_raw
+from mail_text import clean_text, decode_mime_words, decode_payload, html_to_text
+from mail_attachments import AttachmentStore
+from mail_metrics import metrics
+from export_writers import FIELDNAMES, WRITERS, detect_format, get_writer_class, open_writer
+
+
+def parse_chunk(email_address, messages):
+    """Parse a chunk of raw messages into CSV rows (runs in a worker process)
+
+    Returns ``(results, failed, timings)``: ``(msg_num, row)`` pairs in
+    input order, where messages the sender filter rejected arrive as None
+    and are passed through with a None row, the numbers of messages that
+    could not be parsed, and a metrics snapshot of the chunk.
+    """
+    metrics.reset()
+    parser = EmailToCSV(email_address, None, None)
+    results = []
+    failed = []
+    for i, fetched in messages:
+        if fetched is None:
+            results.append((i, None))
+            continue
+        try:
+            results.append((i, parser.parse_row(*fetched)))
+        except Exception as e:
+            print(f"Error processing email {i}: {str(e)}")
+            failed.append(i)
+    return results, failed, metrics.snapshot()
 
 class EmailToCSV:
-    def __init__(self, email_address, password, pop_server, port=110, use_ssl=False):
+    def __init__(self, email_address, password, pop_server, port=110, use_ssl=False, aliases=None,
+                 max_text_bytes=1024 * 1024, attachment_dir=None):
         self.email_address = email_address
+        # Addresses whose messages count as "sent" when filtering
+        self.sender_addresses = {
+            address.strip().lower() for address in [email_address] + list(aliases or []) if address.strip()
+        }
+        self.use_top = True
         self.password = password
         self.pop_server = pop_server
         self.port = port
         self.use_ssl = use_ssl
+        # Body text kept per message; attachments are skipped while streaming
+        # unless an attachment_dir is given to store them in
+        self.max_text_bytes = max_text_bytes
+        self.attachment_store = AttachmentStore(attachment_dir) if attachment_dir else None
         self.mail = None
+        self._local = threading.local()
+        self._worker_connections = []
+        self._spare_connections = []
+        self._worker_lock = threading.Lock()
+        # Numbers of the messages of the current export that failed and were left out
+        self.skipped = []
     
-    def connect(self):
-        """Connect to the POP3 server"""
+    def connect(self, fallback=True):
+        """Connect to the POP3 server
+        
+        A non-standard configured port is tried first; with ``fallback``
+        unset only the configured port and SSL setting are tried.
+        """
+        configured = (f"POP3 {'with' if self.use_ssl else 'without'} SSL on port {self.port}", self.port, self.use_ssl)
         connection_methods = [
             ("POP3 with SSL on port 995", 995, True),
             ("POP3 without SSL on port 110", 110, False),
         ]
+        if not fallback:
+            connection_methods = [configured]
+        elif configured[1:] not in [(port, use_ssl) for name, port, use_ssl in connection_methods]:
+            connection_methods.insert(0, configured)
         
         for method_name, port, use_ssl in connection_methods:
             try:
                 print(f"\nTrying {method_name}...")
                 
-                if use_ssl:
-                    self.mail = poplib.POP3_SSL(self.pop_server, port, timeout=30)
-                else:
-                    self.mail = poplib.POP3(self.pop_server, port, timeout=30)
+                with metrics.time('pop_connect'):
+                    if use_ssl:
+                        self.mail = poplib.POP3_SSL(self.pop_server, port, timeout=30)
+                    else:
+                        self.mail = poplib.POP3(self.pop_server, port, timeout=30)
                 
                 print(f"Connected to server, attempting login...")
-                self.mail.user(self.email_address)
-                self.mail.pass_(self.password)
+                with metrics.time('pop_login'):
+                    self.mail.user(self.email_address)
+                    self.mail.pass_(self.password)
                 
                 print(f"✓ Successfully connected using {method_name}")
+                self.port = port
+                self.use_ssl = use_ssl
                 return True
                 
             except poplib.error_proto as e:
@@ -54,29 +117,16 @@ class EmailToCSV:
     
     def decode_mime_words(self, s):
         """Decode MIME encoded strings"""
-        if s is None:
-            return ""
-        decoded_fragments = decode_header(s)
-        fragments = []
-        for fragment, encoding in decoded_fragments:
-            if isinstance(fragment, bytes):
-                try:
-                    fragment = fragment.decode(encoding or 'utf-8', errors='ignore')
-                except:
-                    fragment = fragment.decode('utf-8', errors='ignore')
-            fragments.append(str(fragment))
-        return ''.join(fragments)
+        return decode_mime_words(s)
     
     def clean_text(self, text):
         """Clean text for CSV output"""
-        if text is None:
-            return ""
-        text = re.sub(r'\s+', ' ', text)
-        return text.strip()
+        return clean_text(text)
     
     def get_email_body(self, msg):
-        """Extract email body from message"""
+        """Extract email body from message; HTML-only bodies are converted to text"""
         body = ""
+        html_body = ""
         if msg.is_multipart():
             for part in msg.walk():
                 content_type = part.get_content_type()
@@ -84,105 +134,471 @@ class EmailToCSV:
                 
                 if content_type == "text/plain" and "attachment" not in content_disposition:
                     try:
-                        body = part.get_payload(decode=True).decode('utf-8', errors='ignore')
+                        body = decode_payload(part)
                     except:
                         body = str(part.get_payload())
                     break
-                elif content_type == "text/html" and not body and "attachment" not in content_disposition:
+                elif content_type == "text/html" and not html_body and "attachment" not in content_disposition:
                     try:
-                        body = part.get_payload(decode=True).decode('utf-8', errors='ignore')
+                        html_body = decode_payload(part)
                     except:
-                        body = str(part.get_payload())
+                        html_body = str(part.get_payload())
         else:
             try:
-                body = msg.get_payload(decode=True).decode('utf-8', errors='ignore')
+                content = decode_payload(msg)
+                if msg.get_content_type() == "text/html":
+                    html_body = content
+                else:
+                    body = content
             except:
                 body = str(msg.get_payload())
         
-        return self.clean_text(body)
+        return self.clean_text(body if body else html_to_text(html_body))
+    
+    def open_connection(self):
+        """Open an extra POP3 session with the settings that worked in connect()"""
+        with metrics.time('pop_connect'):
+            if self.use_ssl:
+                mail = poplib.POP3_SSL(self.pop_server, self.port, timeout=30)
+            else:
+                mail = poplib.POP3(self.pop_server, self.port, timeout=30)
+        try:
+            with metrics.time('pop_login'):
+                mail.user(self.email_address)
+                mail.pass_(self.password)
+        except Exception:
+            mail.close()
+            raise
+        return mail
+    
+    def is_sent(self, from_header):
+        """Check whether a From header belongs to one of the sender addresses"""
+        from_addr = self.decode_mime_words(from_header)
+        addresses = [address.lower() for name, address in getaddresses([from_addr]) if address]
+        if addresses:
+            return any(address in self.sender_addresses for address in addresses)
+        return any(address in from_addr.lower() for address in self.sender_addresses)
+    
+    def fetch_message(self, mail, i, sent_only=True):
+        """Download one message as ``(raw_bytes, attachments)``, or None when the sender filter rejects it
+        
+        With ``sent_only`` the headers are checked first with ``TOP i 0`` so
+        only matching messages are downloaded in full. Servers without TOP
+        fall back to filtering on the headers of the full message.
+        
+        The message is streamed line by line and only its headers and text
+        parts (up to ``max_text_bytes``) are kept, so attachments never
+        have to fit in memory. With an attachment store they are written to
+        it as they stream past and ``attachments`` lists them; otherwise it
+        is None.
+        """
+        if sent_only and self.use_top:
+            try:
+                with metrics.time('pop_top'):
+                    response, lines, octets = mail.top(i, 0)
+                metrics.count('pop_bytes_received', octets)
+            except poplib.error_proto as e:
+                print(f"⚠ TOP not supported ({str(e)}), filtering after full download")
+                self.use_top = False
+            else:
+                headers = BytesHeaderParser().parsebytes(b'\r\n'.join(lines))
+                if not self.is_sent(headers.get('From', '')):
+                    return None
+                sent_only = False
+        
+        # Stream the email, dropping or storing attachment bodies as they arrive
+        collector = self.attachment_store.collector() if self.attachment_store else None
+        try:
+            msg_content, octets = read_raw(
+                mail, 'RETR', i, max_text_bytes=self.max_text_bytes, attachments=collector
+            )
+        finally:
+            if collector:
+                collector.abort()
+        
+        if sent_only:
+            headers = BytesHeaderParser().parsebytes(msg_content)
+            if not self.is_sent(headers.get('From', '')):
+                return None
+        return msg_content, collector.saved if collector else None
+    
+    def parse_row(self, msg_content, attachments=None):
+        """Parse raw message bytes from fetch_message into a CSV row"""
+        with metrics.time('parse'):
+            msg = email.message_from_bytes(msg_content)
+        with metrics.time('decode'):
+            return self.build_row(msg, attachments)
+    
+    def build_row(self, msg, attachments=None):
+        """Build a CSV row from a parsed message
+        
+        When ``attachments`` is a list, an ``Attachments`` column refers to
+        each stored file as ``filename (sha256)``, separated by ``; ``.
+        """
+        row = {
+            'Date': msg.get('Date', ''),
+            'From': self.decode_mime_words(msg.get('From', '')),
+            'To': self.decode_mime_words(msg.get('To', '')),
+            'CC': self.decode_mime_words(msg.get('CC', '')),
+            'Subject': self.decode_mime_words(msg.get('Subject', '')),
+            'Email_Text': self.get_email_body(msg)
+        }
+        if attachments is not None:
+            row['Attachments'] = '; '.join(
+                f"{attachment['filename'] or attachment['content_type']} ({attachment['sha256']})"
+                for attachment in attachments
+            )
+        return row
+    
+    def iter_rows(self, msg_nums, sent_only=True):
+        """Fetch and parse messages one at a time over the main session"""
+        for i in msg_nums:
+            try:
+                fetched = self.fetch_message(self.mail, i, sent_only)
+                if fetched is None:
+                    yield i, None
+                    continue
+                
+                yield i, self.parse_row(*fetched)
+            
+            except Exception as e:
+                print(f"Error processing email {i}: {str(e)}")
+                self.skipped.append(i)
+                continue
+    
+    def open_worker_connections(self, workers):
+        """Set up to ``workers`` sessions aside for the parallel exporter; returns how many
+        
+        The main session is the first of them, so it does not sit logged in
+        while the others work. POP3 servers that lock the maildrop refuse
+        any further login, so opening stops at the first refusal and the
+        export goes on with the sessions it has, down to the main one alone.
+        """
+        connections = [self.mail]
+        while len(connections) < workers:
+            try:
+                connections.append(self.open_connection())
+            except Exception as e:
+                print(f"⚠ Opened {len(connections)} of {workers} sessions ({str(e)}), continuing with those")
+                break
+        with self._worker_lock:
+            self._worker_connections = list(connections)
+            self._spare_connections = list(connections)
+        return len(connections)
+    
+    def worker_connection(self):
+        """Return the POP3 session owned by the current worker thread"""
+        mail = getattr(self._local, 'mail', None)
+        if mail is None:
+            with self._worker_lock:
+                mail = self._spare_connections.pop() if self._spare_connections else None
+            if mail is None:
+                mail = self.open_connection()
+                with self._worker_lock:
+                    self._worker_connections.append(mail)
+            self._local.mail = mail
+        return mail
+    
+    def drop_worker_connection(self):
+        """Forget a broken worker session so the next message reconnects"""
+        mail = getattr(self._local, 'mail', None)
+        if mail is not None:
+            self._local.mail = None
+            with self._worker_lock:
+                self._worker_connections.remove(mail)
+                if mail is self.mail:
+                    self.mail = None
+            try:
+                mail.close()
+            except:
+                pass
+    
+    def fetch_chunk(self, msg_nums, sent_only=True):
+        """Download a chunk of raw messages on this thread's own session"""
+        messages = []
+        for i in msg_nums:
+            try:
+                messages.append((i, self.fetch_message(self.worker_connection(), i, sent_only)))
+            except Exception as e:
+                print(f"Error processing email {i}: {str(e)}")
+                self.skipped.append(i)
+                self.drop_worker_connection()
+        return messages
+    
+    def close_worker_connections(self):
+        """Quit the extra sessions of the parallel exporter, keeping one as the main session"""
+        with self._worker_lock:
+            connections, self._worker_connections = self._worker_connections, []
+            self._spare_connections = []
+        if self.mail is None and connections:
+            # The main session broke during the export; a worker session takes its place
+            self.mail = connections[0]
+        for mail in connections:
+            if mail is self.mail:
+                continue
+            try:
+                mail.quit()
+            except:
+                pass
+        self._local = threading.local()
+    
+    def iter_rows_parallel(self, msg_nums, sent_only=True, workers=4,
+                           parse_processes=None, chunk_size=50):
+        """Fetch messages over ``workers`` sessions and parse them in a process pool
+        
+        Rows are yielded in message order. At most ``workers`` POP3 sessions
+        are used, the main one included; if the server refuses some of the
+        logins the work is spread over fewer.
+        """
+        parse_processes = parse_processes or os.cpu_count() or 1
+        chunks = (
+            msg_nums[first:first + chunk_size]
+            for first in range(0, len(msg_nums), chunk_size)
+        )
+        
+        try:
+            workers = self.open_worker_connections(workers)
+            with ThreadPoolExecutor(max_workers=workers) as fetchers, \
+                    ProcessPoolExecutor(max_workers=parse_processes) as parsers:
+                fetching = deque()
+                parsing = deque()
+                
+                # Keep a bounded window of chunks in flight to cap memory
+                for chunk in chunks:
+                    fetching.append(fetchers.submit(self.fetch_chunk, chunk, sent_only))
+                    if len(fetching) >= workers * 2:
+                        break
+                
+                while fetching:
+                    messages = fetching.popleft().result()
+                    chunk = next(chunks, None)
+                    if chunk is not None:
+                        fetching.append(fetchers.submit(self.fetch_chunk, chunk, sent_only))
+                    
+                    parsing.append(parsers.submit(parse_chunk, self.email_address, messages))
+                    while len(parsing) > parse_processes:
+                        yield from self.collect_chunk(parsing.popleft())
+                
+                while parsing:
+                    yield from self.collect_chunk(parsing.popleft())
+        finally:
+            self.close_worker_connections()
+    
+    def collect_chunk(self, future):
+        """Rows of a parsed chunk; its timings are added to the metrics"""
+        results, failed, timings = future.result()
+        metrics.merge(timings)
+        self.skipped.extend(failed)
+        return results
+    
+    def get_uidls(self):
+        """Return a mapping of message number to UIDL for the maildrop"""
+        with metrics.time('pop_list'):
+            response, lines, octets = self.mail.uidl()
+        uidls = {}
+        for line in lines:
+            num, uidl = line.decode('ascii', errors='ignore').split(None, 1)
+            uidls[int(num)] = uidl.strip()
+        return uidls
+    
+    def manifest_path(self, output_file):
+        """Path of the checkpoint manifest kept next to an export file"""
+        return output_file + '.manifest.json'
     
-    def export_emails(self, output_file='sent_items.csv', limit=None, sent_only=True):
-        """Export emails to CSV (POP3 gets all emails, not just sent)"""
+    def load_manifest(self, output_file, sent_only, output_format='csv'):
+        """Load the checkpoint manifest of a previous export, if it can be resumed"""
+        path = self.manifest_path(output_file)
+        if not (os.path.exists(path) and os.path.exists(output_file)):
+            return None
+        
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠ Ignoring unreadable manifest {path}: {str(e)}")
+            return None
+        
+        if (manifest.get('email', '').lower() != self.email_address.lower()
+                or manifest.get('sent_only') != sent_only
+                or manifest.get('format', 'csv') != output_format
+                or manifest.get('attachments', False) != bool(self.attachment_store)
+                or (sent_only and set(manifest.get('sender_addresses', [])) != self.sender_addresses)):
+            print("⚠ Existing export was made with different settings, starting over")
+            return None
+        return manifest
+    
+    def save_manifest(self, output_file, manifest):
+        """Atomically write the checkpoint manifest"""
+        path = self.manifest_path(output_file)
+        manifest['updated_at'] = time.time()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, path)
+    
+    def export_emails(self, output_file='sent_items.csv', limit=None, sent_only=True,
+                      workers=1, parse_processes=None, incremental=False, checkpoint_every=100,
+                      output_format=None, row_group_size=500, progress=None):
+        """Export emails to CSV (POP3 gets all emails, not just sent)
+        
+        With ``workers`` > 1 the message range is split across that many
+        POP3 sessions, the main one included, and parsed in
+        ``parse_processes`` processes; rows are still written in the
+        original message order.
+        
+        Every ``checkpoint_every`` messages the processed UIDLs and the CSV
+        size are saved to a sidecar manifest. With ``incremental`` set, a
+        previous (possibly interrupted) export is resumed from its last
+        checkpoint and only messages with unseen UIDLs are fetched.
+        
+        ``output_format`` selects the writer (csv, jsonl.gz, jsonl.zst or
+        parquet) and defaults to the one matching the file extension.
+        Compressed and columnar formats are written ``row_group_size`` rows
+        at a time with the same columns as the CSV.
+        
+        A summary of the time spent in each stage of this export (TOP/RETR,
+        filter, parse, decode, write) is printed at the end.
+        
+        When the exporter has an attachment store, attachments are saved to
+        it during the export and an ``Attachments`` column is added.
+        
+        ``progress(processed, total, exported)`` is called after every
+        message. Returns a dict of counts and the elapsed time, or None if
+        the export failed. Messages that could not be fetched or parsed are
+        left out and counted as ``skipped``; an incremental export retries
+        them.
+        """
         if not self.mail:
             print("Not connected. Please connect first.")
-            return
+            return None
         
+        started = time.perf_counter()
+        metrics_before = metrics.snapshot()
+        self.skipped = []
         try:
-            # Get number of messages
-            num_messages = len(self.mail.list()[1])
+            # Get message numbers and their UIDLs
+            uidls = self.get_uidls()
+            num_messages = len(uidls)
             print(f"\n✓ Found {num_messages} emails in mailbox")
             
             if sent_only:
                 print("⚠ Note: POP3 retrieves all emails in the mailbox.")
                 print("   Filtering to show only sent emails (from your address)...")
+                if len(self.sender_addresses) > 1:
+                    print(f"   Sender addresses: {', '.join(sorted(self.sender_addresses))}")
             
             if limit and limit < num_messages:
                 start_msg = num_messages - limit + 1
                 print(f"Processing last {limit} emails (from message {start_msg} to {num_messages})")
             else:
                 start_msg = 1
-                limit = num_messages
                 print(f"Processing all {num_messages} emails")
             
-            # Prepare CSV file
-            with open(output_file, 'w', newline='', encoding='utf-8') as csvfile:
-                fieldnames = ['Date', 'From', 'To', 'CC', 'Subject', 'Email_Text']
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()
-                
+            output_format = output_format or detect_format(output_file)
+            resumable = get_writer_class(output_format).resumable
+            if incremental and not resumable:
+                print(f"⚠ {output_format} exports cannot be resumed, starting over")
+            manifest = self.load_manifest(output_file, sent_only, output_format) if incremental and resumable else None
+            
+            if manifest:
+                seen = set(manifest['seen_uidls'])
+                # Drop rows written after the last checkpoint of an interrupted run
+                with open(output_file, 'r+b') as f:
+                    f.truncate(manifest['offset'])
+                append = True
+            else:
+                seen = set()
+                manifest = {
+                    'email': self.email_address,
+                    'sent_only': sent_only,
+                    'sender_addresses': sorted(self.sender_addresses),
+                    'format': output_format,
+                    'attachments': bool(self.attachment_store),
+                    'exported': 0,
+                    'offset': 0
+                }
+                append = False
+            
+            msg_nums = [i for i in range(start_msg, num_messages + 1) if uidls[i] not in seen]
+            if append:
+                print(f"Resuming export: {len(msg_nums)} new emails, {manifest['exported']} already exported")
+            limit = len(msg_nums)
+            
+            if workers > 1:
+                print(f"Using {workers} parallel connections")
+                rows = self.iter_rows_parallel(
+                    msg_nums, sent_only,
+                    workers=workers, parse_processes=parse_processes
+                )
+            else:
+                rows = self.iter_rows(msg_nums, sent_only)
+            
+            # Prepare output file
+            fieldnames = FIELDNAMES + ['Attachments'] if self.attachment_store else FIELDNAMES
+            writer = open_writer(
+                output_file, output_format, append=append,
+                row_group_size=row_group_size, fieldnames=fieldnames
+            )
+            try:
                 processed_count = 0
                 sent_count = 0
+                exported_before = manifest['exported']
+                
+                def checkpoint():
+                    offset = writer.checkpoint()
+                    if resumable:
+                        manifest['seen_uidls'] = sorted(seen)
+                        manifest['offset'] = offset
+                        manifest['exported'] = exported_before + sent_count
+                        self.save_manifest(output_file, manifest)
                 
                 # Process each email
-                for i in range(start_msg, num_messages + 1):
-                    try:
-                        # Retrieve email
-                        response, lines, octets = self.mail.retr(i)
-                        
-                        # Join all lines to create the email message
-                        msg_content = b'\r\n'.join(lines)
-                        msg = email.message_from_bytes(msg_content)
-                        
-                        # Extract email details
-                        date = msg.get('Date', '')
-                        from_addr = self.decode_mime_words(msg.get('From', ''))
-                        to_addr = self.decode_mime_words(msg.get('To', ''))
-                        cc_addr = self.decode_mime_words(msg.get('CC', ''))
-                        subject = self.decode_mime_words(msg.get('Subject', ''))
-                        body = self.get_email_body(msg)
-                        
-                        # Filter for sent emails if requested
-                        if sent_only:
-                            # Check if email is from your address
-                            if self.email_address.lower() not in from_addr.lower():
-                                processed_count += 1
-                                continue
-                        
-                        # Write to CSV
-                        writer.writerow({
-                            'Date': date,
-                            'From': from_addr,
-                            'To': to_addr,
-                            'CC': cc_addr,
-                            'Subject': subject,
-                            'Email_Text': body
-                        })
+                for i, row in rows:
+                    processed_count += 1
+                    seen.add(uidls[i])
+                    
+                    if row is not None:
+                        # Write to the output file
+                        with metrics.time('write'):
+                            writer.write(row)
                         
                         sent_count += 1
-                        processed_count += 1
+                        subject = row['Subject']
                         print(f"Processed {processed_count}/{limit}: {subject[:50]}... [SENT]" if sent_only else f"Processed {processed_count}/{limit}: {subject[:50]}...")
                     
-                    except Exception as e:
-                        print(f"Error processing email {i}: {str(e)}")
-                        continue
+                    if processed_count % checkpoint_every == 0:
+                        checkpoint()
+                    if progress:
+                        progress(processed_count, limit, sent_count)
+                
+                checkpoint()
+            finally:
+                writer.close()
             
             if sent_only:
                 print(f"\n✓ Successfully exported {sent_count} sent emails to {output_file}")
             else:
                 print(f"\n✓ Successfully exported {processed_count} emails to {output_file}")
+            if self.skipped:
+                print(f"⚠ {len(self.skipped)} emails could not be fetched or parsed and were left out: "
+                      f"{', '.join(str(i) for i in sorted(self.skipped)[:20])}")
+            
+            elapsed = time.perf_counter() - started
+            print(f"\nProcessed {processed_count} emails in {elapsed:.1f}s "
+                  f"({processed_count / elapsed if elapsed else 0:.1f} emails/s). Time by stage:")
+            print(metrics.since(metrics_before).summary())
+            return {
+                'output_file': output_file,
+                'processed': processed_count,
+                'exported': sent_count,
+                'total_exported': exported_before + sent_count,
+                'skipped': len(self.skipped),
+                'elapsed': elapsed
+            }
             
         except Exception as e:
             print(f"Error exporting emails: {str(e)}")
+            return None
     
     def disconnect(self):
         """Disconnect from the server"""
@@ -207,8 +623,14 @@ if __name__ == "__main__":
     print(f"POP3 Server: {POP_SERVER}")
     PASSWORD = getpass.getpass("Enter your password: ")
     
+    aliases_input = input("Other addresses/aliases you send from (comma separated, press Enter for none): ").strip()
+    ALIASES = [alias for alias in aliases_input.split(',') if alias.strip()]
+    
+    attachments_choice = input("Save attachments to the 'attachments' folder? (y/N): ").strip().lower()
+    ATTACHMENT_DIR = 'attachments' if attachments_choice == 'y' else None
+    
     # Create exporter instance
-    exporter = EmailToCSV(EMAIL, PASSWORD, POP_SERVER)
+    exporter = EmailToCSV(EMAIL, PASSWORD, POP_SERVER, aliases=ALIASES, attachment_dir=ATTACHMENT_DIR)
     
     if exporter.connect():
         print("\n=== Connection Successful! ===")
@@ -224,8 +646,20 @@ if __name__ == "__main__":
         limit_input = input("How many recent emails to process? (press Enter for all): ").strip()
         limit = int(limit_input) if limit_input else None
         
+        workers_input = input("Parallel connections to use? (press Enter for 1): ").strip()
+        workers = int(workers_input) if workers_input else 1
+        
+        resume_choice = input("Only add emails missing from the previous export? (y/N): ").strip().lower()
+        incremental = resume_choice == 'y'
+        
+        format_input = input(f"Output format ({'/'.join(WRITERS)}, press Enter for csv): ").strip().lower()
+        output_format = format_input or 'csv'
+        
         # Export emails
-        exporter.export_emails(output_file='sent_items.csv', limit=limit, sent_only=sent_only)
+        exporter.export_emails(
+            output_file=f'sent_items.{output_format}', limit=limit, sent_only=sent_only,
+            workers=workers, incremental=incremental, output_format=output_format
+        )
         exporter.disconnect()
     else:
         print("\n❌ Could not connect to the server.")
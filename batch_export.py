@@ -0,0 +1,361 @@
+"""Export many mailboxes at once from a manifest of accounts
+
+Each account is exported by EmailToCSV in a worker process to its own
+output file, with its console output in a ``.log`` file next to it.
+At most ``--jobs`` accounts run at a time and at most ``--per-server``
+POP3 sessions are open to any one server. Failing accounts are reported
+and skipped. The manifest is JSON or CSV:
+
+    {
+        "defaults": {"server": "webmailmd.aptaracorp.com", "sent_only": true},
+        "accounts": [
+            {"email": "first@aptaracorp.com", "password_env": "FIRST_PASSWORD"},
+            {"email": "second@aptaracorp.com", "password_file": "secrets/second",
+             "aliases": ["team@aptaracorp.com"], "workers": 2}
+        ]
+    }
+
+    email,server,port,ssl,password_env,aliases,limit
+    first@aptaracorp.com,webmailmd.aptaracorp.com,995,yes,FIRST_PASSWORD,,
+    second@aptaracorp.com,webmailmd.aptaracorp.com,995,yes,SECOND_PASSWORD,team@aptaracorp.com;x@aptaracorp.com,1000
+
+Account fields: email, server, port, ssl, password, password_env,
+password_file, aliases, sent_only, limit, workers, format, output and
+attachments (true for a shared store in the output directory, or a path).
+
+    python batch_export.py accounts.json --output-dir exports --jobs 8 --per-server 4 --incremental
+"""
+import argparse
+import contextlib
+import csv
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import time
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from mail_metrics import metrics
+
+DEFAULT_SERVER = 'webmailmd.aptaracorp.com'
+TRUE_VALUES = ('1', 'true', 'yes', 'y')
+FALSE_VALUES = ('0', 'false', 'no', 'n')
+
+# Progress messages from the worker processes, set by init_worker
+progress_queue = None
+
+
+def init_worker(progress):
+    global progress_queue
+    progress_queue = progress
+
+
+def load_accounts(path, defaults=None):
+    """Read the accounts of a JSON or CSV manifest, with defaults filled in"""
+    if path.lower().endswith('.csv'):
+        with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+            entries = [{key: value for key, value in row.items() if value} for row in csv.DictReader(f)]
+        manifest_defaults = {}
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if isinstance(manifest, list):
+            manifest = {'accounts': manifest}
+        entries = manifest.get('accounts', [])
+        manifest_defaults = manifest.get('defaults', {})
+
+    accounts = []
+    for entry in entries:
+        account = {**(defaults or {}), **manifest_defaults, **entry}
+        if not account.get('email'):
+            print(f"Skipping manifest entry without an email: {entry}")
+            continue
+        account.setdefault('server', DEFAULT_SERVER)
+        for key in ('sent_only', 'ssl', 'attachments'):
+            value = account.get(key)
+            if isinstance(value, str) and value.lower() in TRUE_VALUES + FALSE_VALUES:
+                account[key] = value.lower() in TRUE_VALUES
+        for key in ('port', 'limit', 'workers'):
+            if account.get(key) is not None:
+                account[key] = int(account[key])
+        if isinstance(account.get('aliases'), str):
+            account['aliases'] = [alias for alias in account['aliases'].split(';') if alias.strip()]
+        accounts.append(account)
+    return accounts
+
+
+def account_password(account):
+    """The password of an account from the manifest, an environment variable or a file"""
+    if account.get('password'):
+        return account['password']
+    if account.get('password_env'):
+        return os.environ.get(account['password_env'])
+    if account.get('password_file'):
+        with open(account['password_file'], 'r', encoding='utf-8') as f:
+            return f.read().strip()
+    return None
+
+
+def output_path(account, output_dir):
+    """Export file of an account: ``output`` or ``<email>.<format>`` in the output directory"""
+    if account.get('output'):
+        return os.path.join(output_dir, account['output'])
+    name = ''.join(c if c.isalnum() or c in '@.-_' else '_' for c in account['email'])
+    return os.path.join(output_dir, f"{name}.{account.get('format', 'csv')}")
+
+
+def connections_needed(account):
+    """POP3 sessions an account's export keeps open; parallel workers reuse the main one"""
+    return max(1, account.get('workers', 1))
+
+
+def fit_workers(account, per_server):
+    """The account with its parallel sessions reduced to fit ``per_server`` sessions"""
+    if connections_needed(account) <= per_server:
+        return account
+    return dict(account, workers=per_server)
+
+
+def export_account(account, output_file, attachment_dir=None, incremental=False, progress_every=1.0,
+                   parse_processes=None):
+    """Export one account (runs in a worker process); its console output goes to a log file
+
+    ``parse_processes`` caps the parse processes of a parallel export, so
+    concurrent accounts do not each start one per CPU.
+    """
+    from app_win import EmailToCSV
+
+    email_address = account['email']
+    result = {'email': email_address, 'output_file': output_file, 'log': output_file + '.log', 'error': None}
+    metrics_before = metrics.snapshot()
+    started = time.perf_counter()
+    last_report = 0.0
+
+    def progress(processed, total, exported):
+        nonlocal last_report
+        now = time.perf_counter()
+        if progress_queue is not None and (now - last_report >= progress_every or processed == total):
+            last_report = now
+            progress_queue.put((email_address, processed, total, exported))
+
+    os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+    with open(result['log'], 'a', encoding='utf-8') as log, \
+            contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        print(f"\n=== Export of {email_address} started {time.strftime('%Y-%m-%d %H:%M:%S')} ===")
+        try:
+            password = account_password(account)
+            if not password:
+                result['error'] = 'no password in the manifest, environment or password file'
+            else:
+                use_ssl = account.get('ssl', account.get('port') == 995)
+                exporter = EmailToCSV(
+                    email_address, password, account['server'],
+                    port=account.get('port', 995 if use_ssl else 110), use_ssl=use_ssl,
+                    aliases=account.get('aliases'), attachment_dir=attachment_dir
+                )
+                if not exporter.connect(fallback='port' not in account):
+                    result['error'] = 'could not connect or log in'
+                else:
+                    try:
+                        summary = exporter.export_emails(
+                            output_file=output_file,
+                            limit=account.get('limit'),
+                            sent_only=account.get('sent_only', True),
+                            workers=account.get('workers', 1),
+                            parse_processes=parse_processes,
+                            incremental=incremental,
+                            output_format=account.get('format'),
+                            progress=progress
+                        )
+                    finally:
+                        exporter.disconnect()
+                    if summary is None:
+                        result['error'] = 'export failed'
+                    else:
+                        result.update(summary)
+        except Exception as e:
+            result['error'] = str(e)
+        if result['error']:
+            print(f"❌ {result['error']}")
+
+    result['elapsed'] = time.perf_counter() - started
+    result['metrics'] = metrics.since(metrics_before).snapshot()
+    return result
+
+
+class BatchExporter:
+    """Schedules account exports under a global and a per-server limit
+
+    Accounts are started in manifest order, skipping past any whose server
+    is at its session limit so one busy server does not hold up the rest.
+    """
+
+    def __init__(self, accounts, output_dir='exports', jobs=4, per_server=4, incremental=False,
+                 progress_interval=10):
+        self.accounts = accounts
+        self.output_dir = output_dir
+        self.jobs = jobs
+        # The CPUs are shared by the accounts running at once
+        self.parse_processes = max(1, (os.cpu_count() or 1) // jobs)
+        self.per_server = per_server
+        self.incremental = incremental
+        self.progress_interval = progress_interval
+        self.results = []
+        self.progress = {}  # email -> (processed, total, exported)
+
+    def attachment_dir(self, account):
+        attachments = account.get('attachments')
+        if attachments is True:
+            return os.path.join(self.output_dir, 'attachments')
+        return attachments or None
+
+    def run(self):
+        """Export every account and return one result dict per account"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        started = time.perf_counter()
+        last_report = started
+        pending = deque(self.accounts)
+        running = {}  # future -> (account, sessions)
+        sessions = Counter()  # server -> open sessions
+        progress = multiprocessing.Queue()
+
+        print(f"Exporting {len(pending)} accounts to {self.output_dir} "
+              f"({self.jobs} at a time, {self.per_server} sessions per server)")
+        with ProcessPoolExecutor(max_workers=self.jobs, initializer=init_worker, initargs=(progress,)) as pool:
+            while pending or running:
+                for account in list(pending):
+                    if len(running) >= self.jobs:
+                        break
+                    needed = connections_needed(fit_workers(account, self.per_server))
+                    server = account['server'].lower()
+                    if sessions[server] + needed > self.per_server:
+                        continue
+                    pending.remove(account)
+                    account = fit_workers(account, self.per_server)
+                    sessions[server] += needed
+                    future = pool.submit(
+                        export_account, account, output_path(account, self.output_dir),
+                        self.attachment_dir(account), self.incremental,
+                        parse_processes=self.parse_processes
+                    )
+                    running[future] = (account, needed)
+
+                if time.perf_counter() - last_report >= self.progress_interval:
+                    last_report = time.perf_counter()
+                    self.report(started, len(pending), [account['email'] for account, needed in running.values()])
+
+                done, _ = wait(running, timeout=1, return_when=FIRST_COMPLETED)
+                self.drain(progress)
+                for future in done:
+                    account, needed = running.pop(future)
+                    sessions[account['server'].lower()] -= needed
+                    self.finish(account, future, started)
+
+        self.drain(progress)
+        self.summary(started)
+        return self.results
+
+    def drain(self, progress):
+        while True:
+            try:
+                email_address, processed, total, exported = progress.get_nowait()
+            except queue.Empty:
+                return
+            self.progress[email_address] = (processed, total, exported)
+
+    def finish(self, account, future, started):
+        """Record the result of a finished account"""
+        try:
+            result = future.result()
+        except Exception as e:
+            result = {'email': account['email'], 'error': f'worker failed: {e}', 'elapsed': 0,
+                      'output_file': output_path(account, self.output_dir)}
+        if result.get('metrics'):
+            metrics.merge(result.pop('metrics'))
+        self.results.append(result)
+
+        done = len(self.results)
+        if result['error']:
+            print(f"[{done}/{len(self.accounts)}] ✗ {result['email']}: {result['error']} "
+                  f"(see {result.get('log', 'the log')})")
+        else:
+            rate = result['processed'] / result['elapsed'] if result['elapsed'] else 0
+            skipped = f", {result['skipped']} skipped" if result.get('skipped') else ''
+            print(f"[{done}/{len(self.accounts)}] ✓ {result['email']}: {result['exported']} rows from "
+                  f"{result['processed']} emails{skipped} in {result['elapsed']:.1f}s ({rate:.1f} emails/s) "
+                  f"-> {result['output_file']}")
+
+    def processed_count(self):
+        finished = {result['email'] for result in self.results}
+        return (sum(result.get('processed', 0) for result in self.results)
+                + sum(processed for email_address, (processed, total, exported) in self.progress.items()
+                      if email_address not in finished))
+
+    def report(self, started, pending, running):
+        """Print overall progress and the state of the running accounts"""
+        elapsed = time.perf_counter() - started
+        processed = self.processed_count()
+        failed = sum(1 for result in self.results if result['error'])
+        print(f"--- {elapsed:.0f}s: {len(self.results)} done ({failed} failed), {len(running)} running, "
+              f"{pending} waiting; {processed} emails ({processed / elapsed if elapsed else 0:.1f} emails/s)")
+        for email_address in running:
+            if email_address in self.progress:
+                count, total, exported = self.progress[email_address]
+                print(f"    {email_address}: {count}/{total} emails, {exported} rows")
+            else:
+                print(f"    {email_address}: connecting")
+
+    def summary(self, started):
+        elapsed = time.perf_counter() - started
+        processed = self.processed_count()
+        failed = [result for result in self.results if result['error']]
+        print(f"\nExported {len(self.results) - len(failed)} of {len(self.results)} accounts, "
+              f"{processed} emails in {elapsed:.1f}s ({processed / elapsed if elapsed else 0:.1f} emails/s). "
+              f"Time by stage:")
+        print(metrics.summary())
+        if failed:
+            print(f"\n{len(failed)} accounts failed:")
+            for result in failed:
+                print(f"  {result['email']}: {result['error']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('manifest', help='JSON or CSV file listing the accounts')
+    parser.add_argument('-o', '--output-dir', default='exports', help='directory of the export files')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='accounts exported at a time')
+    parser.add_argument('--per-server', type=int, default=4, help='POP3 sessions open at a time per server')
+    parser.add_argument('--format', help='output format of accounts that do not set one (default csv)')
+    parser.add_argument('--all', action='store_true', help='export all emails, not only sent ones')
+    parser.add_argument('--incremental', action='store_true',
+                        help='resume previous exports and add only new emails')
+    parser.add_argument('--progress-interval', type=float, default=10, help='seconds between progress reports')
+    parser.add_argument('--report', help='write the per-account results to this JSON file')
+    args = parser.parse_args(argv)
+
+    defaults = {}
+    if args.format:
+        defaults['format'] = args.format
+    if args.all:
+        defaults['sent_only'] = False
+    accounts = load_accounts(args.manifest, defaults)
+    if not accounts:
+        print("No accounts to export.")
+        return 1
+
+    exporter = BatchExporter(
+        accounts, output_dir=args.output_dir, jobs=max(1, args.jobs), per_server=max(1, args.per_server),
+        incremental=args.incremental, progress_interval=args.progress_interval
+    )
+    results = exporter.run()
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nReport written to {args.report}")
+    return 1 if any(result['error'] for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
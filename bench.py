@@ -0,0 +1,426 @@
+"""Benchmarks for fetching, exporting and serving mail against a local fake server
+
+Every scenario runs in a fresh process against the POP3/SMTP stand-ins of
+bench_fixtures, so peak memory is measured per scenario. Results are
+written as a JSON report that later runs can be compared with:
+
+    python bench.py --messages 500 --latency 0.005 --bandwidth 5000000 -o before.json
+    python bench.py --messages 500 --latency 0.005 --bandwidth 5000000 -o after.json
+    python bench.py --compare before.json after.json
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import math
+import os
+import platform
+import poplib
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak RSS is not reported there
+    resource = None
+
+from bench_fixtures import WORDS, FakePOP3Server, FakeSMTPServer, generate_mailbox
+
+ACCOUNT = 'bench@example.com'
+PASSWORD = 'bench'
+REPORT_VERSION = 1
+
+SCENARIOS = {}
+
+
+def scenario(name):
+    """Register a benchmark; it returns a dict with at least ``messages``"""
+    def register(f):
+        SCENARIOS[name] = f
+        return f
+    return register
+
+
+def load_app(ctx):
+    """Import the web app with its cache in the current (scratch) directory, pointed at the fake servers"""
+    import app
+    app.EMAIL_CONFIG.update({
+        'pop_server': ctx['pop'][0],
+        'pop_port': ctx['pop'][1],
+        'smtp_server': ctx['smtp'][0],
+        'smtp_port': ctx['smtp'][1],
+        'use_ssl_pop': False,
+        'use_tls_smtp': False,
+        'export_files': []
+    })
+    return app
+
+
+@scenario('sync_headers')
+def bench_sync_headers(ctx):
+    """EmailManager.sync_mailbox: UIDL listing and TOP of every message"""
+    app = load_app(ctx)
+    added = app.EmailManager(ACCOUNT, PASSWORD).sync_mailbox(limit=ctx['messages'])
+    return {'messages': added or 0}
+
+
+@scenario('sync_headers_async')
+def bench_sync_headers_async(ctx):
+    """AsyncEmailManager.sync_mailbox on the mail loop"""
+    app = load_app(ctx)
+    added = app.mail_loop.run(app.AsyncEmailManager(ACCOUNT, PASSWORD).sync_mailbox(limit=ctx['messages']))
+    return {'messages': added or 0}
+
+
+@scenario('fetch_bodies')
+def bench_fetch_bodies(ctx):
+    """EmailManager.get_email of every message, one after another (RETR, parse, attachments)"""
+    app = load_app(ctx)
+    manager = app.EmailManager(ACCOUNT, PASSWORD)
+    fetched = sum(manager.get_email(num) is not None for num in range(1, ctx['messages'] + 1))
+    return {'messages': fetched}
+
+
+@scenario('fetch_bodies_async')
+def bench_fetch_bodies_async(ctx):
+    """AsyncEmailManager.get_email of every message, concurrently over the pooled sessions"""
+    app = load_app(ctx)
+
+    async def fetch_all():
+        results = await asyncio.gather(*(
+            app.AsyncEmailManager(ACCOUNT, PASSWORD).get_email(num) for num in range(1, ctx['messages'] + 1)
+        ))
+        return sum(result is not None for result in results)
+
+    return {'messages': app.mail_loop.run(fetch_all())}
+
+
+def run_export(ctx, **options):
+    from app_win import EmailToCSV
+    host, port = ctx['pop']
+    exporter = EmailToCSV(ACCOUNT, PASSWORD, host, port=port)
+    # connect() only tries the standard ports, so log in directly
+    exporter.mail = poplib.POP3(host, port, timeout=30)
+    exporter.mail.user(ACCOUNT)
+    exporter.mail.pass_(PASSWORD)
+    exporter.export_emails(output_file='bench.csv', **options)
+    exporter.disconnect()
+    with open('bench.csv.manifest.json', 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    return {'messages': len(manifest.get('seen_uidls', [])), 'rows': manifest['exported']}
+
+
+@scenario('export')
+def bench_export(ctx):
+    """EmailToCSV.export_emails of the whole mailbox over one session"""
+    return run_export(ctx, sent_only=False)
+
+
+@scenario('export_sent')
+def bench_export_sent(ctx):
+    """EmailToCSV.export_emails with the sent-only filter (TOP first, RETR on match)"""
+    return run_export(ctx, sent_only=True)
+
+
+@scenario('export_parallel')
+def bench_export_parallel(ctx):
+    """EmailToCSV.export_emails over 4 sessions with parsing in a process pool"""
+    return run_export(ctx, sent_only=False, workers=4)
+
+
+@scenario('send')
+def bench_send(ctx):
+    """EmailManager.send_batch in batches of send_batch_size"""
+    app = load_app(ctx)
+    manager = app.EmailManager(ACCOUNT, PASSWORD)
+    batch_size = app.EMAIL_CONFIG['send_batch_size']
+    items = [
+        {'to_address': f'recipient{num}@example.org', 'subject': f'Benchmark {num}',
+         'body': ' '.join(WORDS) * 4}
+        for num in range(ctx['messages'])
+    ]
+    sent = 0
+    for start in range(0, len(items), batch_size):
+        sent += sum(success for success, error, permanent in manager.send_batch(items[start:start + batch_size]))
+    return {'messages': sent}
+
+
+@scenario('routes')
+def bench_routes(ctx):
+    """Latency of the main Flask routes through the test client
+
+    The mailbox headers are synced first. ``email`` opens a different
+    message on every request, so it measures uncached opens.
+    """
+    app = load_app(ctx)
+    client = app.app.test_client()
+    client.post('/login', data={'email': ACCOUNT, 'password': PASSWORD})
+    app.run_mail_blocking(app.new_manager(ACCOUNT, PASSWORD), 'sync_mailbox', limit=ctx['messages'])
+
+    messages = ctx['messages']
+    routes = {
+        'inbox': lambda n: '/inbox',
+        'inbox_json': lambda n: '/inbox.json',
+        'email': lambda n: f'/email/{messages - n % messages}',
+        'search': lambda n: f'/search?q={WORDS[n % len(WORDS)]}',
+        'threads': lambda n: '/threads',
+    }
+    results = {}
+    total = 0
+    for name, url in routes.items():
+        timings = []
+        errors = 0
+        for n in range(ctx['requests']):
+            started = time.perf_counter()
+            response = client.get(url(n))
+            timings.append(time.perf_counter() - started)
+            errors += response.status_code >= 400
+        results[name] = dict(summarize(timings), errors=errors)
+        total += len(timings)
+    return {'messages': total, 'routes': results}
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a sorted list"""
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)]
+
+
+def summarize(timings):
+    timings = sorted(timings)
+    return {
+        'requests': len(timings),
+        'mean_ms': round(sum(timings) / len(timings) * 1000, 3),
+        'p50_ms': round(percentile(timings, 50) * 1000, 3),
+        'p99_ms': round(percentile(timings, 99) * 1000, 3),
+        'max_ms': round(timings[-1] * 1000, 3)
+    }
+
+
+def peak_rss_kb(who):
+    """Peak resident set size in KB, or None where it cannot be measured"""
+    if resource is None:
+        return None
+    if who == resource.RUSAGE_SELF:
+        # Linux carries ru_maxrss over from the parent across exec; VmHWM starts afresh
+        try:
+            with open('/proc/self/status', 'r') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+    peak = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def run_scenario(name, ctx):
+    """Run one scenario in this process and return its measurements"""
+    scratch = tempfile.mkdtemp(prefix='mailbench-')
+    os.chdir(scratch)
+    try:
+        started = time.perf_counter()
+        cpu_started = time.process_time()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            result = SCENARIOS[name](ctx)
+        seconds = time.perf_counter() - started
+    finally:
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    result.update({
+        'seconds': round(seconds, 3),
+        'cpu_seconds': round(time.process_time() - cpu_started, 3),
+        'msgs_per_sec': round(result['messages'] / seconds, 2) if seconds else None,
+        'peak_rss_kb': peak_rss_kb(resource.RUSAGE_SELF) if resource else None,
+        'peak_rss_children_kb': peak_rss_kb(resource.RUSAGE_CHILDREN) if resource else None
+    })
+    return result
+
+
+def run_in_subprocess(name, ctx, timeout):
+    """Run a scenario in a fresh interpreter so its memory peak is its own"""
+    command = [
+        sys.executable, os.path.abspath(__file__), '--run-scenario', name,
+        '--context', json.dumps(ctx)
+    ]
+    try:
+        completed = subprocess.run(command, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return {'error': f'timed out after {timeout}s'}
+    lines = completed.stdout.strip().splitlines()
+    if completed.returncode != 0 or not lines:
+        return {'error': (completed.stderr.strip().splitlines() or ['no output'])[-1]}
+    return json.loads(lines[-1])
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_benchmarks(args):
+    started = time.perf_counter()
+    mailbox = list(generate_mailbox(args.messages, account=ACCOUNT, seed=args.seed))
+    mailbox_info = {
+        'messages': len(mailbox),
+        'bytes': sum(len(message) for message in mailbox),
+        'largest_bytes': max((len(message) for message in mailbox), default=0),
+        'generate_seconds': round(time.perf_counter() - started, 3)
+    }
+    print(f"Mailbox: {mailbox_info['messages']} messages, {mailbox_info['bytes'] / 1e6:.1f} MB")
+
+    pop_server = FakePOP3Server(mailbox, latency=args.latency, bandwidth=args.bandwidth).start()
+    smtp_server = FakeSMTPServer(latency=args.latency, bandwidth=args.bandwidth).start()
+    ctx = {
+        'pop': list(pop_server.address),
+        'smtp': list(smtp_server.address),
+        'messages': args.messages,
+        'requests': args.requests
+    }
+
+    results = {}
+    try:
+        for name in args.scenarios:
+            pop_before, smtp_before = pop_server.snapshot(), smtp_server.snapshot()
+            result = run_in_subprocess(name, ctx, args.timeout)
+            pop_after, smtp_after = pop_server.snapshot(), smtp_server.snapshot()
+            result.update({
+                'bytes_from_server': (pop_after['bytes_sent'] - pop_before['bytes_sent']
+                                      + smtp_after['bytes_sent'] - smtp_before['bytes_sent']),
+                'bytes_to_server': (pop_after['bytes_received'] - pop_before['bytes_received']
+                                    + smtp_after['bytes_received'] - smtp_before['bytes_received']),
+                'connections': (pop_after['connections'] - pop_before['connections']
+                                + smtp_after['connections'] - smtp_before['connections']),
+                'commands': {
+                    verb: count - pop_before['commands'].get(verb, 0) - smtp_before['commands'].get(verb, 0)
+                    for verb, count in _merge(pop_after['commands'], smtp_after['commands']).items()
+                    if count - pop_before['commands'].get(verb, 0) - smtp_before['commands'].get(verb, 0)
+                }
+            })
+            results[name] = result
+            print(format_result(name, result))
+    finally:
+        pop_server.stop()
+        smtp_server.stop()
+
+    return {
+        'version': REPORT_VERSION,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': {
+            'messages': args.messages,
+            'seed': args.seed,
+            'latency': args.latency,
+            'bandwidth': args.bandwidth,
+            'requests': args.requests
+        },
+        'mailbox': mailbox_info,
+        'results': results
+    }
+
+
+def _merge(first, second):
+    merged = dict(first)
+    for key, value in second.items():
+        merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+def format_result(name, result):
+    if 'error' in result:
+        return f"{name:20} ERROR: {result['error']}"
+    rss = result.get('peak_rss_kb')
+    line = (f"{name:20} {result['messages']:>7} msgs {result['seconds']:>8.2f}s "
+            f"{result['msgs_per_sec'] or 0:>9.1f} msg/s {result['bytes_from_server'] / 1e6:>8.1f} MB "
+            f"{(rss or 0) / 1024:>7.1f} MB peak RSS")
+    for route, timing in result.get('routes', {}).items():
+        line += (f"\n    {route:16} p50 {timing['p50_ms']:>8.2f} ms  p99 {timing['p99_ms']:>8.2f} ms"
+                 f"  ({timing['requests']} requests, {timing['errors']} errors)")
+    return line
+
+
+def _change(old, new, higher_is_better=False):
+    if old is None or new is None:
+        return f"{'-':>28}"
+    pct = (new - old) / old * 100 if old else 0.0
+    better = pct > 0 if higher_is_better else pct < 0
+    marker = '' if abs(pct) < 5 else (' better' if better else ' worse')
+    return f"{old:>10.2f} -> {new:>10.2f} {pct:>+7.1f}%{marker}"
+
+
+def compare_reports(old_path, new_path):
+    """Print the change of every metric between two reports"""
+    with open(old_path, 'r', encoding='utf-8') as f:
+        old = json.load(f)
+    with open(new_path, 'r', encoding='utf-8') as f:
+        new = json.load(f)
+
+    print(f"{old_path} ({old.get('git_commit')}) -> {new_path} ({new.get('git_commit')})")
+    if old['config'] != new['config']:
+        print(f"⚠ Reports were made with different settings: {old['config']} vs {new['config']}")
+
+    for name, new_result in new['results'].items():
+        old_result = old['results'].get(name)
+        if old_result is None or 'error' in old_result or 'error' in new_result:
+            continue
+        print(f"\n{name}")
+        print(f"  msgs/sec        {_change(old_result['msgs_per_sec'], new_result['msgs_per_sec'], True)}")
+        print(f"  seconds         {_change(old_result['seconds'], new_result['seconds'])}")
+        print(f"  cpu seconds     {_change(old_result['cpu_seconds'], new_result['cpu_seconds'])}")
+        print(f"  MB from server  {_change(old_result['bytes_from_server'] / 1e6, new_result['bytes_from_server'] / 1e6)}")
+        if old_result.get('peak_rss_kb') and new_result.get('peak_rss_kb'):
+            print(f"  peak RSS MB     {_change(old_result['peak_rss_kb'] / 1024, new_result['peak_rss_kb'] / 1024)}")
+        for route, timing in new_result.get('routes', {}).items():
+            old_timing = old_result.get('routes', {}).get(route)
+            if old_timing:
+                print(f"  {route + ' p50 ms':16}{_change(old_timing['p50_ms'], timing['p50_ms'])}")
+                print(f"  {route + ' p99 ms':16}{_change(old_timing['p99_ms'], timing['p99_ms'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=200, help='messages in the synthetic mailbox')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic mailbox')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added before every server reply')
+    parser.add_argument('--bandwidth', type=float, default=None, help='server bandwidth cap in bytes/sec')
+    parser.add_argument('--requests', type=int, default=100, help='requests per route in the routes scenario')
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--timeout', type=int, default=1800, help='seconds allowed per scenario')
+    parser.add_argument('-o', '--output', help='write the JSON report to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two JSON reports')
+    parser.add_argument('--run-scenario', help=argparse.SUPPRESS)
+    parser.add_argument('--context', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_reports(*args.compare)
+        return
+
+    if args.run_scenario:
+        print(json.dumps(run_scenario(args.run_scenario, json.loads(args.context))))
+        sys.stdout.flush()
+        # Background sync and mail loop threads are not joined
+        os._exit(0)
+
+    report = run_benchmarks(args)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+import base64
+import random
+import socketserver
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from email.message import EmailMessage
+from email.utils import format_datetime
+
+# Replies are written in chunks of this size so bandwidth limits apply smoothly
+CHUNK_SIZE = 16 * 1024
+
+WORDS = (
+    'project schedule review meeting invoice report update client draft design '
+    'budget release deadline shipment proof chapter manuscript figure table '
+    'approval feedback revision contract quarter forecast estimate layout '
+    'question answer summary agenda notes follow team vendor order status'
+).split()
+
+ACCENTED_WORDS = ['café', 'naïve', 'résumé', 'Müller', 'Zürich', 'señor', 'crème']
+
+
+class ThrottledHandler(socketserver.StreamRequestHandler):
+    """Line-based request handler that replies with the server's latency and bandwidth"""
+
+    def readline(self):
+        line = self.rfile.readline()
+        self.server.count('bytes_received', len(line))
+        return line
+
+    def reply(self, data):
+        """Send one reply after ``latency`` seconds at no more than ``bandwidth`` bytes/sec"""
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        for start in range(0, len(data), CHUNK_SIZE):
+            chunk = data[start:start + CHUNK_SIZE]
+            self.wfile.write(chunk)
+            if self.server.bandwidth:
+                time.sleep(len(chunk) / self.server.bandwidth)
+        self.server.count('bytes_sent', len(data))
+
+
+class FakeServer(socketserver.ThreadingTCPServer):
+    """Threaded local server with per-reply latency and a bandwidth cap
+
+    ``stats`` counts connections, commands by name and bytes in each
+    direction; ``snapshot`` returns a copy for measuring one run.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handler, host='127.0.0.1', port=0, latency=0, bandwidth=None):
+        super().__init__((host, port), handler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.stats = {'connections': 0, 'bytes_sent': 0, 'bytes_received': 0, 'commands': {}}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def address(self):
+        return self.server_address[:2]
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.stats[name] += amount
+
+    def count_command(self, verb):
+        with self._lock:
+            commands = self.stats['commands']
+            commands[verb] = commands.get(verb, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, commands=dict(self.stats['commands']))
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class POP3Handler(ThrottledHandler):
+    def handle(self):
+        self.server.count('connections')
+        self.reply(b'+OK fake POP3 server ready\r\n')
+        mailbox = self.server.mailbox
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            parts = line.decode('ascii', errors='ignore').split()
+            verb = parts[0].upper() if parts else ''
+            self.server.count_command(verb)
+            try:
+                args = [int(arg) for arg in parts[1:]] if verb in ('LIST', 'UIDL', 'RETR', 'TOP', 'DELE') else []
+            except ValueError:
+                self.reply(b'-ERR invalid argument\r\n')
+                continue
+            if args and not 1 <= args[0] <= len(mailbox):
+                self.reply(b'-ERR no such message\r\n')
+                continue
+
+            if verb in ('USER', 'PASS', 'NOOP', 'RSET', 'DELE'):
+                self.reply(b'+OK\r\n')
+            elif verb == 'STAT':
+                self.reply(f'+OK {len(mailbox)} {sum(len(m) for m in mailbox)}\r\n'.encode('ascii'))
+            elif verb in ('LIST', 'UIDL'):
+                def value(num):
+                    return len(mailbox[num - 1]) if verb == 'LIST' else self.server.uidl(num)
+                if args:
+                    self.reply(f'+OK {args[0]} {value(args[0])}\r\n'.encode('ascii'))
+                else:
+                    listing = ''.join(f'{num} {value(num)}\r\n' for num in range(1, len(mailbox) + 1))
+                    self.reply(f'+OK\r\n{listing}.\r\n'.encode('ascii'))
+            elif verb == 'RETR':
+                self.reply(b'+OK\r\n' + self.server.stuffed(args[0]) + b'.\r\n')
+            elif verb == 'TOP' and len(args) == 2:
+                self.reply(b'+OK\r\n' + self.server.top(args[0], args[1]) + b'.\r\n')
+            elif verb == 'QUIT':
+                self.reply(b'+OK bye\r\n')
+                return
+            else:
+                self.reply(b'-ERR unknown command\r\n')
+
+
+class FakePOP3Server(FakeServer):
+    """POP3 stand-in serving a fixed list of raw messages (any password is accepted)"""
+
+    def __init__(self, mailbox, **kwargs):
+        super().__init__(POP3Handler, **kwargs)
+        self.mailbox = [message.replace(b'\r\n', b'\n').replace(b'\n', b'\r\n') for message in mailbox]
+        self._stuffed = {}
+
+    def uidl(self, num):
+        return f'bench{num:07d}'
+
+    def stuffed(self, num):
+        """Dot-stuffed message text as sent in a RETR response"""
+        data = self._stuffed.get(num)
+        if data is None:
+            lines = self.mailbox[num - 1].split(b'\r\n')
+            if lines and lines[-1] == b'':
+                lines.pop()
+            data = b''.join((b'.' + line if line.startswith(b'.') else line) + b'\r\n' for line in lines)
+            self._stuffed[num] = data
+        return data
+
+    def top(self, num, body_lines):
+        data = self.stuffed(num)
+        header_end = data.find(b'\r\n\r\n')
+        if header_end < 0:
+            return data
+        end = header_end + 4
+        for _ in range(body_lines):
+            next_end = data.find(b'\r\n', end)
+            if next_end < 0:
+                break
+            end = next_end + 2
+        return data[:end]
+
+
+class SMTPHandler(ThrottledHandler):
+    def handle(self):
+        self.server.count('connections')
+        self.reply(b'220 fake SMTP server ready\r\n')
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            parts = line.decode('ascii', errors='ignore').split()
+            verb = parts[0].upper() if parts else ''
+            self.server.count_command(verb)
+
+            if verb == 'EHLO':
+                self.reply(b'250-fake\r\n250-AUTH PLAIN LOGIN\r\n250-8BITMIME\r\n250 SIZE 52428800\r\n')
+            elif verb == 'HELO':
+                self.reply(b'250 fake\r\n')
+            elif verb == 'AUTH':
+                mechanism = parts[1].upper() if len(parts) > 1 else ''
+                if mechanism == 'LOGIN':
+                    if len(parts) < 3:
+                        self.reply(b'334 ' + base64.b64encode(b'Username:') + b'\r\n')
+                        self.readline()
+                    self.reply(b'334 ' + base64.b64encode(b'Password:') + b'\r\n')
+                    self.readline()
+                elif len(parts) < 3:
+                    self.reply(b'334 \r\n')
+                    self.readline()
+                self.reply(b'235 Authentication successful\r\n')
+            elif verb in ('MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self.reply(b'250 OK\r\n')
+            elif verb == 'DATA':
+                self.reply(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+                while True:
+                    data = self.readline()
+                    if not data or data.rstrip(b'\r\n') == b'.':
+                        break
+                self.server.count('messages_received')
+                self.reply(b'250 OK queued\r\n')
+            elif verb == 'QUIT':
+                self.reply(b'221 bye\r\n')
+                return
+            else:
+                self.reply(b'502 Command not implemented\r\n')
+
+
+class FakeSMTPServer(FakeServer):
+    """SMTP stand-in that accepts any login and discards the mail it is sent"""
+
+    def __init__(self, **kwargs):
+        super().__init__(SMTPHandler, **kwargs)
+        self.stats['messages_received'] = 0
+
+
+def _words(rng, count):
+    words = [rng.choice(WORDS) for _ in range(count)]
+    if rng.random() < 0.2:
+        words[rng.randrange(len(words))] = rng.choice(ACCENTED_WORDS)
+    return ' '.join(words)
+
+
+def _paragraphs(rng, size):
+    """Roughly ``size`` characters of text in wrapped paragraphs"""
+    paragraphs = []
+    total = 0
+    while total < size:
+        paragraph = _words(rng, rng.randint(20, 80))
+        paragraphs.append(paragraph)
+        total += len(paragraph)
+    return '\n\n'.join(paragraphs)
+
+
+def _lognormal(rng, median, sigma, limit):
+    return int(min(limit, rng.lognormvariate(0, sigma) * median))
+
+
+def generate_mailbox(count, account='bench@example.com', seed=0, sent_ratio=0.2,
+                     attachment_ratio=0.15, reply_ratio=0.3, max_attachment_bytes=5 * 1024 * 1024):
+    """Yield ``count`` raw messages with realistic sizes and MIME structures
+
+    Body sizes and attachment sizes follow log-normal distributions (a few
+    KB and ~100 KB median). Messages are plain text, multipart/alternative,
+    HTML only, or multipart/mixed with attachments or a forwarded message;
+    ``reply_ratio`` of them reply to an earlier one with In-Reply-To and
+    References, and ``sent_ratio`` are from ``account`` itself. The same
+    ``seed`` always gives the same mailbox.
+    """
+    rng = random.Random(seed)
+    domain = account.split('@')[-1]
+    contacts = [f'{rng.choice(WORDS)}.{rng.choice(WORDS)}{n}@{rng.choice(["example.org", domain])}'
+                for n in range(max(5, count // 20))]
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    sent = []
+
+    for num in range(count):
+        msg = EmailMessage()
+        sender = account if rng.random() < sent_ratio else rng.choice(contacts)
+        recipient = rng.choice(contacts) if sender == account else account
+        msg['From'] = sender
+        msg['To'] = recipient
+        if rng.random() < 0.2:
+            msg['Cc'] = ', '.join(rng.sample(contacts, min(len(contacts), rng.randint(1, 4))))
+        msg['Date'] = format_datetime(start + timedelta(minutes=17 * num + rng.randint(0, 16)))
+        msg['Message-ID'] = f'<bench.{seed}.{num}@{domain}>'
+
+        subject = _words(rng, rng.randint(2, 7)).capitalize()
+        if sent and rng.random() < reply_ratio:
+            parent_num, parent_subject, parent_refs = rng.choice(sent[-200:])
+            parent_id = f'<bench.{seed}.{parent_num}@{domain}>'
+            subject = 'Re: ' + parent_subject
+            msg['In-Reply-To'] = parent_id
+            msg['References'] = ' '.join((parent_refs + [parent_id])[-10:])
+            sent.append((num, parent_subject, (parent_refs + [parent_id])[-10:]))
+        else:
+            sent.append((num, subject, []))
+        msg['Subject'] = subject
+
+        text = _paragraphs(rng, _lognormal(rng, 2000, 1.0, 200000))
+        html = '<html><body>' + ''.join(f'<p>{p}</p>' for p in text.split('\n\n')) + '</body></html>'
+        shape = rng.random()
+        if shape < 0.4:
+            msg.set_content(text)
+        elif shape < 0.75:
+            msg.set_content(text)
+            msg.add_alternative(html, subtype='html')
+        elif shape < 0.8:
+            msg.set_content(html, subtype='html')
+        else:
+            msg.set_content(text)
+            if rng.random() < 0.5:
+                msg.add_alternative(html, subtype='html')
+
+        if shape >= 0.8 or rng.random() < attachment_ratio:
+            if rng.random() < 0.15 and num:
+                forwarded = EmailMessage()
+                forwarded['From'] = rng.choice(contacts)
+                forwarded['Subject'] = _words(rng, 4)
+                forwarded.set_content(_paragraphs(rng, _lognormal(rng, 1500, 0.8, 50000)))
+                msg.add_attachment(forwarded)
+            for index in range(rng.choice([1, 1, 1, 2, 3])):
+                maintype, subtype, extension = rng.choice([
+                    ('application', 'pdf', 'pdf'),
+                    ('image', 'jpeg', 'jpg'),
+                    ('image', 'png', 'png'),
+                    ('application', 'vnd.openxmlformats-officedocument.wordprocessingml.document', 'docx'),
+                    ('application', 'zip', 'zip'),
+                ])
+                size = _lognormal(rng, 100 * 1024, 1.2, max_attachment_bytes)
+                msg.add_attachment(
+                    rng.randbytes(size), maintype=maintype, subtype=subtype,
+                    filename=f'{rng.choice(WORDS)}_{num}_{index}.{extension}'
+                )
+
+        yield msg.as_bytes()
@@ -0,0 +1,167 @@
+import csv
+import gzip
+import json
+import os
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+FIELDNAMES = ['Date', 'From', 'To', 'CC', 'Subject', 'Email_Text']
+
+
+class CSVWriter:
+    """Plain CSV output, one row per message"""
+
+    resumable = True
+
+    def __init__(self, path, fieldnames=FIELDNAMES, append=False, row_group_size=None):
+        self.file = open(path, 'a' if append else 'w', newline='', encoding='utf-8')
+        self.writer = csv.DictWriter(self.file, fieldnames=fieldnames)
+        if not append:
+            self.writer.writeheader()
+
+    def write(self, row):
+        self.writer.writerow(row)
+
+    def checkpoint(self):
+        """Flush everything written so far and return the file offset"""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class CompressedJSONLWriter:
+    """JSON Lines compressed in independent gzip or zstd frames
+
+    Rows are buffered and compressed ``row_group_size`` at a time. Every
+    group (and every checkpoint) ends a frame, so the file can be truncated
+    back to any checkpoint offset and appended to, and readers see one
+    continuous stream.
+    """
+
+    resumable = True
+
+    def __init__(self, path, fieldnames=FIELDNAMES, append=False, row_group_size=500,
+                 compression='gzip'):
+        if compression == 'zstd' and zstandard is None:
+            raise RuntimeError("zstd output requires the 'zstandard' package")
+        self.fieldnames = fieldnames
+        self.compression = compression
+        self.row_group_size = row_group_size
+        self.file = open(path, 'ab' if append else 'wb')
+        self.rows = []
+
+    def compress(self, data):
+        if self.compression == 'zstd':
+            return zstandard.ZstdCompressor(level=3).compress(data)
+        return gzip.compress(data, compresslevel=6)
+
+    def flush_rows(self):
+        if not self.rows:
+            return
+        data = ''.join(
+            json.dumps({name: row.get(name, '') for name in self.fieldnames}, ensure_ascii=False) + '\n'
+            for row in self.rows
+        )
+        self.file.write(self.compress(data.encode('utf-8')))
+        self.rows = []
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.row_group_size:
+            self.flush_rows()
+
+    def checkpoint(self):
+        """Compress buffered rows into a closed frame and return the file offset"""
+        self.flush_rows()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.file.tell()
+
+    def close(self):
+        self.flush_rows()
+        self.file.close()
+
+
+class ParquetWriter:
+    """Parquet output written one row group at a time (requires pyarrow)
+
+    A Parquet file is only readable once its footer is written, so an
+    interrupted export cannot be resumed and is started over instead.
+    """
+
+    resumable = False
+
+    def __init__(self, path, fieldnames=FIELDNAMES, append=False, row_group_size=500):
+        if pyarrow is None:
+            raise RuntimeError("Parquet output requires the 'pyarrow' package")
+        self.fieldnames = fieldnames
+        self.row_group_size = row_group_size
+        self.schema = pyarrow.schema([(name, pyarrow.string()) for name in fieldnames])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression='zstd')
+        self.rows = []
+
+    def flush_rows(self):
+        if not self.rows:
+            return
+        columns = {name: [row.get(name, '') for row in self.rows] for name in self.fieldnames}
+        self.writer.write_table(pyarrow.table(columns, schema=self.schema))
+        self.rows = []
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.row_group_size:
+            self.flush_rows()
+
+    def checkpoint(self):
+        """Write buffered rows as a row group; offsets are not meaningful here"""
+        self.flush_rows()
+        return 0
+
+    def close(self):
+        self.flush_rows()
+        self.writer.close()
+
+
+# Output format name -> (writer class, extra keyword arguments)
+WRITERS = {
+    'csv': (CSVWriter, {}),
+    'jsonl.gz': (CompressedJSONLWriter, {'compression': 'gzip'}),
+    'jsonl.zst': (CompressedJSONLWriter, {'compression': 'zstd'}),
+    'parquet': (ParquetWriter, {}),
+}
+
+
+def detect_format(path):
+    """Guess the output format from a file name, defaulting to CSV"""
+    name = path.lower()
+    for output_format in WRITERS:
+        if name.endswith('.' + output_format):
+            return output_format
+    return 'csv'
+
+
+def get_writer_class(output_format):
+    """Return the writer class for an output format name"""
+    if output_format not in WRITERS:
+        raise ValueError(f"Unknown output format {output_format!r}, expected one of {', '.join(WRITERS)}")
+    return WRITERS[output_format][0]
+
+
+def open_writer(path, output_format=None, append=False, row_group_size=500, fieldnames=FIELDNAMES):
+    """Open an output writer for ``path`` in the given (or detected) format"""
+    output_format = output_format or detect_format(path)
+    writer_class = get_writer_class(output_format)
+    options = WRITERS[output_format][1]
+    return writer_class(path, fieldnames=fieldnames, append=append, row_group_size=row_group_size, **options)
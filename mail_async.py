@@ -0,0 +1,522 @@
+import asyncio
+import base64
+import poplib
+import smtplib
+import ssl
+import threading
+import time
+from email.parser import BytesFeedParser
+from email.utils import getaddresses
+
+from mail_stream import MessageFilter, record_fetch
+
+
+class AsyncPOP3:
+    """Minimal asyncio POP3 client with the subset of poplib used by the app
+
+    Errors are raised as ``poplib.error_proto`` so callers can treat both
+    backends alike. Like poplib's socket timeout, ``timeout`` limits how
+    long the server may stay silent, not how long a response may take: a
+    single timer per response is pushed back as lines arrive, so long
+    responses do not pay for a timer task per line.
+    """
+
+    def __init__(self, reader, writer, timeout=30):
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.welcome = None
+        self.closed = False
+        self._last_read = 0.0
+
+    @classmethod
+    async def connect(cls, host, port, use_ssl=False, timeout=30):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=ssl.create_default_context() if use_ssl else None),
+            timeout
+        )
+        connection = cls(reader, writer, timeout)
+        try:
+            connection.welcome = await asyncio.wait_for(connection._getresp(), timeout)
+        except Exception:
+            connection.close()
+            raise
+        return connection
+
+    async def _getline(self):
+        line = await self.reader.readline()
+        if not line:
+            raise poplib.error_proto('-ERR EOF')
+        self._last_read = time.monotonic()
+        return line.rstrip(b'\r\n'), len(line)
+
+    async def _until_idle(self, coro):
+        """Await ``coro``, raising TimeoutError once no line arrives for ``timeout`` seconds"""
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        expired = False
+        self._last_read = time.monotonic()
+
+        def check():
+            nonlocal timer, expired
+            idle = time.monotonic() - self._last_read
+            if idle >= self.timeout:
+                expired = True
+                task.cancel()
+            else:
+                timer = loop.call_later(self.timeout - idle, check)
+
+        timer = loop.call_later(self.timeout, check)
+        try:
+            return await coro
+        except asyncio.CancelledError:
+            if not expired:
+                raise
+            if hasattr(task, 'uncancel'):
+                task.uncancel()
+            raise asyncio.TimeoutError() from None
+        finally:
+            timer.cancel()
+
+    async def _getresp(self):
+        line, octets = await self._getline()
+        if not line.startswith(b'+'):
+            raise poplib.error_proto(line)
+        return line
+
+    async def _command(self, line):
+        """Send a command and read its status line, without a timeout"""
+        self.writer.write(line.encode('utf-8') + b'\r\n')
+        await self.writer.drain()
+        return await self._getresp()
+
+    async def _shortcmd(self, line):
+        return await self._until_idle(self._command(line))
+
+    async def _longcmd(self, line):
+        """Send a command and collect its multi-line response"""
+        return await self._until_idle(self._read_long(line))
+
+    async def _read_long(self, line):
+        response = await self._command(line)
+        lines = []
+        async for line in self._iter_lines():
+            lines.append(line)
+        return response, lines
+
+    async def _iter_lines(self):
+        """Yield the dot-unstuffed lines of a multi-line response"""
+        while True:
+            line, octets = await self._getline()
+            if line == b'.':
+                return
+            if line.startswith(b'..'):
+                line = line[1:]
+            yield line
+
+    async def user(self, user):
+        return await self._shortcmd(f'USER {user}')
+
+    async def pass_(self, password):
+        return await self._shortcmd(f'PASS {password}')
+
+    async def noop(self):
+        return await self._shortcmd('NOOP')
+
+    async def uidl(self, which=None):
+        if which is not None:
+            return await self._shortcmd(f'UIDL {which}')
+        return await self._longcmd('UIDL')
+
+    async def read_message(self, command, *args, max_text_bytes=1024 * 1024, attachments=None):
+        """Stream a RETR or TOP response into a parsed message, see mail_stream.read_message"""
+        started = time.perf_counter()
+        message_filter = MessageFilter(max_text_bytes, attachments=attachments)
+        parser = BytesFeedParser()
+        # Shared with _read_message so the counts survive a timeout
+        state = {'octets': 0, 'parse_seconds': 0.0, 'open': False}
+        try:
+            await self._until_idle(
+                self._read_message(' '.join([command] + [str(arg) for arg in args]), message_filter, parser, state)
+            )
+            parse_started = time.perf_counter()
+            for kept in message_filter.close():
+                parser.feed(kept + b'\r\n')
+            msg = parser.close()
+            state['parse_seconds'] += time.perf_counter() - parse_started
+        except BaseException as e:
+            record_fetch(command, started, state['parse_seconds'], state['octets'], error=True)
+            if state['open']:
+                await self._drain(e)
+            raise
+        record_fetch(command, started, state['parse_seconds'], state['octets'])
+        return msg, state['octets']
+
+    async def _read_message(self, line, message_filter, parser, state):
+        await self._command(line)
+        state['open'] = True
+        async for line in self._iter_lines():
+            state['octets'] += len(line) + 2
+            parse_started = time.perf_counter()
+            for kept in message_filter.feed(line):
+                parser.feed(kept + b'\r\n')
+            state['parse_seconds'] += time.perf_counter() - parse_started
+        state['open'] = False
+
+    async def _drain(self, error):
+        """Skip the rest of a response interrupted by ``error`` so the session stays in step
+
+        After a timeout or cancellation the session cannot be trusted and is
+        closed instead.
+        """
+        if not isinstance(error, Exception) or isinstance(error, asyncio.TimeoutError):
+            self.close()
+            return
+        try:
+            await self._until_idle(self._skip_lines())
+        except Exception:
+            self.close()
+
+    async def _skip_lines(self):
+        async for line in self._iter_lines():
+            pass
+
+    async def quit(self):
+        try:
+            return await self._shortcmd('QUIT')
+        finally:
+            self.close()
+
+    def close(self):
+        self.closed = True
+        self.writer.close()
+
+
+class AsyncSMTP:
+    """Minimal asyncio SMTP client: EHLO, STARTTLS, AUTH and send_message
+
+    Error replies are raised as ``smtplib.SMTPResponseException``.
+    """
+
+    def __init__(self, host, reader, writer, timeout=30):
+        self.host = host
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.features = {}
+        self.closed = False
+
+    @classmethod
+    async def connect(cls, host, port, timeout=30):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        connection = cls(host, reader, writer, timeout)
+        try:
+            await connection._expect(220)
+            await connection.ehlo()
+        except Exception:
+            connection.close()
+            raise
+        return connection
+
+    async def _getreply(self):
+        """Read a possibly multi-line reply; returns ``(code, lines)``"""
+        return await asyncio.wait_for(self._read_reply(), self.timeout)
+
+    async def _read_reply(self):
+        lines = []
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+            line = line.rstrip(b'\r\n')
+            lines.append(line[4:])
+            if line[3:4] != b'-':
+                return int(line[:3]), lines
+
+    async def _expect(self, *codes):
+        code, lines = await self._getreply()
+        if code not in codes:
+            raise smtplib.SMTPResponseException(code, b'\n'.join(lines))
+        return code, lines
+
+    async def _command(self, line, *codes):
+        self.writer.write(line.encode('utf-8') + b'\r\n')
+        await self.writer.drain()
+        return await self._expect(*codes)
+
+    async def ehlo(self):
+        code, lines = await self._command('EHLO localhost', 250)
+        self.features = {}
+        for line in lines[1:]:
+            name, _, value = line.decode('ascii', errors='ignore').partition(' ')
+            self.features[name.upper()] = value
+
+    async def starttls(self):
+        await self._command('STARTTLS', 220)
+        await self.writer.start_tls(ssl.create_default_context(), server_hostname=self.host)
+        await self.ehlo()
+
+    async def login(self, user, password):
+        mechanisms = self.features.get('AUTH', '').upper().split()
+        if 'PLAIN' in mechanisms or not mechanisms:
+            token = base64.b64encode(f'\0{user}\0{password}'.encode('utf-8')).decode('ascii')
+            await self._command(f'AUTH PLAIN {token}', 235)
+        else:
+            await self._command('AUTH LOGIN', 334)
+            await self._command(base64.b64encode(user.encode('utf-8')).decode('ascii'), 334)
+            await self._command(base64.b64encode(password.encode('utf-8')).decode('ascii'), 235)
+
+    async def noop(self):
+        return await self._command('NOOP', 250)
+
+    async def send_message(self, msg):
+        """Send an email.message.Message to the addresses in its headers"""
+        sender = getaddresses([msg['From']])[0][1]
+        recipients = [
+            address for name, address in getaddresses(
+                msg.get_all('To', []) + msg.get_all('Cc', []) + msg.get_all('Bcc', [])
+            ) if address
+        ]
+        del msg['Bcc']
+
+        try:
+            await self._command(f'MAIL FROM:<{sender}>', 250)
+            for recipient in recipients:
+                await self._command(f'RCPT TO:<{recipient}>', 250, 251)
+            await self._command('DATA', 354)
+        except smtplib.SMTPResponseException:
+            # Abort the transaction so the session can send the next message
+            await self._command('RSET', 250)
+            raise
+
+        data = msg.as_bytes().replace(b'\r\n', b'\n').split(b'\n')
+        for line in data:
+            if line.startswith(b'.'):
+                line = b'.' + line
+            self.writer.write(line + b'\r\n')
+        self.writer.write(b'.\r\n')
+        await self.writer.drain()
+        await self._expect(250)
+
+    async def quit(self):
+        try:
+            return await self._command('QUIT', 221)
+        finally:
+            self.close()
+
+    def close(self):
+        self.closed = True
+        self.writer.close()
+
+
+class AsyncConnectionPool:
+    """Idle asyncio POP3/SMTP sessions kept per key, for use on a single event loop
+
+    Like ConnectionPool, sessions are counted per server so the pool never
+    holds more than ``max_per_server`` sessions open against one host, idle
+    ones included, and at most ``max_per_key`` per key; one session per
+    mailbox is the default since POP3 servers lock the maildrop for the
+    length of a session. Idle sessions are checked with NOOP before reuse
+    and closed after ``idle_timeout`` seconds, or once they are older than
+    ``max_age``, whether or not the pool is used again.
+    """
+
+    def __init__(self, max_per_server=4, max_per_key=1, idle_timeout=60, max_age=300,
+                 health_check_interval=5, wait_timeout=30):
+        self.max_per_server = max_per_server
+        self.max_per_key = max_per_key
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self.health_check_interval = health_check_interval
+        self.wait_timeout = wait_timeout
+        self._idle = {}         # key -> list of [conn, created_at, last_used]
+        self._open = {}         # server -> number of open sessions
+        self._open_by_key = {}  # key -> number of open sessions
+        self._in_use = {}       # id(conn) -> (key, server, created_at)
+        self._changed = None    # asyncio.Event set when a session is freed
+        self._sweep_timer = None
+        self._sweep_loop = None
+        self._sweep_task = None
+
+    async def _close(self, conn):
+        try:
+            await asyncio.wait_for(conn.quit(), 5)
+        except Exception:
+            conn.close()
+
+    def _notify(self):
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = None
+
+    def _forget(self, key, server):
+        """Drop one open session from the counters"""
+        self._open[server] -= 1
+        self._open_by_key[key] -= 1
+        self._notify()
+
+    def _expired(self, entry, now):
+        conn, created_at, last_used = entry
+        return now - last_used > self.idle_timeout or now - created_at > self.max_age
+
+    def _sweep(self, now):
+        """Take expired idle sessions of every key out of the pool and return them"""
+        expired = []
+        for key, entries in self._idle.items():
+            for entry in [e for e in entries if self._expired(e, now)]:
+                entries.remove(entry)
+                self._forget(key, key[0])
+                expired.append(entry[0])
+        return expired
+
+    def _evict_idle(self, server):
+        """Take one idle session for ``server`` out of the pool to make room"""
+        for key, entries in self._idle.items():
+            if entries and key[0] == server:
+                self._forget(key, server)
+                return entries.pop(0)[0]
+        return None
+
+    def _schedule_sweep(self):
+        """Close idle sessions once they expire, even if the pool is not used again"""
+        loop = asyncio.get_running_loop()
+        if self._sweep_timer is not None and self._sweep_loop is loop:
+            return
+        entries = [entry for entries in self._idle.values() for entry in entries]
+        if not entries:
+            return
+        expires_at = min(min(last_used + self.idle_timeout, created_at + self.max_age)
+                         for conn, created_at, last_used in entries)
+        self._sweep_loop = loop
+        self._sweep_timer = loop.call_later(max(0, expires_at - time.time()) + 0.1, self._start_sweep)
+
+    def _start_sweep(self):
+        self._sweep_timer = None
+        self._sweep_task = asyncio.ensure_future(self._sweep_idle())
+
+    async def _sweep_idle(self):
+        for conn in self._sweep(time.time()):
+            await self._close(conn)
+        self._schedule_sweep()
+
+    async def acquire(self, key, factory):
+        """Check out a session for ``key``, opening one with ``factory`` if needed
+
+        ``key`` is a tuple whose first element is the server name.
+        """
+        server = key[0]
+        deadline = time.monotonic() + self.wait_timeout
+
+        while True:
+            if self._changed is None:
+                self._changed = asyncio.Event()
+            changed = self._changed
+            to_close = self._sweep(time.time())
+            entry = None
+            create = False
+
+            idle = self._idle.get(key)
+            if idle:
+                entry = idle.pop()
+            elif (self._open_by_key.get(key, 0) < self.max_per_key
+                    and self._open.get(server, 0) >= self.max_per_server):
+                evicted = self._evict_idle(server)
+                if evicted is not None:
+                    to_close.append(evicted)
+
+            if entry is None and (self._open_by_key.get(key, 0) < self.max_per_key
+                                  and self._open.get(server, 0) < self.max_per_server):
+                self._open[server] = self._open.get(server, 0) + 1
+                self._open_by_key[key] = self._open_by_key.get(key, 0) + 1
+                create = True
+
+            for conn in to_close:
+                await self._close(conn)
+
+            if entry is not None:
+                conn, created_at, last_used = entry
+                if time.time() - last_used >= self.health_check_interval:
+                    try:
+                        await conn.noop()
+                    except Exception:
+                        conn.close()
+                        self._forget(key, server)
+                        continue
+                self._in_use[id(conn)] = (key, server, created_at)
+                return conn
+
+            if create:
+                try:
+                    conn = await factory()
+                except BaseException:
+                    self._forget(key, server)
+                    raise
+                self._in_use[id(conn)] = (key, server, time.time())
+                return conn
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"No free session for {server} within {self.wait_timeout}s")
+            try:
+                await asyncio.wait_for(changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def release(self, conn, discard=False):
+        """Return a session to the pool, or close it when ``discard`` is set"""
+        key, server, created_at = self._in_use.pop(id(conn))
+        now = time.time()
+        to_close = self._sweep(now)
+        if getattr(conn, 'closed', False) or discard or now - created_at > self.max_age:
+            self._forget(key, server)
+            to_close.append(conn)
+        else:
+            self._idle.setdefault(key, []).append([conn, created_at, now])
+            self._notify()
+            self._schedule_sweep()
+        for conn in to_close:
+            if not getattr(conn, 'closed', False):
+                await self._close(conn)
+
+    async def close_all(self, key=None):
+        """Close idle sessions, for one key or the whole pool"""
+        keys = [key] if key is not None else list(self._idle)
+        to_close = []
+        for k in keys:
+            for entry in self._idle.pop(k, []):
+                self._forget(k, k[0])
+                to_close.append(entry[0])
+        for conn in to_close:
+            await self._close(conn)
+
+
+class MailLoop:
+    """Event loop running on a background thread for the asyncio mail backend
+
+    All asyncio sessions live on this one loop, so a single thread can
+    multiplex many mailbox fetches and sends at once.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='mail-loop', daemon=True).start()
+                self.loop = loop
+        return self.loop
+
+    def submit(self, coro):
+        """Schedule a coroutine on the mail loop; returns a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self._start())
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the mail loop and wait for its result"""
+        return self.submit(coro).result(timeout)
+
+    async def wait(self, coro):
+        """Await a coroutine on the mail loop from another event loop"""
+        return await asyncio.wrap_future(self.submit(coro))
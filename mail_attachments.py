@@ -0,0 +1,132 @@
+import binascii
+import hashlib
+import os
+import re
+import tempfile
+
+SHA256_HEX = re.compile(r'^[0-9a-f]{64}$')
+
+
+class AttachmentCollector:
+    """Receives the parts of one message from MessageFilter and stores them
+
+    Each attachment is decoded line by line into a temporary file while
+    its SHA-256 is computed, then moved to its content address, so memory
+    use does not depend on attachment size. ``saved`` lists the metadata
+    of every stored attachment in message order.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.saved = []
+        self.file = None
+
+    def start(self, part):
+        """Begin a new attachment from its parsed part headers"""
+        self.finish()
+        self.filename = part.get_filename() or ''
+        self.content_type = part.get_content_type()
+        self.encoding = str(part.get('Content-Transfer-Encoding', '7bit')).strip().lower()
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.pending = b''
+        # The CRLF ending the last line belongs to the MIME boundary, so a
+        # line break is only written once another line follows it
+        self.newline = b''
+        self.file, self.tmp_path = self.store.temp_file()
+
+    def _write(self, data):
+        if data:
+            self.hash.update(data)
+            self.size += len(data)
+            self.file.write(data)
+
+    def write(self, line):
+        """Decode one body line of the current attachment"""
+        if self.file is None:
+            return
+        if self.encoding == 'base64':
+            # Decode whole 4-character groups and carry the rest to the next line
+            data = self.pending + b''.join(line.split())
+            cut = len(data) - len(data) % 4
+            self.pending = data[cut:]
+            try:
+                self._write(binascii.a2b_base64(data[:cut]))
+            except binascii.Error:
+                pass
+        elif self.encoding == 'quoted-printable':
+            if line.endswith(b'='):
+                self._write(self.newline + binascii.a2b_qp(line[:-1]))
+                self.newline = b''
+            else:
+                self._write(self.newline + binascii.a2b_qp(line))
+                self.newline = b'\r\n'
+        else:
+            self._write(self.newline + line)
+            self.newline = b'\r\n'
+
+    def finish(self):
+        """Close the current attachment and move it to its content address"""
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        if not self.size:
+            os.remove(self.tmp_path)
+            return
+        sha256 = self.hash.hexdigest()
+        self.store.commit(self.tmp_path, sha256)
+        self.saved.append({
+            'filename': self.filename,
+            'content_type': self.content_type,
+            'size': self.size,
+            'sha256': sha256
+        })
+
+    def abort(self):
+        """Close and remove an attachment left half-written by a failed fetch"""
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+
+class AttachmentStore:
+    """Attachment files on disk, stored once per distinct content under their SHA-256
+
+    Directories are created when the first attachment is written.
+    """
+
+    def __init__(self, root='attachments'):
+        self.root = os.path.abspath(root)
+        self.tmp_dir = os.path.join(self.root, 'tmp')
+
+    def collector(self):
+        """Return a collector for the attachments of one message"""
+        return AttachmentCollector(self)
+
+    def temp_file(self):
+        """Open a new temporary file in the store; returns ``(file, path)``"""
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=self.tmp_dir)
+        return os.fdopen(fd, 'wb'), path
+
+    def path(self, sha256):
+        """Path of the file holding the content with this SHA-256, or None if invalid"""
+        if not SHA256_HEX.match(sha256):
+            return None
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def commit(self, tmp_path, sha256):
+        """Move a finished temporary file to its content address, dropping duplicates"""
+        path = self.path(sha256)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            return path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        return path
@@ -0,0 +1,191 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60
+)
+
+
+class Histogram:
+    """Cumulative latency histogram of one stage, in the Prometheus layout"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+
+    def observe(self, seconds, error=False):
+        for index, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                break
+        else:
+            index = len(self.buckets)
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+        self.errors += bool(error)
+
+    def merge(self, other):
+        for index, count in enumerate(other['counts']):
+            self.counts[index] += count
+        self.count += other['count']
+        self.sum += other['sum']
+        self.errors += other['errors']
+
+    def quantile(self, q):
+        """Estimate a quantile by interpolating inside its bucket, like histogram_quantile()"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            if count and seen + count >= rank:
+                if bound == float('inf'):
+                    return lower
+                return lower + (bound - lower) * (rank - seen) / count
+            seen += count
+            lower = bound
+        return lower
+
+    def to_dict(self):
+        return {'counts': list(self.counts), 'count': self.count, 'sum': self.sum, 'errors': self.errors}
+
+
+class Metrics:
+    """Thread-safe counters and per-stage latency histograms
+
+    Stages are timed with ``time(stage)`` or recorded with ``observe``;
+    ``render`` returns them in the Prometheus text format and ``summary``
+    as a table for the command line.
+    """
+
+    def __init__(self, prefix='mail', buckets=DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._stages = {}    # stage -> Histogram
+        self._counters = {}  # name -> value
+
+    def observe(self, stage, seconds, error=False):
+        """Record one run of a stage"""
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = Histogram(self.buckets)
+            histogram.observe(seconds, error)
+
+    @contextmanager
+    def time(self, stage):
+        """Time the enclosed block as one run of ``stage``; exceptions count as errors"""
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.observe(stage, time.perf_counter() - started, error=True)
+            raise
+        self.observe(stage, time.perf_counter() - started)
+
+    def count(self, name, amount=1):
+        """Add to a counter, e.g. bytes received"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def snapshot(self):
+        """Return all measurements as plain data, e.g. to send from a worker process"""
+        with self._lock:
+            return {
+                'stages': {stage: histogram.to_dict() for stage, histogram in self._stages.items()},
+                'counters': dict(self._counters)
+            }
+
+    def merge(self, snapshot):
+        """Add the measurements of a snapshot taken elsewhere"""
+        with self._lock:
+            for stage, data in snapshot['stages'].items():
+                histogram = self._stages.get(stage)
+                if histogram is None:
+                    histogram = self._stages[stage] = Histogram(self.buckets)
+                histogram.merge(data)
+            for name, value in snapshot['counters'].items():
+                self._counters[name] = self._counters.get(name, 0) + value
+
+    def since(self, snapshot):
+        """Return a new Metrics holding what was recorded after ``snapshot`` was taken"""
+        current = self.snapshot()
+        delta = {'stages': {}, 'counters': {}}
+        for stage, data in current['stages'].items():
+            old = snapshot['stages'].get(stage)
+            if old is not None:
+                data = {
+                    'counts': [new - before for new, before in zip(data['counts'], old['counts'])],
+                    'count': data['count'] - old['count'],
+                    'sum': data['sum'] - old['sum'],
+                    'errors': data['errors'] - old['errors']
+                }
+            if data['count']:
+                delta['stages'][stage] = data
+        for name, value in current['counters'].items():
+            if value - snapshot['counters'].get(name, 0):
+                delta['counters'][name] = value - snapshot['counters'].get(name, 0)
+        recent = Metrics(self.prefix, self.buckets)
+        recent.merge(delta)
+        return recent
+
+    def reset(self):
+        with self._lock:
+            self._stages = {}
+            self._counters = {}
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        name = f'{self.prefix}_stage_seconds'
+        lines = [
+            f'# HELP {name} Time spent in each stage of fetching, parsing, rendering and sending mail',
+            f'# TYPE {name} histogram'
+        ]
+        with self._lock:
+            stages = sorted(self._stages.items())
+            counters = sorted(self._counters.items())
+            for stage, histogram in stages:
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum:.6f}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+
+            errors = f'{self.prefix}_stage_errors_total'
+            lines += [f'# HELP {errors} Runs of each stage that raised an error', f'# TYPE {errors} counter']
+            lines += [f'{errors}{{stage="{stage}"}} {histogram.errors}' for stage, histogram in stages]
+
+            for counter, value in counters:
+                lines += [f'# TYPE {self.prefix}_{counter}_total counter', f'{self.prefix}_{counter}_total {value}']
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """A table of count, total, mean and estimated p50/p99 per stage"""
+        with self._lock:
+            stages = sorted(self._stages.items(), key=lambda item: -item[1].sum)
+            counters = sorted(self._counters.items())
+            lines = [f"{'stage':<14}{'count':>8}{'total s':>10}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}"]
+            for stage, histogram in stages:
+                lines.append(
+                    f"{stage:<14}{histogram.count:>8}{histogram.sum:>10.2f}"
+                    f"{histogram.sum / histogram.count * 1000 if histogram.count else 0:>10.2f}"
+                    f"{histogram.quantile(0.5) * 1000:>10.2f}{histogram.quantile(0.99) * 1000:>10.2f}"
+                    f"{histogram.errors:>8}"
+                )
+            for counter, value in counters:
+                lines.append(f"{counter}: {value}")
+        return '\n'.join(lines)
+
+
+# Registry shared by the web app, the exporter and the mail modules
+metrics = Metrics()
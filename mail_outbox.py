@@ -0,0 +1,191 @@
+import smtplib
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def classify_send_error(e):
+    """Describe a send failure as ``(message, permanent, broken)``
+
+    ``permanent`` is set for 5xx replies, which retrying will not fix;
+    ``broken`` means the session can no longer be used for the batch.
+    """
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, reply in e.recipients.values()]
+        return f"Recipients refused: {', '.join(e.recipients)}", all(code >= 500 for code in codes), False
+    if isinstance(e, smtplib.SMTPResponseException):
+        message = e.smtp_error.decode('utf-8', errors='ignore') if isinstance(e.smtp_error, bytes) else str(e.smtp_error)
+        return f"{e.smtp_code} {message}", e.smtp_code >= 500, e.smtp_code == 421
+    return str(e) or type(e).__name__, False, True
+
+
+class SendQueue:
+    """Outbound mail queue that sends in batches over one SMTP session per account
+
+    ``send_batch(email_address, password, items)`` sends a list of message
+    dicts over a single session and returns one ``(success, error,
+    permanent)`` tuple per item. Transient failures are retried up to
+    ``max_attempts`` times with exponential backoff starting at
+    ``retry_delay`` seconds. Each account may send at most
+    ``rate_per_minute`` messages per minute.
+    """
+
+    def __init__(self, send_batch, batch_size=50, rate_per_minute=120, max_attempts=5,
+                 retry_delay=5, max_workers=4, keep_finished=3600):
+        self.send_batch = send_batch
+        self.batch_size = batch_size
+        self.rate_per_minute = rate_per_minute
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_workers = max_workers
+        self.keep_finished = keep_finished
+        self._cond = threading.Condition()
+        self._jobs = {}      # job id -> job dict
+        self._pending = {}   # account -> deque of queued items
+        self._accounts = {}  # account -> {'password', 'tokens', 'refilled_at', 'busy'}
+        self._thread = None
+        self._executor = None
+        self._stopped = False
+
+    def _start(self):
+        """Start the dispatcher thread on first use (lock must be held)"""
+        if self._thread is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            self._thread = threading.Thread(target=self._run, name='mail-outbox', daemon=True)
+            self._thread.start()
+
+    def submit(self, email_address, password, messages):
+        """Queue messages for sending and return the job id
+
+        ``messages`` is a list of dicts with ``to_address``, ``subject``,
+        ``body`` and optionally ``in_reply_to``.
+        """
+        account = email_address.lower()
+        job_id = uuid.uuid4().hex
+        with self._cond:
+            self._jobs[job_id] = {
+                'id': job_id,
+                'account': account,
+                'status': 'queued',
+                'total': len(messages),
+                'sent': 0,
+                'failed': 0,
+                'errors': [],
+                'created_at': time.time(),
+                'finished_at': None,
+                'reported': False
+            }
+            state = self._accounts.setdefault(account, {
+                'tokens': self.rate_per_minute,
+                'refilled_at': time.time(),
+                'busy': False
+            })
+            state['email_address'] = email_address
+            state['password'] = password
+            pending = self._pending.setdefault(account, deque())
+            for message in messages:
+                pending.append({'job': job_id, 'message': message, 'attempts': 0, 'next_attempt': 0})
+            self._start()
+            self._cond.notify_all()
+        return job_id
+
+    def status(self, job_id, email_address):
+        """Return a copy of a job's progress, or None if it is not the account's job"""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None or job['account'] != email_address.lower():
+                return None
+            return dict(job, errors=list(job['errors']))
+
+    def take_failures(self, email_address):
+        """Return copies of the account's finished jobs with failed messages, each only once"""
+        account = email_address.lower()
+        with self._cond:
+            jobs = [
+                job for job in self._jobs.values()
+                if job['account'] == account and job['finished_at'] and job['failed'] and not job['reported']
+            ]
+            for job in jobs:
+                job['reported'] = True
+            return [dict(job, errors=list(job['errors'])) for job in sorted(jobs, key=lambda job: job['created_at'])]
+
+    def stop(self):
+        """Stop dispatching and wait for batches in flight"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._executor.shutdown(wait=True)
+
+    def _refill(self, state, now):
+        """Top up an account's send tokens (lock must be held)"""
+        elapsed = now - state['refilled_at']
+        state['tokens'] = min(self.rate_per_minute, state['tokens'] + elapsed * self.rate_per_minute / 60)
+        state['refilled_at'] = now
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+                now = time.time()
+                wake_at = now + 60
+
+                for job_id in [j for j, job in self._jobs.items()
+                               if job['finished_at'] and now - job['finished_at'] > self.keep_finished]:
+                    del self._jobs[job_id]
+
+                for account, pending in self._pending.items():
+                    state = self._accounts[account]
+                    if state['busy'] or not pending:
+                        continue
+                    self._refill(state, now)
+
+                    ready = [item for item in pending if item['next_attempt'] <= now]
+                    count = min(len(ready), self.batch_size, int(state['tokens']))
+                    if count:
+                        batch = ready[:count]
+                        for item in batch:
+                            pending.remove(item)
+                            self._jobs[item['job']]['status'] = 'sending'
+                        state['tokens'] -= count
+                        state['busy'] = True
+                        self._executor.submit(
+                            self._send, account, state['email_address'], state['password'], batch
+                        )
+                    elif ready:
+                        # Wait for the next token
+                        wake_at = min(wake_at, now + (1 - state['tokens']) * 60 / self.rate_per_minute)
+                    else:
+                        wake_at = min(wake_at, min(item['next_attempt'] for item in pending))
+
+                self._cond.wait(max(wake_at - now, 0.05))
+
+    def _send(self, account, email_address, password, batch):
+        try:
+            results = self.send_batch(email_address, password, [item['message'] for item in batch])
+        except Exception as e:
+            results = [(False, str(e), False)] * len(batch)
+
+        with self._cond:
+            now = time.time()
+            for item, (success, error, permanent) in zip(batch, results):
+                job = self._jobs.get(item['job'])
+                item['attempts'] += 1
+                if success:
+                    job['sent'] += 1
+                elif permanent or item['attempts'] >= self.max_attempts:
+                    job['failed'] += 1
+                    job['errors'].append(f"{item['message']['to_address']}: {error}")
+                else:
+                    item['next_attempt'] = now + self.retry_delay * 2 ** (item['attempts'] - 1)
+                    self._pending[account].append(item)
+                    continue
+                if job['sent'] + job['failed'] == job['total']:
+                    job['status'] = 'failed' if not job['sent'] else 'partial' if job['failed'] else 'sent'
+                    job['finished_at'] = now
+            self._accounts[account]['busy'] = False
+            self._cond.notify_all()
@@ -0,0 +1,163 @@
+import threading
+import time
+
+
+class ConnectionPool:
+    """Pool of authenticated POP3/SMTP sessions shared across requests
+
+    Connections are keyed by account (and credentials) and counted per
+    server so the pool never holds more than ``max_per_server`` sessions
+    open against one host, idle ones included. Idle sessions are checked
+    with NOOP before reuse and closed after ``idle_timeout`` seconds, or
+    once they are older than ``max_age``.
+    """
+
+    def __init__(self, max_per_server=4, max_per_key=1, idle_timeout=60,
+                 max_age=300, health_check_interval=5, wait_timeout=30):
+        self.max_per_server = max_per_server
+        self.max_per_key = max_per_key
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self.health_check_interval = health_check_interval
+        self.wait_timeout = wait_timeout
+        self._cond = threading.Condition()
+        self._idle = {}         # key -> list of [conn, created_at, last_used]
+        self._open = {}         # server -> number of open sessions
+        self._open_by_key = {}  # key -> number of open sessions
+        self._in_use = {}       # id(conn) -> (key, server, created_at)
+
+    def _close(self, conn):
+        """Close a connection, ignoring errors from dead sockets"""
+        try:
+            conn.quit()
+        except Exception:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def _forget(self, key, server):
+        """Drop one open session from the counters (lock must be held)"""
+        self._open[server] -= 1
+        self._open_by_key[key] -= 1
+        self._cond.notify_all()
+
+    def _expired(self, entry, now):
+        conn, created_at, last_used = entry
+        return now - last_used > self.idle_timeout or now - created_at > self.max_age
+
+    def _sweep(self, now):
+        """Collect expired idle sessions (lock must be held)"""
+        expired = []
+        for key, entries in self._idle.items():
+            for entry in [e for e in entries if self._expired(e, now)]:
+                entries.remove(entry)
+                expired.append((key, entry))
+        return expired
+
+    def _evict_idle(self, server):
+        """Remove one idle session for ``server`` to make room (lock must be held)"""
+        for key, entries in self._idle.items():
+            if entries and key[0] == server:
+                return key, entries.pop(0)
+        return None
+
+    def acquire(self, key, factory):
+        """Check out a connection for ``key``, opening one with ``factory`` if needed
+
+        ``key`` is a tuple whose first element is the server name.
+        """
+        server = key[0]
+        deadline = time.monotonic() + self.wait_timeout
+
+        while True:
+            to_close = []
+            entry = None
+            create = False
+
+            with self._cond:
+                now = time.time()
+                for expired_key, expired in self._sweep(now):
+                    self._forget(expired_key, expired_key[0])
+                    to_close.append(expired[0])
+
+                idle = self._idle.get(key)
+                if idle:
+                    entry = idle.pop()
+                elif (self._open_by_key.get(key, 0) < self.max_per_key
+                        and self._open.get(server, 0) >= self.max_per_server):
+                    evicted = self._evict_idle(server)
+                    if evicted:
+                        evicted_key, evicted_entry = evicted
+                        self._forget(evicted_key, server)
+                        to_close.append(evicted_entry[0])
+
+                if entry is None and (self._open_by_key.get(key, 0) < self.max_per_key
+                                      and self._open.get(server, 0) < self.max_per_server):
+                    self._open[server] = self._open.get(server, 0) + 1
+                    self._open_by_key[key] = self._open_by_key.get(key, 0) + 1
+                    create = True
+
+                if entry is None and not create:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(f"No free session for {server} within {self.wait_timeout}s")
+                    self._cond.wait(remaining)
+
+            for conn in to_close:
+                self._close(conn)
+
+            if entry is not None:
+                conn, created_at, last_used = entry
+                if time.time() - last_used < self.health_check_interval or self._healthy(conn):
+                    with self._cond:
+                        self._in_use[id(conn)] = (key, server, created_at)
+                    return conn
+                self._close(conn)
+                with self._cond:
+                    self._forget(key, server)
+                continue
+
+            if create:
+                try:
+                    conn = factory()
+                except Exception:
+                    with self._cond:
+                        self._forget(key, server)
+                    raise
+                with self._cond:
+                    self._in_use[id(conn)] = (key, server, time.time())
+                return conn
+
+    def _healthy(self, conn):
+        """Check an idle connection with NOOP"""
+        try:
+            conn.noop()
+            return True
+        except Exception:
+            return False
+
+    def release(self, conn, discard=False):
+        """Return a connection to the pool, or close it when ``discard`` is set"""
+        with self._cond:
+            key, server, created_at = self._in_use.pop(id(conn))
+            now = time.time()
+            if discard or now - created_at > self.max_age:
+                self._forget(key, server)
+            else:
+                self._idle.setdefault(key, []).append([conn, created_at, now])
+                self._cond.notify_all()
+                return
+        self._close(conn)
+
+    def close_all(self, key=None):
+        """Close idle connections, for one key or the whole pool"""
+        to_close = []
+        with self._cond:
+            keys = [key] if key is not None else list(self._idle)
+            for k in keys:
+                for entry in self._idle.pop(k, []):
+                    self._forget(k, k[0])
+                    to_close.append(entry[0])
+        for conn in to_close:
+            self._close(conn)
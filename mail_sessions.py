@@ -0,0 +1,191 @@
+import base64
+import hmac
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+# Seconds between writes of a session's last-use time to the store, and
+# between sweeps for expired sessions
+TOUCH_INTERVAL = 60
+
+
+def encrypt_secret(key, plaintext, sid):
+    """Encrypt and authenticate a secret with AES-GCM, bound to its session id"""
+    nonce = os.urandom(12)
+    return nonce + AESGCM(key).encrypt(nonce, plaintext.encode('utf-8'), sid.encode('ascii'))
+
+
+def decrypt_secret(key, blob, sid):
+    """Return the secret sealed by encrypt_secret, or None if the key, session or data is wrong"""
+    try:
+        return AESGCM(key).decrypt(blob[:12], blob[12:], sid.encode('ascii')).decode('utf-8')
+    except (InvalidTag, ValueError):
+        return None
+
+
+class Credentials:
+    """Mail account credentials of one logged-in session"""
+
+    def __init__(self, email_address, password):
+        self.email_address = email_address
+        self.password = password
+        self.account = email_address.lower()
+
+
+class SessionStore:
+    """Server-side login sessions holding encrypted mail credentials
+
+    The browser cookie carries only a session id and the key that decrypts
+    the password kept here, so neither the cookie nor the store reveals it
+    alone. Records live in memory, or in a SQLite file at ``path`` shared by
+    several worker processes. Decrypted credentials are cached per process,
+    so a request only reads the store the first time a worker sees a
+    session. Sessions unused for ``ttl`` seconds expire.
+    """
+
+    def __init__(self, path=None, ttl=86400):
+        self.path = path
+        self.ttl = ttl
+        # Writes must keep the stored last-use time well inside the ttl
+        self.touch_interval = min(TOUCH_INTERVAL, ttl / 2)
+        self._lock = threading.Lock()
+        self._records = {}  # sid -> (email_address, secret, last_used), without a path
+        self._cache = {}    # sid -> (key, Credentials, last_used, last_written)
+        self._purged_at = time.time()
+        self._local = threading.local()
+        if path:
+            self._conn().execute('''
+                CREATE TABLE IF NOT EXISTS sessions (
+                    sid TEXT PRIMARY KEY,
+                    email_address TEXT NOT NULL,
+                    secret BLOB NOT NULL,
+                    created REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            ''')
+
+    def _conn(self):
+        """Return the SQLite connection for the current thread"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def create(self, email_address, password):
+        """Store new credentials and return the ``(sid, key)`` pair for the cookie"""
+        sid = secrets.token_urlsafe(24)
+        key = secrets.token_bytes(32)
+        secret = encrypt_secret(key, password, sid)
+        now = time.time()
+        if self.path:
+            self._conn().execute(
+                'INSERT INTO sessions (sid, email_address, secret, created, last_used) VALUES (?, ?, ?, ?, ?)',
+                (sid, email_address, secret, now, now)
+            )
+        else:
+            with self._lock:
+                self._records[sid] = (email_address, secret, now)
+        with self._lock:
+            self._cache[sid] = (key, Credentials(email_address, password), now, now)
+        self.purge()
+        return sid, base64.urlsafe_b64encode(key).decode('ascii')
+
+    def get(self, sid, key):
+        """Return the Credentials of a session, or None if it is unknown or expired"""
+        if not sid or not key:
+            return None
+        try:
+            key = base64.urlsafe_b64decode(key)
+        except (ValueError, TypeError):
+            return None
+        now = time.time()
+        with self._lock:
+            cached = self._cache.get(sid)
+        if now - self._purged_at >= self.touch_interval:
+            self.purge()
+        if cached is not None and hmac.compare_digest(cached[0], key):
+            key, credentials, last_used, last_written = cached
+            if now - last_used > self.ttl:
+                # Another worker may have used the session since; the store knows
+                record = self._load(sid)
+                if record is None or now - record[2] > self.ttl:
+                    self.delete(sid)
+                    return None
+            if now - last_written >= self.touch_interval:
+                # Refresh the expiry, which also notices logouts from other workers
+                if not self._touch(sid, now):
+                    self._forget(sid)
+                    return None
+                last_written = now
+            with self._lock:
+                self._cache[sid] = (key, credentials, now, last_written)
+            return credentials
+
+        record = self._load(sid)
+        if record is None:
+            return None
+        email_address, secret, last_used = record
+        if now - last_used > self.ttl:
+            self.delete(sid)
+            return None
+        password = decrypt_secret(key, secret, sid)
+        if password is None:
+            return None
+        self._touch(sid, now)
+        credentials = Credentials(email_address, password)
+        with self._lock:
+            self._cache[sid] = (key, credentials, now, now)
+        return credentials
+
+    def _load(self, sid):
+        if self.path:
+            return self._conn().execute(
+                'SELECT email_address, secret, last_used FROM sessions WHERE sid = ?', (sid,)
+            ).fetchone()
+        with self._lock:
+            return self._records.get(sid)
+
+    def _touch(self, sid, now):
+        """Record a use of the session; False if it no longer exists"""
+        if self.path:
+            return self._conn().execute(
+                'UPDATE sessions SET last_used = ? WHERE sid = ?', (now, sid)
+            ).rowcount > 0
+        with self._lock:
+            record = self._records.get(sid)
+            if record is None:
+                return False
+            self._records[sid] = record[:2] + (now,)
+            return True
+
+    def _forget(self, sid):
+        with self._lock:
+            self._cache.pop(sid, None)
+
+    def delete(self, sid):
+        """End a session"""
+        self._forget(sid)
+        if self.path:
+            self._conn().execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+        else:
+            with self._lock:
+                self._records.pop(sid, None)
+
+    def purge(self):
+        """Drop expired sessions"""
+        self._purged_at = time.time()
+        cutoff = self._purged_at - self.ttl
+        if self.path:
+            self._conn().execute('DELETE FROM sessions WHERE last_used < ?', (cutoff,))
+        with self._lock:
+            for sid in [sid for sid, record in self._records.items() if record[2] < cutoff]:
+                del self._records[sid]
+            for sid in [sid for sid, cached in self._cache.items() if cached[2] < cutoff]:
+                del self._cache[sid]
@@ -0,0 +1,763 @@
+import csv
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from email.utils import parseaddr
+
+from mail_text import is_reply_subject, normalize_subject, parse_message_ids
+
+# Bump when the cache layout changes; older caches are dropped and refetched
+SCHEMA_VERSION = 9
+
+# Columns covered by the full-text index, in index order
+FTS_COLUMNS = ('subject', 'from_addr', 'to_addr', 'cc_addr', 'body')
+
+# Bytes at each end of an indexed file's span hashed to notice rewrites
+DIGEST_SPAN = 64 * 1024
+
+
+def file_digest(path, size):
+    """Hash the first and last DIGEST_SPAN bytes of the first ``size`` bytes of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        digest.update(f.read(min(size, DIGEST_SPAN)))
+        if size > DIGEST_SPAN:
+            f.seek(max(DIGEST_SPAN, size - DIGEST_SPAN))
+            digest.update(f.read(size - f.tell()))
+    return digest.hexdigest()
+
+
+class MessageStore:
+    """Local SQLite cache of POP3 messages keyed by account and UIDL"""
+
+    def __init__(self, path='mail_cache.db'):
+        self.path = path
+        self._local = threading.local()
+        self._init_schema()
+
+    def _conn(self):
+        """Return the SQLite connection for the current thread"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        """Create the cache tables if they do not exist yet"""
+        conn = self._conn()
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        with conn:
+            if version != SCHEMA_VERSION:
+                for table in ('messages', 'maildrop', 'attachments', 'threads', 'thread_links',
+                              'messages_fts', 'exported', 'exported_fts', 'indexed_files'):
+                    conn.execute(f'DROP TABLE IF EXISTS {table}')
+                conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    account TEXT NOT NULL,
+                    uidl TEXT NOT NULL,
+                    msg_num INTEGER,
+                    date TEXT,
+                    from_addr TEXT,
+                    to_addr TEXT,
+                    cc_addr TEXT,
+                    subject TEXT,
+                    body TEXT,
+                    preview TEXT,
+                    has_body INTEGER NOT NULL DEFAULT 0,
+                    message_id TEXT,
+                    thread_id INTEGER,
+                    size INTEGER,
+                    fetched_at REAL,
+                    PRIMARY KEY (account, uidl)
+                )
+            """)
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_messages_num ON messages (account, msg_num)'
+            )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_messages_thread ON messages (account, thread_id, msg_num)'
+            )
+            # Conversations, with the message count and newest message number
+            # kept up to date so the threaded inbox pages without grouping
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS threads (
+                    thread_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    account TEXT NOT NULL,
+                    subject TEXT,
+                    subject_key TEXT,
+                    message_count INTEGER NOT NULL DEFAULT 0,
+                    last_msg_num INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_threads_last ON threads (account, last_msg_num)'
+            )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_threads_subject ON threads (account, subject_key)'
+            )
+            # Every Message-ID seen in a Message-ID, References or In-Reply-To
+            # header, with its parent and thread, whether or not it is cached
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS thread_links (
+                    account TEXT NOT NULL,
+                    message_id TEXT NOT NULL,
+                    parent_id TEXT,
+                    thread_id INTEGER NOT NULL,
+                    PRIMARY KEY (account, message_id)
+                )
+            """)
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_thread_links_thread ON thread_links (account, thread_id)'
+            )
+            # Every message on the server as of the last UIDL listing
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS maildrop (
+                    account TEXT NOT NULL,
+                    uidl TEXT NOT NULL,
+                    msg_num INTEGER NOT NULL,
+                    PRIMARY KEY (account, uidl)
+                )
+            """)
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_maildrop_num ON maildrop (account, msg_num)'
+            )
+            # Attachments of fully fetched messages; the files themselves
+            # live in the attachment store under their SHA-256
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS attachments (
+                    account TEXT NOT NULL,
+                    uidl TEXT NOT NULL,
+                    part INTEGER NOT NULL,
+                    filename TEXT,
+                    content_type TEXT,
+                    size INTEGER,
+                    sha256 TEXT NOT NULL,
+                    PRIMARY KEY (account, uidl, part)
+                )
+            """)
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_attachments_sha256 ON attachments (account, sha256)'
+            )
+            # Rows of exported CSV files, e.g. sent_items.csv
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS exported (
+                    account TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    row_num INTEGER NOT NULL,
+                    date TEXT,
+                    from_addr TEXT,
+                    to_addr TEXT,
+                    cc_addr TEXT,
+                    subject TEXT,
+                    body TEXT
+                )
+            """)
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_exported_source ON exported (source, row_num)'
+            )
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS indexed_files (
+                    source TEXT PRIMARY KEY,
+                    size INTEGER,
+                    mtime REAL,
+                    rows INTEGER,
+                    digest TEXT
+                )
+            """)
+            # Full-text indexes keyed by the rowid of the indexed row
+            for table in ('messages_fts', 'exported_fts'):
+                conn.execute(
+                    f"CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5({', '.join(FTS_COLUMNS)})"
+                )
+
+    def _row_to_email(self, row):
+        """Convert a database row to the dict shape used by the templates"""
+        return {
+            'id': row['msg_num'],
+            'uidl': row['uidl'],
+            'date': row['date'] or '',
+            'from': row['from_addr'] or '',
+            'to': row['to_addr'] or '',
+            'cc': row['cc_addr'] or '',
+            'subject': row['subject'] or '',
+            'body': row['body'] or '',
+            'preview': row['preview'] or '',
+            'has_body': bool(row['has_body']),
+            'message_id': row['message_id'] or '',
+            'thread_id': row['thread_id']
+        }
+
+    def known_uidls(self, account):
+        """Return the set of UIDLs already cached for an account"""
+        rows = self._conn().execute(
+            'SELECT uidl FROM messages WHERE account = ?', (account,)
+        )
+        return {row['uidl'] for row in rows}
+
+    def update_positions(self, account, uidls):
+        """Sync message numbers with the server and drop messages it no longer has
+
+        ``uidls`` maps message number to UIDL for the whole maildrop. The
+        listing is also kept in the maildrop table for paging.
+        """
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                'CREATE TEMP TABLE IF NOT EXISTS server_uidls (uidl TEXT PRIMARY KEY, msg_num INTEGER)'
+            )
+            conn.execute('DELETE FROM server_uidls')
+            conn.executemany(
+                'INSERT OR REPLACE INTO server_uidls (uidl, msg_num) VALUES (?, ?)',
+                [(uidl, num) for num, uidl in uidls.items()]
+            )
+            conn.execute("""
+                DELETE FROM messages_fts WHERE rowid IN (
+                    SELECT rowid FROM messages
+                    WHERE account = ? AND uidl NOT IN (SELECT uidl FROM server_uidls)
+                )
+            """, (account,))
+            deleted = conn.execute("""
+                DELETE FROM messages
+                WHERE account = ? AND uidl NOT IN (SELECT uidl FROM server_uidls)
+            """, (account,)).rowcount
+            conn.execute("""
+                DELETE FROM attachments
+                WHERE account = ? AND uidl NOT IN (SELECT uidl FROM server_uidls)
+            """, (account,))
+            renumbered = conn.execute("""
+                UPDATE messages
+                SET msg_num = (SELECT msg_num FROM server_uidls WHERE server_uidls.uidl = messages.uidl)
+                WHERE account = ? AND msg_num IS NOT (
+                    SELECT msg_num FROM server_uidls WHERE server_uidls.uidl = messages.uidl
+                )
+            """, (account,)).rowcount
+            if deleted or renumbered:
+                self._refresh_threads(conn, account)
+            conn.execute('DELETE FROM maildrop WHERE account = ?', (account,))
+            conn.execute("""
+                INSERT INTO maildrop (account, uidl, msg_num)
+                SELECT ?, uidl, msg_num FROM server_uidls
+            """, (account,))
+
+    def save_message(self, account, uidl, msg_num, email_data, size=None, has_body=True):
+        """Insert or replace a parsed message in the cache
+
+        Header-only entries from the listing pass ``has_body=False`` so the
+        full message is fetched the first time it is opened. Their preview
+        is indexed for search until the full body replaces it. Full entries
+        also record the ``attachments`` listed in ``email_data``. Every
+        entry is added to the thread index.
+        """
+        conn = self._conn()
+        with conn:
+            old = conn.execute(
+                'SELECT rowid FROM messages WHERE account = ? AND uidl = ?', (account, uidl)
+            ).fetchone()
+            if old:
+                conn.execute('DELETE FROM messages_fts WHERE rowid = ?', (old[0],))
+            cursor = conn.execute("""
+                INSERT OR REPLACE INTO messages (
+                    account, uidl, msg_num, date, from_addr, to_addr, cc_addr,
+                    subject, body, preview, has_body, message_id, size, fetched_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                account, uidl, msg_num,
+                email_data.get('date', ''),
+                email_data.get('from', ''),
+                email_data.get('to', ''),
+                email_data.get('cc', ''),
+                email_data.get('subject', ''),
+                email_data.get('body', '') if has_body else None,
+                email_data.get('preview', ''),
+                int(has_body),
+                email_data.get('message_id', ''),
+                size,
+                time.time()
+            ))
+            conn.execute(f"""
+                INSERT INTO messages_fts (rowid, {', '.join(FTS_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?)
+            """, (
+                cursor.lastrowid,
+                email_data.get('subject', ''),
+                email_data.get('from', ''),
+                email_data.get('to', ''),
+                email_data.get('cc', ''),
+                email_data.get('body', '') if has_body else email_data.get('preview', '')
+            ))
+            if has_body:
+                conn.execute(
+                    'DELETE FROM attachments WHERE account = ? AND uidl = ?', (account, uidl)
+                )
+                conn.executemany("""
+                    INSERT INTO attachments (account, uidl, part, filename, content_type, size, sha256)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, [
+                    (account, uidl, part, attachment['filename'], attachment['content_type'],
+                     attachment['size'], attachment['sha256'])
+                    for part, attachment in enumerate(email_data.get('attachments', []))
+                ])
+            self._thread_message(conn, account, uidl, email_data)
+
+    def _thread_message(self, conn, account, uidl, email_data):
+        """Add a message to the thread index (JWZ threading, applied incrementally)
+
+        The References and In-Reply-To chain of the message is linked into
+        thread_links, including IDs of messages that are not cached (JWZ's
+        empty containers), so a reply that arrives before its parent still
+        joins the parent's thread. Threads found to be connected are merged.
+        A reply without references joins the newest thread with the same
+        subject. Runs inside the transaction of save_message.
+        """
+        message_id = (parse_message_ids(email_data.get('message_id')) or [f'<{uidl}@{account}>'])[0]
+        refs = parse_message_ids(email_data.get('references'))
+        refs += [ref for ref in parse_message_ids(email_data.get('in_reply_to'))[:1] if ref not in refs]
+        refs = [ref for ref in dict.fromkeys(refs) if ref != message_id]
+        subject = email_data.get('subject', '')
+
+        ids = refs + [message_id]
+        links = {
+            row['message_id']: row for row in conn.execute(f"""
+                SELECT message_id, parent_id, thread_id FROM thread_links
+                WHERE account = ? AND message_id IN ({', '.join('?' * len(ids))})
+            """, [account] + ids)
+        }
+        thread_ids = sorted({row['thread_id'] for row in links.values()})
+        if not thread_ids and not refs and is_reply_subject(subject):
+            row = conn.execute("""
+                SELECT thread_id FROM threads WHERE account = ? AND subject_key = ?
+                ORDER BY last_msg_num DESC LIMIT 1
+            """, (account, normalize_subject(subject))).fetchone()
+            if row is not None:
+                thread_ids = [row['thread_id']]
+
+        if thread_ids:
+            thread_id, merged = thread_ids[0], thread_ids[1:]
+            if merged:
+                placeholders = ', '.join('?' * len(merged))
+                for table in ('thread_links', 'messages'):
+                    conn.execute(
+                        f'UPDATE {table} SET thread_id = ? WHERE account = ? AND thread_id IN ({placeholders})',
+                        [thread_id, account] + merged
+                    )
+                conn.execute(f'DELETE FROM threads WHERE thread_id IN ({placeholders})', merged)
+        else:
+            thread_id = conn.execute(
+                'INSERT INTO threads (account, subject, subject_key) VALUES (?, ?, ?)',
+                (account, subject, normalize_subject(subject))
+            ).lastrowid
+
+        # Link the reference chain, keeping parents that are already known
+        parent = None
+        for ref in refs:
+            if ref not in links:
+                conn.execute(
+                    'INSERT INTO thread_links (account, message_id, parent_id, thread_id) VALUES (?, ?, ?, ?)',
+                    (account, ref, parent, thread_id)
+                )
+            elif links[ref]['parent_id'] is None and parent is not None \
+                    and not self._is_descendant(conn, account, parent, ref):
+                conn.execute(
+                    'UPDATE thread_links SET parent_id = ? WHERE account = ? AND message_id = ?',
+                    (parent, account, ref)
+                )
+            parent = ref
+
+        # The message's own headers decide its parent, unless that makes a loop
+        if parent is not None and self._is_descendant(conn, account, parent, message_id):
+            parent = None
+        conn.execute(
+            'INSERT OR REPLACE INTO thread_links (account, message_id, parent_id, thread_id) VALUES (?, ?, ?, ?)',
+            (account, message_id, parent, thread_id)
+        )
+        if parent is None and not is_reply_subject(subject):
+            conn.execute(
+                'UPDATE threads SET subject = ?, subject_key = ? WHERE thread_id = ?',
+                (subject, normalize_subject(subject), thread_id)
+            )
+        conn.execute(
+            'UPDATE messages SET thread_id = ? WHERE account = ? AND uidl = ?', (thread_id, account, uidl)
+        )
+        self._refresh_threads(conn, account, [thread_id])
+
+    def _is_descendant(self, conn, account, message_id, ancestor):
+        """Whether ``ancestor`` is ``message_id`` or one of its parents in thread_links"""
+        seen = set()
+        while message_id is not None and message_id not in seen:
+            if message_id == ancestor:
+                return True
+            seen.add(message_id)
+            row = conn.execute(
+                'SELECT parent_id FROM thread_links WHERE account = ? AND message_id = ?',
+                (account, message_id)
+            ).fetchone()
+            message_id = row['parent_id'] if row else None
+        return False
+
+    def _refresh_threads(self, conn, account, thread_ids=None):
+        """Recount the messages of some (or all) threads of an account"""
+        where = 'account = ?'
+        params = [account]
+        if thread_ids is not None:
+            where += f" AND thread_id IN ({', '.join('?' * len(thread_ids))})"
+            params += list(thread_ids)
+        conn.execute(f"""
+            UPDATE threads SET
+                message_count = (
+                    SELECT COUNT(*) FROM messages m
+                    WHERE m.account = threads.account AND m.thread_id = threads.thread_id
+                ),
+                last_msg_num = COALESCE((
+                    SELECT MAX(m.msg_num) FROM messages m
+                    WHERE m.account = threads.account AND m.thread_id = threads.thread_id
+                ), 0)
+            WHERE {where}
+        """, params)
+
+    def get_messages(self, account, limit=50):
+        """Return the newest cached messages for an account"""
+        rows = self._conn().execute("""
+            SELECT account, uidl, msg_num, date, from_addr, to_addr, cc_addr,
+                   subject, NULL AS body, preview, has_body, message_id, thread_id
+            FROM messages
+            WHERE account = ?
+            ORDER BY msg_num DESC
+            LIMIT ?
+        """, (account, limit))
+        return [self._row_to_email(row) for row in rows]
+
+    def get_page(self, account, before=None, limit=50):
+        """Return one page of the inbox, newest first
+
+        ``before`` is the UIDL cursor returned for the previous page; the
+        page holds the ``limit`` messages below it on the server. Returns
+        a dict with the cached ``emails``, the ``missing`` message numbers
+        whose headers are not cached yet, the ``next`` cursor (None on the
+        last page) and the ``total`` number of messages.
+        """
+        conn = self._conn()
+        top = None
+        if before is not None:
+            row = conn.execute(
+                'SELECT msg_num FROM maildrop WHERE account = ? AND uidl = ?', (account, before)
+            ).fetchone()
+            if row is not None:
+                top = row['msg_num']
+
+        slice_rows = conn.execute("""
+            SELECT uidl, msg_num FROM maildrop
+            WHERE account = ? AND msg_num < ?
+            ORDER BY msg_num DESC
+            LIMIT ?
+        """, (account, top if top is not None else 2 ** 62, limit)).fetchall()
+
+        rows = conn.execute(f"""
+            SELECT account, uidl, msg_num, date, from_addr, to_addr, cc_addr,
+                   subject, NULL AS body, preview, has_body, message_id, thread_id
+            FROM messages
+            WHERE account = ? AND uidl IN ({', '.join('?' * len(slice_rows))})
+            ORDER BY msg_num DESC
+        """, [account] + [row['uidl'] for row in slice_rows])
+        emails = [self._row_to_email(row) for row in rows]
+
+        cached = {email_data['uidl'] for email_data in emails}
+        last = slice_rows[-1] if slice_rows else None
+        return {
+            'emails': emails,
+            'missing': [row['msg_num'] for row in slice_rows if row['uidl'] not in cached],
+            'next': last['uidl'] if last is not None and last['msg_num'] > 1 else None,
+            'total': self.maildrop_size(account)
+        }
+
+    def maildrop_size(self, account):
+        """Return the number of messages on the server as of the last sync"""
+        return self._conn().execute(
+            'SELECT COUNT(*) FROM maildrop WHERE account = ?', (account,)
+        ).fetchone()[0]
+
+    def get_messages_after(self, account, uidl, limit=50):
+        """Return messages numbered above the current position of ``uidl``, newest first
+
+        New mail is always numbered above the messages already in the
+        maildrop, so this finds arrivals but not older messages that were
+        cached or refreshed later. An unknown ``uidl`` returns the newest
+        messages.
+        """
+        rows = self._conn().execute("""
+            SELECT account, uidl, msg_num, date, from_addr, to_addr, cc_addr,
+                   subject, NULL AS body, preview, has_body, message_id, thread_id
+            FROM messages
+            WHERE account = ? AND msg_num > COALESCE(
+                (SELECT msg_num FROM messages WHERE account = ? AND uidl = ?), 0
+            )
+            ORDER BY msg_num DESC
+            LIMIT ?
+        """, (account, account, uidl, limit))
+        return [self._row_to_email(row) for row in rows]
+
+    def newest_uidl(self, account):
+        """Return the UIDL of the highest numbered cached message, or '' if there is none"""
+        row = self._conn().execute(
+            'SELECT uidl FROM messages WHERE account = ? ORDER BY msg_num DESC LIMIT 1', (account,)
+        ).fetchone()
+        return row[0] if row else ''
+
+    def get_message(self, account, msg_num):
+        """Return a single cached message by its current message number"""
+        row = self._conn().execute(
+            'SELECT * FROM messages WHERE account = ? AND msg_num = ?',
+            (account, msg_num)
+        ).fetchone()
+        if row is None:
+            return None
+        email_data = self._row_to_email(row)
+        email_data['attachments'] = self.get_attachments(account, row['uidl'])
+        return email_data
+
+    def get_threads(self, account, before=None, limit=50):
+        """Return one page of conversations, most recently active first
+
+        ``before`` is the ``next`` cursor of the previous page: the UIDL of
+        the newest message of its last thread. Returns a dict with the
+        ``threads`` (each with its subject, message count and newest
+        message) and the ``next`` cursor, None on the last page.
+        """
+        conn = self._conn()
+        top = 2 ** 62
+        if before is not None:
+            row = conn.execute(
+                'SELECT msg_num FROM messages WHERE account = ? AND uidl = ?', (account, before)
+            ).fetchone()
+            if row is not None and row['msg_num'] is not None:
+                top = row['msg_num']
+
+        # Pick the page of threads before joining, so the join is one lookup per thread
+        rows = conn.execute("""
+            SELECT t.thread_id, t.subject AS thread_subject, t.message_count,
+                   m.uidl, m.msg_num, m.date, m.from_addr, m.subject, m.preview
+            FROM (
+                SELECT * FROM threads
+                WHERE account = ? AND message_count > 0 AND last_msg_num < ?
+                ORDER BY last_msg_num DESC
+                LIMIT ?
+            ) t
+            JOIN messages m ON m.account = t.account AND m.msg_num = t.last_msg_num
+            ORDER BY t.last_msg_num DESC
+        """, (account, top, limit + 1)).fetchall()
+
+        threads = [{
+            'thread_id': row['thread_id'],
+            'subject': row['thread_subject'] or row['subject'] or '',
+            'message_count': row['message_count'],
+            'id': row['msg_num'],
+            'uidl': row['uidl'],
+            'date': row['date'] or '',
+            'from': row['from_addr'] or '',
+            'preview': row['preview'] or ''
+        } for row in rows[:limit]]
+        return {
+            'threads': threads,
+            'next': threads[-1]['uidl'] if len(rows) > limit else None
+        }
+
+    def get_thread(self, account, thread_id):
+        """Return a conversation with its cached messages in tree order, or None
+
+        Each message gets a ``depth`` for indentation. Empty containers
+        (messages referenced but not cached) are left out and their
+        replies moved up a level, as in JWZ threading.
+        """
+        conn = self._conn()
+        thread = conn.execute(
+            'SELECT thread_id, subject, message_count FROM threads WHERE account = ? AND thread_id = ?',
+            (account, thread_id)
+        ).fetchone()
+        if thread is None or not thread['message_count']:
+            return None
+
+        parents = {
+            row['message_id']: row['parent_id'] for row in conn.execute(
+                'SELECT message_id, parent_id FROM thread_links WHERE account = ? AND thread_id = ?',
+                (account, thread_id)
+            )
+        }
+        rows = conn.execute("""
+            SELECT account, uidl, msg_num, date, from_addr, to_addr, cc_addr,
+                   subject, NULL AS body, preview, has_body, message_id, thread_id
+            FROM messages
+            WHERE account = ? AND thread_id = ?
+            ORDER BY msg_num
+        """, (account, thread_id))
+
+        messages = {}
+        for row in rows:
+            node = (parse_message_ids(row['message_id']) or [f"<{row['uidl']}@{account}>"])[0]
+            messages.setdefault(node, []).append(self._row_to_email(row))
+
+        children = {}
+        for node, parent in parents.items():
+            children.setdefault(parent if parent in parents else None, []).append(node)
+
+        def sort_key(node):
+            # Siblings in arrival order; empty containers by their first reply
+            if node in messages:
+                return messages[node][0]['id'] or 0
+            nums = [messages[child][0]['id'] or 0 for child in children.get(node, []) if child in messages]
+            return min(nums) if nums else 2 ** 62
+
+        emails = []
+        seen = set()
+        stack = [(node, 0) for node in sorted(children.get(None, []), key=sort_key, reverse=True)]
+        while stack:
+            node, depth = stack.pop()
+            if node in seen:
+                continue
+            seen.add(node)
+            for email_data in messages.get(node, []):
+                email_data['depth'] = depth
+                emails.append(email_data)
+            child_depth = depth + 1 if node in messages else depth
+            stack.extend(
+                (child, child_depth) for child in sorted(children.get(node, []), key=sort_key, reverse=True)
+            )
+
+        return {
+            'thread_id': thread['thread_id'],
+            'subject': thread['subject'] or '',
+            'message_count': thread['message_count'],
+            'emails': emails
+        }
+
+    def get_attachments(self, account, uidl):
+        """Return the attachments recorded for a message, in message order"""
+        rows = self._conn().execute("""
+            SELECT filename, content_type, size, sha256 FROM attachments
+            WHERE account = ? AND uidl = ?
+            ORDER BY part
+        """, (account, uidl))
+        return [dict(row) for row in rows]
+
+    def find_attachment(self, account, sha256):
+        """Return an attachment of the account with this content, or None"""
+        row = self._conn().execute(
+            'SELECT filename, content_type, size, sha256 FROM attachments WHERE account = ? AND sha256 = ?',
+            (account, sha256)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def index_export(self, path, account=None):
+        """Add the rows of an exported CSV file to the search index
+
+        Only rows appended since the last call are indexed. A file that
+        shrank, or whose previously indexed bytes changed because it was
+        rewritten, is indexed again from scratch. Rows belong
+        to ``account``, the account recorded in the export manifest, or
+        else the address in their From column.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return 0
+
+        source = os.path.abspath(path)
+        conn = self._conn()
+        state = conn.execute(
+            'SELECT size, mtime, rows, digest FROM indexed_files WHERE source = ?', (source,)
+        ).fetchone()
+        if state and state['size'] == stat.st_size and state['mtime'] == stat.st_mtime:
+            return 0
+
+        if account is None:
+            try:
+                with open(path + '.manifest.json', 'r', encoding='utf-8') as f:
+                    account = json.load(f).get('email')
+            except (OSError, ValueError):
+                pass
+
+        done = 0
+        if state and state['size'] <= stat.st_size and state['digest'] == file_digest(path, state['size']):
+            done = state['rows']
+        csv.field_size_limit(sys.maxsize)
+
+        with conn:
+            if not done:
+                conn.execute("""
+                    DELETE FROM exported_fts WHERE rowid IN (
+                        SELECT rowid FROM exported WHERE source = ?
+                    )
+                """, (source,))
+                conn.execute('DELETE FROM exported WHERE source = ?', (source,))
+
+            added = 0
+            with open(path, 'r', newline='', encoding='utf-8') as f:
+                for row_num, row in enumerate(csv.DictReader(f)):
+                    if row_num < done:
+                        continue
+                    owner = account or parseaddr(row.get('From') or '')[1]
+                    values = (
+                        row.get('Subject') or '', row.get('From') or '', row.get('To') or '',
+                        row.get('CC') or '', row.get('Email_Text') or ''
+                    )
+                    cursor = conn.execute("""
+                        INSERT INTO exported (
+                            account, source, row_num, date, subject, from_addr, to_addr, cc_addr, body
+                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """, (owner.lower(), source, row_num, row.get('Date') or '') + values)
+                    conn.execute(f"""
+                        INSERT INTO exported_fts (rowid, {', '.join(FTS_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?)
+                    """, (cursor.lastrowid,) + values)
+                    added += 1
+
+            conn.execute("""
+                INSERT OR REPLACE INTO indexed_files (source, size, mtime, rows, digest)
+                VALUES (?, ?, ?, ?, ?)
+            """, (source, stat.st_size, stat.st_mtime, done + added, file_digest(path, stat.st_size)))
+        return added
+
+    def search(self, account, query, limit=20, offset=0):
+        """Full-text search over cached messages and exported rows
+
+        Every word of ``query`` must match (as a prefix) in the subject,
+        addresses or body. Returns up to ``limit`` results ranked by
+        relevance, each with a highlighted snippet of the body.
+        """
+        terms = re.findall(r'\w+', query)
+        if not terms:
+            return []
+        match = ' '.join('"{}"*'.format(term) for term in terms)
+
+        rows = self._conn().execute("""
+            SELECT * FROM (
+                SELECT 'inbox' AS source, m.msg_num AS ref, m.date, m.from_addr, m.to_addr,
+                       m.subject, snippet(messages_fts, 4, '[', ']', '...', 12) AS snippet,
+                       bm25(messages_fts) AS rank
+                FROM messages_fts JOIN messages m ON m.rowid = messages_fts.rowid
+                WHERE messages_fts MATCH ? AND m.account = ?
+                UNION ALL
+                SELECT 'sent' AS source, e.row_num AS ref, e.date, e.from_addr, e.to_addr,
+                       e.subject, snippet(exported_fts, 4, '[', ']', '...', 12) AS snippet,
+                       bm25(exported_fts) AS rank
+                FROM exported_fts JOIN exported e ON e.rowid = exported_fts.rowid
+                WHERE exported_fts MATCH ? AND e.account = ?
+            )
+            ORDER BY rank
+            LIMIT ? OFFSET ?
+        """, (match, account, match, account, limit, offset))
+        return [{
+            'source': row['source'],
+            'id': row['ref'],
+            'date': row['date'] or '',
+            'from': row['from_addr'] or '',
+            'to': row['to_addr'] or '',
+            'subject': row['subject'] or '',
+            'snippet': row['snippet'] or ''
+        } for row in rows]
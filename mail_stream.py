@@ -0,0 +1,217 @@
+import poplib
+import time
+from email.parser import BytesFeedParser, BytesHeaderParser
+
+from mail_metrics import metrics
+
+# Errors after which a POP3 session has lost its place in the response
+# stream, e.g. a socket timeout mid-message; such sessions are discarded
+# rather than drained
+SESSION_ERRORS = (OSError, poplib.error_proto)
+
+# Content types whose bodies are kept; every other leaf part is skipped
+TEXT_TYPES = ('text/plain', 'text/html')
+
+
+class ResponseLines:
+    """Iterate over the lines of a POP3 multi-line response as they arrive
+
+    Lines are read one at a time from the socket and dot-unstuffed, so a
+    large message is never held in memory as a whole like ``retr()`` does.
+    ``octets`` counts the bytes received so far.
+    """
+
+    def __init__(self, connection, command, *args):
+        self.connection = connection
+        self.octets = 0
+        self.done = False
+        connection._putcmd(' '.join([command] + [str(arg) for arg in args]))
+        self.response = connection._getresp()
+
+    def __iter__(self):
+        while not self.done:
+            line, octets = self.connection._getline()
+            if line == b'.':
+                self.done = True
+                return
+            if line.startswith(b'..'):
+                octets -= 1
+                line = line[1:]
+            self.octets += octets
+            yield line
+
+    def drain(self):
+        """Read the rest of the response so the session can be reused"""
+        for line in self:
+            pass
+
+
+class MessageFilter:
+    """Push-style filter that keeps the lines of a message worth parsing
+
+    Headers and MIME boundaries are always kept. Bodies of text/plain and
+    text/html parts are kept up to ``max_text_bytes`` per message; the
+    bodies of attachments and other non-text parts are dropped unread, so
+    memory stays bounded no matter how large the message is. Given an
+    ``attachments`` collector (see mail_attachments), those bodies are
+    streamed into it instead of being dropped.
+
+    ``feed`` takes one line at a time, so the filter works the same for
+    blocking sockets and asyncio streams.
+    """
+
+    def __init__(self, max_text_bytes=1024 * 1024, max_header_bytes=256 * 1024, attachments=None):
+        self.max_text_bytes = max_text_bytes
+        self.max_header_bytes = max_header_bytes
+        self.attachments = attachments
+        self.boundaries = []
+        self.headers = []
+        self.header_bytes = 0
+        self.in_headers = True
+        self.keep = False
+        self.collect = False
+        self.text_bytes = 0
+
+    def feed(self, line):
+        """Return the lines to keep for one input line"""
+        if self.in_headers:
+            if line:
+                self.header_bytes += len(line) + 2
+                if self.header_bytes <= self.max_header_bytes:
+                    self.headers.append(line)
+                return []
+            return self.end_headers(line)
+
+        if self.boundaries and line.startswith(b'--'):
+            marker = line.rstrip()
+            for depth in range(len(self.boundaries) - 1, -1, -1):
+                if marker == self.boundaries[depth]:
+                    del self.boundaries[depth + 1:]
+                    self.end_attachment()
+                    self.in_headers = True
+                    return [line]
+                if marker == self.boundaries[depth] + b'--':
+                    del self.boundaries[depth:]
+                    self.end_attachment()
+                    self.keep = False
+                    return [line]
+
+        if self.collect:
+            self.attachments.write(line)
+        elif self.keep:
+            self.text_bytes += len(line) + 2
+            if self.text_bytes <= self.max_text_bytes:
+                return [line]
+        return []
+
+    def end_headers(self, blank):
+        """Decide what to keep of the part whose header block just ended"""
+        kept = self.headers + [blank]
+        part = BytesHeaderParser().parsebytes(b'\r\n'.join(self.headers) + b'\r\n\r\n')
+        self.headers = []
+        self.header_bytes = 0
+        self.in_headers = False
+        self.keep = False
+
+        if part.get_content_maintype() == 'multipart':
+            boundary = part.get_boundary()
+            if boundary:
+                self.boundaries.append(b'--' + boundary.encode('ascii', errors='ignore'))
+        elif part.get_content_type() == 'message/rfc822':
+            # The body of an attached message starts with its own headers
+            self.in_headers = True
+        else:
+            self.keep = (part.get_content_type() in TEXT_TYPES
+                         and part.get_content_disposition() != 'attachment')
+            if not self.keep and self.attachments is not None:
+                self.attachments.start(part)
+                self.collect = True
+        return kept
+
+    def end_attachment(self):
+        """Hand the attachment being collected, if any, over to storage"""
+        if self.collect:
+            self.attachments.finish()
+            self.collect = False
+
+    def close(self):
+        """Return pending header lines, e.g. from TOP n 0 without a blank line"""
+        self.end_attachment()
+        kept, self.headers = self.headers, []
+        return kept
+
+
+def filter_lines(lines, max_text_bytes=1024 * 1024, max_header_bytes=256 * 1024, attachments=None):
+    """Yield the lines of a message worth parsing, see MessageFilter"""
+    message_filter = MessageFilter(max_text_bytes, max_header_bytes, attachments)
+    for line in lines:
+        yield from message_filter.feed(line)
+    yield from message_filter.close()
+
+
+def record_fetch(command, started, parse_seconds, octets, error=False, stage='parse'):
+    """Record a streamed fetch as time on the wire (``pop_retr``/``pop_top``) and processing time
+
+    The processing ``stage`` covers the MIME filter and attachment storage,
+    and for ``parse`` also the message parser.
+    """
+    metrics.observe('pop_' + command.lower(), time.perf_counter() - started - parse_seconds, error)
+    metrics.observe(stage, parse_seconds)
+    metrics.count('pop_bytes_received', octets)
+
+
+def read_message(connection, command, *args, max_text_bytes=1024 * 1024, attachments=None):
+    """Stream a RETR or TOP response into a parsed message
+
+    Returns ``(msg, octets)``. Non-text parts come back with empty bodies;
+    pass an ``attachments`` collector to store them on the way.
+    """
+    started = time.perf_counter()
+    response = ResponseLines(connection, command, *args)
+    message_filter = MessageFilter(max_text_bytes, attachments=attachments)
+    parser = BytesFeedParser()
+    parse_seconds = 0.0
+    try:
+        for line in response:
+            parse_started = time.perf_counter()
+            for kept in message_filter.feed(line):
+                parser.feed(kept + b'\r\n')
+            parse_seconds += time.perf_counter() - parse_started
+        parse_started = time.perf_counter()
+        for kept in message_filter.close():
+            parser.feed(kept + b'\r\n')
+        msg = parser.close()
+        parse_seconds += time.perf_counter() - parse_started
+    except BaseException as e:
+        record_fetch(command, started, parse_seconds, response.octets, error=True)
+        if isinstance(e, Exception) and not isinstance(e, SESSION_ERRORS):
+            response.drain()
+        raise
+    record_fetch(command, started, parse_seconds, response.octets)
+    return msg, response.octets
+
+
+def read_raw(connection, command, *args, max_text_bytes=1024 * 1024, attachments=None):
+    """Stream a RETR or TOP response into filtered raw message bytes
+
+    Like read_message, but returns ``(raw_bytes, octets)`` for callers that
+    parse elsewhere, e.g. in another process.
+    """
+    started = time.perf_counter()
+    response = ResponseLines(connection, command, *args)
+    message_filter = MessageFilter(max_text_bytes, attachments=attachments)
+    kept = []
+    parse_seconds = 0.0
+    try:
+        for line in response:
+            parse_started = time.perf_counter()
+            kept.extend(message_filter.feed(line))
+            parse_seconds += time.perf_counter() - parse_started
+        kept.extend(message_filter.close())
+    except BaseException as e:
+        record_fetch(command, started, parse_seconds, response.octets, error=True, stage='filter')
+        if isinstance(e, Exception) and not isinstance(e, SESSION_ERRORS):
+            response.drain()
+        raise
+    record_fetch(command, started, parse_seconds, response.octets, stage='filter')
+    return b'\r\n'.join(kept), response.octets
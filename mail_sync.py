@@ -0,0 +1,160 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SyncWorker:
+    """Background thread that keeps the local store in sync for logged-in accounts
+
+    Accounts are registered at login and polled every ``interval``
+    seconds by calling ``sync(email_address, password)``, at most
+    ``max_workers`` accounts at a time. Accounts without any request for
+    ``idle_timeout`` seconds are dropped until they are used again.
+
+    With a ``mail_loop`` (mail_async.MailLoop), ``sync`` returns a
+    coroutine and every due account is synced concurrently on that loop
+    instead of on the thread pool.
+    """
+
+    def __init__(self, sync, interval=60, idle_timeout=1800, max_workers=4, mail_loop=None):
+        self.sync = sync
+        self.mail_loop = mail_loop
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        self.max_workers = max_workers
+        self._cond = threading.Condition()
+        self._accounts = {}  # account -> state dict
+        self._prefetching = set()
+        self._thread = None
+        self._executor = None
+        self._stopped = False
+
+    def _start(self):
+        """Start the scheduler thread on first use (lock must be held)"""
+        if self._thread is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            self._thread = threading.Thread(target=self._run, name='mail-sync', daemon=True)
+            self._thread.start()
+
+    def add(self, email_address, password):
+        """Register an account, or refresh its credentials and last use"""
+        account = email_address.lower()
+        with self._cond:
+            state = self._accounts.get(account)
+            if state is None:
+                state = self._accounts[account] = {
+                    'next_sync': 0,
+                    'last_sync': None,
+                    'syncing': False,
+                    'error': None
+                }
+                self._cond.notify_all()
+            state['email_address'] = email_address
+            state['password'] = password
+            state['last_seen'] = time.time()
+            self._start()
+
+    def remove(self, email_address):
+        """Stop syncing an account, e.g. at logout"""
+        with self._cond:
+            self._accounts.pop(email_address.lower(), None)
+
+    def request_sync(self, email_address):
+        """Sync an account as soon as possible instead of waiting for its turn"""
+        with self._cond:
+            state = self._accounts.get(email_address.lower())
+            if state is not None:
+                state['next_sync'] = 0
+                self._cond.notify_all()
+
+    def status(self, email_address):
+        """Return the sync state of an account for display"""
+        with self._cond:
+            state = self._accounts.get(email_address.lower())
+            if state is None:
+                return {'last_sync': None, 'syncing': False, 'error': None}
+            return {
+                'last_sync': state['last_sync'],
+                'syncing': state['syncing'] or state['last_sync'] is None,
+                'error': state['error']
+            }
+
+    def prefetch(self, key, fn):
+        """Run ``fn`` on a sync thread unless a prefetch for ``key`` is already queued"""
+        with self._cond:
+            if self._stopped or key in self._prefetching:
+                return
+            self._prefetching.add(key)
+            self._start()
+
+        def run():
+            try:
+                fn()
+            except Exception as e:
+                print(f"Prefetch error: {str(e)}")
+            finally:
+                with self._cond:
+                    self._prefetching.discard(key)
+
+        self._executor.submit(run)
+
+    def stop(self):
+        """Stop the scheduler and wait for running syncs to finish"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._executor.shutdown(wait=True)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+                now = time.time()
+                for account in [a for a, s in self._accounts.items()
+                                if now - s['last_seen'] > self.idle_timeout and not s['syncing']]:
+                    del self._accounts[account]
+
+                for account, state in self._accounts.items():
+                    if not state['syncing'] and state['next_sync'] <= now:
+                        state['syncing'] = True
+                        if self.mail_loop is not None:
+                            future = self.mail_loop.submit(self.sync(state['email_address'], state['password']))
+                            future.add_done_callback(
+                                lambda f, account=account: self._finish(account, f.exception() or f.result())
+                            )
+                        else:
+                            self._executor.submit(
+                                self._sync_account, account, state['email_address'], state['password']
+                            )
+
+                pending = [s['next_sync'] for s in self._accounts.values() if not s['syncing']]
+                timeout = min(pending) - now if pending else self.interval
+                self._cond.wait(max(timeout, 0.1))
+
+    def _sync_account(self, account, email_address, password):
+        try:
+            result = self.sync(email_address, password)
+        except Exception as e:
+            result = e
+        self._finish(account, result)
+
+    def _finish(self, account, result):
+        """Record the outcome of a sync: the added count, None, or an exception"""
+        error = None
+        if isinstance(result, BaseException):
+            error = str(result)
+            print(f"Sync error for {account}: {error}")
+        elif result is None:
+            error = 'Error retrieving emails'
+
+        with self._cond:
+            state = self._accounts.get(account)
+            if state is not None:
+                state['syncing'] = False
+                state['last_sync'] = time.time()
+                state['error'] = error
+                state['next_sync'] = time.time() + self.interval
+                self._cond.notify_all()
@@ -0,0 +1,233 @@
+import codecs
+import re
+from email.header import decode_header
+from functools import lru_cache
+from html.parser import HTMLParser
+
+# Charsets mail clients declare that Python does not know, or knows only
+# as a narrower subset than what is actually sent
+CHARSET_ALIASES = {
+    'gb2312': 'gb18030',
+    'gbk': 'gb18030',
+    'ks_c_5601-1987': 'cp949',
+    'iso-8859-8-i': 'iso-8859-8',
+}
+
+# Charsets that say nothing useful about 8-bit content; such bytes are
+# decoded with the UTF-8/Latin-1 fallback instead
+UNRELIABLE_CHARSETS = {'us-ascii', 'ascii', 'unknown-8bit', 'x-unknown'}
+
+ANGLE_ADDRESS = re.compile(r'<(.+?)>')
+
+MESSAGE_ID = re.compile(r'<[^<>\s]+>')
+
+# HTML elements whose content is never text
+HTML_SKIP_TAGS = {'script', 'style', 'head', 'title', 'noscript', 'template', 'svg', 'object'}
+
+# HTML elements that start a new line of text
+HTML_BLOCK_TAGS = {
+    'address', 'article', 'aside', 'blockquote', 'br', 'dd', 'div', 'dl', 'dt', 'footer', 'form',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li', 'ol', 'p', 'pre', 'section',
+    'table', 'tr', 'ul'
+}
+
+# Classes of elements holding the quoted history of a reply
+# (Gmail, Yahoo, Apple Mail and Thunderbird)
+HTML_QUOTE_CLASSES = {'gmail_quote', 'gmail_extra', 'yahoo_quoted', 'moz-cite-prefix'}
+
+# Outlook starts the quoted history with one of these ids; everything after it is history
+HTML_HISTORY_IDS = {'appendonsend', 'divrplyfwdmsg'}
+
+# Separator lines that start a forwarded or quoted original message
+ORIGINAL_MESSAGE = re.compile(r'^\s*-{2,}\s*(?:original message|forwarded message)\s*-{2,}', re.IGNORECASE)
+
+# Reply and forward prefixes, including localized and counted ones like "Re[2]:"
+REPLY_PREFIX = re.compile(r'^\s*(?:(?:re|fwd?|aw|sv|antw)\s*(?:\[\d+\])?\s*:\s*)+', re.IGNORECASE)
+
+
+@lru_cache(maxsize=256)
+def normalize_charset(charset):
+    """Map a declared charset to a codec Python can decode, or None"""
+    if not charset:
+        return None
+    charset = charset.strip().strip('"').lower()
+    if charset in UNRELIABLE_CHARSETS:
+        return None
+    charset = CHARSET_ALIASES.get(charset, charset)
+    try:
+        return codecs.lookup(charset).name
+    except LookupError:
+        return None
+
+
+def decode_bytes(data, charset=None):
+    """Decode bytes with the declared charset, falling back to UTF-8, then Latin-1
+
+    The UTF-8 fallback is strict so that 8-bit mail in a legacy charset
+    comes out as Latin-1 text instead of losing every non-ASCII byte.
+    """
+    codec = normalize_charset(charset)
+    if codec is not None:
+        return data.decode(codec, errors='ignore')
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return data.decode('latin-1')
+
+
+def decode_mime_words(s):
+    """Decode an RFC 2047 encoded header value
+
+    String values are cached because the same senders, recipients and
+    subject lines recur across thousands of messages. Raw 8-bit headers
+    come back from the parser as Header objects and are decoded uncached.
+    """
+    if s is None:
+        return ""
+    if isinstance(s, str):
+        return _decode_header_text(s)
+    return _decode_header(s)
+
+
+@lru_cache(maxsize=4096)
+def _decode_header_text(s):
+    if '=?' not in s:
+        return s
+    return _decode_header(s)
+
+
+def _decode_header(s):
+    try:
+        fragments = decode_header(s)
+    except Exception:
+        return str(s)
+    return ''.join(
+        decode_bytes(fragment, encoding) if isinstance(fragment, bytes) else fragment
+        for fragment, encoding in fragments
+    )
+
+
+def clean_text(text):
+    """Collapse runs of whitespace to single spaces and trim the ends"""
+    if text is None:
+        return ""
+    # str.split() splits on the same characters as \s and is faster than re.sub
+    return ' '.join(text.split())
+
+
+def decode_payload(part):
+    """Return the decoded text of a MIME part, honouring its charset"""
+    payload = part.get_payload(decode=True)
+    if payload is None:
+        return str(part.get_payload() or '')
+    return decode_bytes(payload, part.get_content_charset())
+
+
+def extract_address(value):
+    """Return the address in a ``Name <address>`` header, or the value itself"""
+    match = ANGLE_ADDRESS.search(value)
+    return match.group(1) if match else value
+
+
+def parse_message_ids(value):
+    """Return the ``<id>`` tokens of a Message-ID, In-Reply-To or References header, in order"""
+    if not value:
+        return []
+    return MESSAGE_ID.findall(str(value))
+
+
+def normalize_subject(subject):
+    """Strip reply and forward prefixes and fold case, for grouping messages by subject"""
+    return clean_text(REPLY_PREFIX.sub('', subject or '')).lower()
+
+
+def is_reply_subject(subject):
+    """Whether a subject starts with a reply or forward prefix"""
+    return bool(REPLY_PREFIX.match(subject or ''))
+
+
+class _QuotedHistory(Exception):
+    """Raised by _HTMLText at the start of the quoted history to stop parsing"""
+
+
+class _HTMLText(HTMLParser):
+    """Collects the visible text of an HTML document as it is fed
+
+    With ``strip_history`` the quoted history of replies and forwards is
+    left out as well.
+    """
+
+    def __init__(self, strip_history=False):
+        super().__init__(convert_charrefs=True)
+        self.strip_history = strip_history
+        self.parts = []
+        self.skip_tag = None
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if self.skip_tag:
+            self.skip_depth += tag == self.skip_tag
+            return
+        if tag in HTML_SKIP_TAGS or (self.strip_history and self.quoted(tag, dict(attrs))):
+            self.skip_tag = tag
+            self.skip_depth = 1
+            return
+        if tag in HTML_BLOCK_TAGS:
+            self.parts.append('\n')
+        elif tag in ('td', 'th'):
+            self.parts.append(' ')
+
+    def quoted(self, tag, attrs):
+        """Whether an element holds quoted history; raises _QuotedHistory where the history starts"""
+        classes = set((attrs.get('class') or '').lower().split())
+        if (attrs.get('id') or '').lower() in HTML_HISTORY_IDS or 'moz-cite-prefix' in classes:
+            raise _QuotedHistory()
+        return bool(classes & HTML_QUOTE_CLASSES) or (
+            tag == 'blockquote' and (attrs.get('type') or '').lower() == 'cite'
+        )
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if self.skip_tag == tag:
+            self.skip_depth -= 1
+            if not self.skip_depth:
+                self.skip_tag = None
+
+    def handle_endtag(self, tag):
+        if self.skip_tag:
+            if tag == self.skip_tag:
+                self.skip_depth -= 1
+                if not self.skip_depth:
+                    self.skip_tag = None
+            return
+        if tag in HTML_BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        if self.skip_tag:
+            return
+        if self.strip_history and ORIGINAL_MESSAGE.match(data):
+            raise _QuotedHistory()
+        self.parts.append(data)
+
+
+def html_to_text(html, strip_history=False):
+    """Return the visible text of an HTML body, one line per block element
+
+    The document is parsed in a single incremental pass and scripts and
+    styles are left out. ``strip_history`` also drops the quoted history
+    of replies and forwards, stopping the parse where it starts; that is
+    only meant for previews, since a forward's content is all history.
+    """
+    if not html:
+        return ""
+    parser = _HTMLText(strip_history)
+    try:
+        parser.feed(html)
+        # A tag cut off by a truncated body is dropped rather than shown as text
+        if not parser.rawdata.startswith('<'):
+            parser.close()
+    except _QuotedHistory:
+        pass
+    lines = (' '.join(line.split()) for line in ''.join(parser.parts).split('\n'))
+    return '\n'.join(line for line in lines if line)